@@ -1,18 +1,24 @@
 from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+import json
 import uvicorn
-from projectflow_graph import background_graph, AIMessage, HumanMessage, logger
+from projectflow_graph import astream_graph, get_graph, AIMessage, HumanMessage, logger
+import background_jobs
 import background_tool
 from typing import Optional, List
 from group_manager import get_group_manager
+import circuit_breaker
+import llm_client
+import metrics
+from config import CacheConfig
 from teacher_analysis_agent import create_teacher_analysis_agent
-from projectflow_graph import llm
 
 # 初始化工具（若未在 import 時 setup）
-background_tool.setup(background_graph, AIMessage, HumanMessage, logger=logger)
+background_tool.setup(lambda: get_graph("bookkeeping_graph"), AIMessage, HumanMessage, logger=logger)
 
 # 初始化教師分析 Agent
-teacher_agent = create_teacher_analysis_agent(llm)
+teacher_agent = create_teacher_analysis_agent()
 
 # API_KEY = "YOUR_INTERNAL_KEY"  # 放環境變數更安全
 
@@ -22,6 +28,11 @@ class BackgroundUpdateRequest(BaseModel):
     user_prompt: str
     group_id: Optional[str] = None  # 新增組別 ID 支援
 
+class ChatStreamRequest(BaseModel):
+    session_id: str
+    user_prompt: str
+    group_id: Optional[str] = None
+
 class CreateGroupRequest(BaseModel):
     group_id: str
     group_name: str
@@ -36,17 +47,69 @@ app = FastAPI(title="ProjectFlow Agent API", version="2.0.0")
 def background_update(req: BackgroundUpdateRequest):
     """背景更新工具 - 支援組別
     
-    Note: group_id 用於前端識別，實際處理使用 session_id
-    各組的 session 資料已在 projectflow_graph 中根據 group_id 獨立儲存
+    Note: 指定 group_id 時讀寫該組別目錄下的 session state，與對話介面共用同一個檔案
     """
     # if x_api_key != API_KEY:
     #     raise HTTPException(status_code=401, detail="Unauthorized")
     return background_tool.background_update_tool(
         session_id=req.session_id,
         prev_ai_prompt=req.prev_ai_prompt,
-        user_prompt=req.user_prompt
+        user_prompt=req.user_prompt,
+        group_id=req.group_id
+    )
+
+def _sse(event: dict) -> str:
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatStreamRequest):
+    """串流對話 - 以 text/event-stream 逐段推送 response_agent 的輸出
+    
+    事件格式：
+    - {"type": "token", "content": "..."}：回覆片段
+    - {"type": "done", "content": "..."}：清理後的完整回覆
+    - {"type": "error", "content": "..."}：執行失敗
+    
+    回覆完成後立即儲存本輪對話；背景工作可能被去重、合併或因佇列滿而捨棄，不能依賴它保存對話。
+    """
+    state = background_tool._load_state(req.session_id, req.group_id)
+    state["messages"].append(HumanMessage(content=req.user_prompt))
+
+    async def event_source():
+        try:
+            async for delta in astream_graph(state):
+                yield _sse({"type": "token", "content": delta})
+            background_tool.save_state(state)
+            yield _sse({"type": "done", "content": state["messages"][-1].content})
+        except Exception as e:
+            logger.error(f"[chat_stream] 串流失敗: {e}", exc_info=True)
+            yield _sse({"type": "error", "content": str(e)})
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
+@app.get("/metrics")
+def get_metrics():
+    """取得執行指標（快取命中率、端點健康狀態等）"""
+    snapshot = metrics.snapshot()
+    snapshot["background_jobs"] = background_jobs.stats()
+    if CacheConfig.ENABLED:
+        snapshot["llm_cache"] = llm_client.get_cache().stats()
+    pool = llm_client.get_endpoint_pool()
+    if pool is not None:
+        snapshot["llm_endpoints"] = pool.stats()
+    return snapshot
+
+@app.get("/health/llm")
+def llm_health():
+    """取得 LLM 斷路器狀態：任一斷路器未關閉時 status 為 degraded"""
+    breakers = circuit_breaker.all_stats()
+    degraded = any(b["state"] != circuit_breaker.CLOSED for b in breakers)
+    return {"status": "degraded" if degraded else "ok", "breakers": breakers}
+
 @app.post("/groups/create")
 def create_group(req: CreateGroupRequest):
     """建立新組別"""
@@ -129,6 +192,15 @@ def get_teacher_overview():
         ]
     }
 
+def _analysis_dict(analysis) -> dict:
+    return {
+        "group_id": analysis.group_id,
+        "difficulties": analysis.difficulties,
+        "suggestions": analysis.suggestions,
+        "analysis_summary": analysis.analysis_summary,
+        "generated_at": analysis.generated_at.isoformat()
+    }
+
 @app.post("/teacher/analyze")
 def analyze_group(req: GroupAnalysisRequest):
     """分析特定組別"""
@@ -140,13 +212,36 @@ def analyze_group(req: GroupAnalysisRequest):
     
     analysis = teacher_agent.analyze_group(progress)
     
-    return {
-        "group_id": analysis.group_id,
-        "difficulties": analysis.difficulties,
-        "suggestions": analysis.suggestions,
-        "analysis_summary": analysis.analysis_summary,
-        "generated_at": analysis.generated_at.isoformat()
-    }
+    return _analysis_dict(analysis)
+
+@app.post("/teacher/analyze_all")
+async def analyze_all_groups():
+    """同時分析所有組別，以 text/event-stream 依完成順序推送各組結果
+    
+    事件格式：
+    - {"type": "analysis", "completed": k, "total": n, "analysis": {...}}：一組的分析結果
+    - {"type": "done", "completed": k, "total": n}：全部完成
+    """
+    group_manager = get_group_manager()
+    progress_list = group_manager.get_all_progress()
+
+    async def event_source():
+        completed = 0
+        async for analysis in teacher_agent.aiter_analyses(progress_list):
+            completed += 1
+            yield _sse({
+                "type": "analysis",
+                "completed": completed,
+                "total": len(progress_list),
+                "analysis": _analysis_dict(analysis)
+            })
+        yield _sse({"type": "done", "completed": completed, "total": len(progress_list)})
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == "__main__":
     uvicorn.run("api_server:app", host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""
+ProjectFlow 背景工作模組
+
+每一輪對話結束後會在背景執行摘要/評分 workflow，本模組負責：
+
+1. 去重：同一輪若被重複送出（例如多個呼叫路徑各自啟動背景工作），會重複消耗 LLM
+   並由多個 writer 同時覆寫同一個 state_*.pkl。前景每一輪開始時在 state["turn_id"]
+   寫入新的識別碼；JobRegistry 依 session 記錄近期已送出的 turn_id，保證每個 session
+   的每一輪最多只有一個背景 pipeline。訊息數不能作為輪次：從尚未更新的 pickle 載入的
+   state，新的一輪可能與上一輪的訊息數相同。沒有 session_id 或 turn_id 的 state
+   無法識別，一律放行。
+
+2. 執行：WorkerPool 以固定數量的 worker thread 執行背景工作。同一 session 的工作
+   依送出順序逐一執行（serial lane），不同 session 平行執行；每個工作開始時套用
+   該 session 上一個工作的結果（見 JobRegistry.remember / latest），避免較舊的 state
+   覆寫較新的摘要。同一 session 已有等待中的工作時，新一輪的工作直接取代它
+   （coalesce），由新工作一次處理所有尚未處理的輪次。等待中的工作放在
+   有上限的佇列（BACKGROUND_QUEUE_SIZE），佇列已滿時依 BACKGROUND_QUEUE_OVERFLOW：
+   - block：等待空位（最多 BACKGROUND_QUEUE_BLOCK_TIMEOUT 秒，逾時丟棄新工作）
+   - drop_oldest：丟棄最舊的等待中工作
+   - reject：丟棄新工作
+
+指標：background_jobs_submitted、background_jobs_deduplicated、background_jobs_coalesced、
+background_jobs_dropped（reason）、
+background_queue_depth、background_queue_wait_seconds、background_job_seconds、
+background_workers_busy、background_worker_utilization、background_lanes。
+"""
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Set
+
+import metrics
+from config import BackgroundConfig
+
+logger = logging.getLogger(__name__)
+
+# 最多記錄的 session 數，超過時移除最久未送出的 session
+MAX_SESSIONS = 10000
+# 每個 session 記錄的近期 turn_id 數
+RECENT_TURNS = 16
+
+
+def new_turn_id() -> str:
+    """產生一輪對話的識別碼（由前景在每一輪開始時寫入 state["turn_id"]）"""
+    return uuid.uuid4().hex
+
+
+class JobRegistry:
+    """依 session 記錄已送出的背景工作輪次與最近一次完成的結果"""
+
+    def __init__(self, max_sessions: int = MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._turns: "OrderedDict[str, Deque[str]]" = OrderedDict()
+        self._results: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._deduplicated = 0
+
+    def claim(self, session_id: Optional[str], turn_id: Optional[str]) -> bool:
+        """
+        登記一個背景工作
+
+        Args:
+            session_id: session 識別碼
+            turn_id: 該輪對話的識別碼
+
+        Returns:
+            True 表示應執行；False 表示該輪已送出過，應略過
+        """
+        with self._lock:
+            recent = self._turns.get(session_id) if session_id and turn_id else None
+            duplicate = recent is not None and turn_id in recent
+            if duplicate:
+                self._deduplicated += 1
+            else:
+                self._submitted += 1
+                if session_id and turn_id:
+                    if recent is None:
+                        recent = self._turns[session_id] = deque(maxlen=RECENT_TURNS)
+                    recent.append(turn_id)
+                    self._turns.move_to_end(session_id)
+                    while len(self._turns) > self.max_sessions:
+                        self._turns.popitem(last=False)
+
+        if duplicate:
+            metrics.inc("background_jobs_deduplicated")
+            logger.info(f"[background_jobs] session {session_id} 的本輪（{turn_id}）已有背景工作，略過重複送出")
+            return False
+        metrics.inc("background_jobs_submitted")
+        return True
+
+    def remember(self, session_id: Optional[str], result: Dict[str, Any]) -> None:
+        """記錄 session 最近一次完成的背景工作結果"""
+        if not session_id:
+            return
+        with self._lock:
+            self._results[session_id] = dict(result)
+            self._results.move_to_end(session_id)
+            while len(self._results) > self.max_sessions:
+                self._results.popitem(last=False)
+
+    def latest(self, session_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """session 最近一次完成的背景工作結果，沒有時回傳 None"""
+        if not session_id:
+            return None
+        with self._lock:
+            result = self._results.get(session_id)
+            return dict(result) if result is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "sessions": len(self._turns),
+                "submitted": self._submitted,
+                "deduplicated": self._deduplicated,
+            }
+
+    def reset(self) -> None:
+        """清除所有紀錄（主要供測試使用）"""
+        with self._lock:
+            self._turns.clear()
+            self._results.clear()
+            self._submitted = 0
+            self._deduplicated = 0
+
+
+_registry = JobRegistry()
+
+
+def get_registry() -> JobRegistry:
+    return _registry
+
+
+def claim(state: Dict[str, Any]) -> bool:
+    """登記 state 對應的背景工作，同一 session 的同一輪已送出時回傳 False"""
+    return _registry.claim(state.get("session_id"), state.get("turn_id"))
+
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "reject")
+
+
+class _Job:
+    __slots__ = ("fn", "key", "seq", "enqueued_at")
+
+    def __init__(self, fn: Callable[[], Any], key: Hashable, seq: int):
+        self.fn = fn
+        self.key = key
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+
+
+class WorkerPool:
+    """
+    固定大小的 worker pool，搭配有上限的等待佇列
+
+    送出時可指定 key（例如 session_id）：同一 key 的工作依送出順序逐一執行（serial lane），
+    不同 key 的工作由各 worker 平行執行。未指定 key 的工作彼此獨立。
+    coalesce=True 時，同一 key 尚在等待的工作由新工作取代（保留原本的排隊位置）。
+    """
+
+    def __init__(self, workers: int, queue_size: int, overflow: str = "drop_oldest",
+                 block_timeout: float = 5.0, name: str = "background"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"不支援的佇列溢出策略: {overflow}（可用: {', '.join(OVERFLOW_POLICIES)}）")
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.name = name
+        # 每個 key 等待中的工作（只保留非空的 lane）；_ready 為有等待工作且目前沒有在執行的 key
+        self._lanes: Dict[Hashable, Deque[_Job]] = {}
+        self._ready: Deque[Hashable] = deque()
+        self._running: Set[Hashable] = set()
+        self._depth = 0
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._completed = 0
+        self._dropped = 0
+        self._coalesced = 0
+
+    def _start_workers(self) -> None:
+        """第一次送出工作時才啟動 worker（需持有 _cond）"""
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self._worker, name=f"{self.name}-worker-{len(self._threads)}", daemon=True
+            )
+            self._threads.append(thread)
+            thread.start()
+
+    def _drop(self, reason: str) -> None:
+        self._dropped += 1
+        metrics.inc("background_jobs_dropped", reason=reason)
+        logger.warning(f"[background_jobs] 背景佇列已滿（{self.queue_size}），丟棄工作（{reason}）")
+
+    def _report(self) -> None:
+        """更新佇列與 worker 指標（需持有 _cond）"""
+        busy = len(self._running)
+        metrics.set_gauge("background_queue_depth", self._depth)
+        metrics.set_gauge("background_workers_busy", busy)
+        metrics.set_gauge("background_worker_utilization", busy / self.workers)
+        metrics.set_gauge("background_lanes", len(self._lanes))
+
+    def _drop_oldest(self) -> None:
+        """丟棄所有 lane 中最早送出的等待中工作（需持有 _cond）"""
+        key = min(self._lanes, key=lambda k: self._lanes[k][0].seq)
+        lane = self._lanes[key]
+        lane.popleft()
+        self._depth -= 1
+        if not lane:
+            del self._lanes[key]
+            if key not in self._running:
+                self._ready.remove(key)
+        self._drop("drop_oldest")
+
+    def _coalesce(self, fn: Callable[[], Any], key: Hashable) -> bool:
+        """以新工作取代 key 最後一個等待中的工作（需持有 _cond），沒有等待中的工作時回傳 False"""
+        lane = self._lanes.get(key)
+        if not lane:
+            return False
+        lane[-1].fn = fn
+        self._coalesced += 1
+        metrics.inc("background_jobs_coalesced")
+        logger.info(f"[background_jobs] {key} 已有等待中的背景工作，合併為一次")
+        return True
+
+    def submit(self, fn: Callable[[], Any], key: Optional[Hashable] = None, coalesce: bool = False) -> bool:
+        """
+        送出背景工作
+
+        Args:
+            fn: 要執行的函式（不帶參數，例外由 pool 記錄）
+            key: 序列化的單位，同一 key 的工作依序執行；None 表示不需排序
+            coalesce: 同一 key 還有等待中的工作時，以 fn 取代它
+
+        Returns:
+            是否已排入佇列；佇列已滿且依策略丟棄新工作時回傳 False
+        """
+        with self._cond:
+            self._start_workers()
+            if coalesce and key is not None and self._coalesce(fn, key):
+                return True
+            if self._depth >= self.queue_size:
+                if self.overflow == "drop_oldest":
+                    self._drop_oldest()
+                elif self.overflow == "block":
+                    if not self._cond.wait_for(lambda: self._depth < self.queue_size, self.block_timeout):
+                        self._drop("timeout")
+                        return False
+                else:
+                    self._drop("rejected")
+                    return False
+            self._seq += 1
+            job = _Job(fn, key if key is not None else object(), self._seq)
+            lane = self._lanes.setdefault(job.key, deque())
+            lane.append(job)
+            self._depth += 1
+            if len(lane) == 1 and job.key not in self._running:
+                self._ready.append(job.key)
+            self._report()
+            self._cond.notify_all()
+        return True
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready)
+                key = self._ready.popleft()
+                lane = self._lanes[key]
+                job = lane.popleft()
+                if not lane:
+                    del self._lanes[key]
+                self._depth -= 1
+                self._running.add(key)
+                self._report()
+                # 通知 block 模式等待空位的送出端
+                self._cond.notify_all()
+            started = time.monotonic()
+            metrics.observe("background_queue_wait_seconds", started - job.enqueued_at)
+            try:
+                job.fn()
+            except Exception as e:
+                logger.error(f"[background_jobs] 背景工作執行失敗: {e}", exc_info=True)
+            finally:
+                metrics.observe("background_job_seconds", time.monotonic() - started)
+                with self._cond:
+                    self._running.discard(key)
+                    self._completed += 1
+                    # 同一 lane 還有工作時排到最後，讓其他 session 也有機會執行
+                    if key in self._lanes:
+                        self._ready.append(key)
+                    self._report()
+                    self._cond.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """等待所有工作完成（主要供測試與關閉前使用），逾時回傳 False"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._depth and not self._running, timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            busy = len(self._running)
+            return {
+                "workers": self.workers,
+                "busy": busy,
+                "utilization": round(busy / self.workers, 3),
+                "queue_depth": self._depth,
+                "queue_size": self.queue_size,
+                "lanes": len(self._lanes),
+                "overflow": self.overflow,
+                "completed": self._completed,
+                "dropped": self._dropped,
+                "coalesced": self._coalesced,
+            }
+
+
+_pool: Optional[WorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> WorkerPool:
+    """取得背景 worker pool（第一次使用時依 BackgroundConfig 建立）"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = WorkerPool(
+                    BackgroundConfig.WORKERS,
+                    BackgroundConfig.QUEUE_SIZE,
+                    BackgroundConfig.OVERFLOW,
+                    BackgroundConfig.BLOCK_TIMEOUT,
+                )
+    return _pool
+
+
+def submit(fn: Callable[[], Any], key: Optional[Hashable] = None, coalesce: bool = False) -> bool:
+    """將背景工作送到 worker pool，同一 key（session）的工作依序執行"""
+    return get_pool().submit(fn, key, coalesce)
+
+
+def stats() -> Dict[str, Any]:
+    """背景工作的登記與佇列狀態（供 /metrics 使用）"""
+    return {"registry": _registry.stats(), "pool": get_pool().stats()}
@@ -5,6 +5,9 @@ import logging
 import threading
 from typing import Any, Dict, List, Optional
 
+import background_jobs
+from config import BackgroundConfig
+
 # 這個模組將 background_update_tool 模組化，並提供給 GPTs / LangChain 的工具介面
 
 try:
@@ -41,13 +44,26 @@ BACKGROUND_UPDATE_TOOL_SPEC: Dict[str, Any] = {
 
 BACKGROUND_UPDATE_STRUCTURED_TOOL = None  # 在 setup 內建立
 
+# 前景與背景工作寫入同一個 state_*.pkl 時互斥
+_save_lock = threading.Lock()
+
+# 背景 workflow（summary/score）負責更新的欄位，同一 session 的下一個背景工作以此為起點
+BOOKKEEPING_FIELDS = (
+    "project_content", "action_plan", "historical_log", "current_progress", "stage_number", "score",
+    "summary_cursor", "score_cursor",
+)
+
 # ----------------- 輔助函式 -----------------
 
-def _state_path(session_id: str) -> str:
+def _state_path(session_id: str, group_id: Optional[str] = None) -> str:
+    if group_id:
+        group_dir = os.path.join(os.getenv("GROUPS_DIR", "groups_data"), group_id)
+        os.makedirs(group_dir, exist_ok=True)
+        return os.path.join(group_dir, f"state_{session_id}.pkl")
     return os.path.join(SESSION_DIR, f"state_{session_id}.pkl")
 
-def _default_state(session_id: str) -> Dict[str, Any]:
-    return {
+def _default_state(session_id: str, group_id: Optional[str] = None) -> Dict[str, Any]:
+    state = {
         "messages": [],
         "next_agent": None,
         "project_content": "",
@@ -59,6 +75,9 @@ def _default_state(session_id: str) -> Dict[str, Any]:
         "next_response": None,
         "session_id": session_id
     }
+    if group_id:
+        state["group_id"] = group_id
+    return state
 
 def _flatten_graph_state(state: Dict[str, Any]) -> Dict[str, Any]:
     """將 LangGraph stream 產生的 {node_name: {...}} 結構攤平成頂層。
@@ -73,32 +92,57 @@ def _flatten_graph_state(state: Dict[str, Any]) -> Dict[str, Any]:
                     state[ik] = iv
     return state
 
-def _load_state(session_id: str) -> Dict[str, Any]:
-    path = _state_path(session_id)
+def _load_state(session_id: str, group_id: Optional[str] = None) -> Dict[str, Any]:
+    path = _state_path(session_id, group_id)
     if os.path.exists(path):
         try:
             with open(path, "rb") as f:
                 state = pickle.load(f)
             if not isinstance(state, dict):  # 防呆
-                return _default_state(session_id)
-            # 若是包在某個節點，例如 summary_agent/score_agent
-            # 模仿 buddy_web 的做法：如果包含 score_agent 就取其值
-            if "score_agent" in state and isinstance(state["score_agent"], dict):
-                base = state["score_agent"].copy()
-                base.update({k: v for k, v in state.items() if k not in ("score_agent", "summary_agent")})
-                state = base
-            elif "summary_agent" in state and isinstance(state["summary_agent"], dict):
-                base = state["summary_agent"].copy()
-                base.update({k: v for k, v in state.items() if k not in ("score_agent", "summary_agent")})
-                state = base
+                return _default_state(session_id, group_id)
+            # 若是包在某個節點，例如 summary_agent/score_agent/summary_score_agent
+            # 模仿 buddy_web 的做法：依序取最後執行的節點值
+            node_keys = ("score_agent", "summary_score_agent", "summary_agent")
+            for node in node_keys:
+                if node in state and isinstance(state[node], dict):
+                    base = state[node].copy()
+                    base.update({k: v for k, v in state.items() if k not in node_keys})
+                    state = base
+                    break
             # 基本欄位補齊
-            defaults = _default_state(session_id)
+            defaults = _default_state(session_id, group_id)
             for k, v in defaults.items():
                 state.setdefault(k, v)
             return _flatten_graph_state(state)
         except Exception as e:  # pragma: no cover
             _logger.warning(f"讀取既有 state 失敗，重新建立。error={e}")
-    return _default_state(session_id)
+    return _default_state(session_id, group_id)
+
+def save_state(state: Dict[str, Any]) -> None:
+    """
+    儲存 state 到 state_*.pkl（依 session_id / group_id 定位，沒有 session_id 時不儲存）。
+
+    前景每輪回覆後與背景工作完成後都會呼叫，寫入順序不固定，因此合併兩者較新的部分：
+    - 檔案中的對話較長時保留檔案中的 messages（背景工作的快照落後於前景已儲存的下一輪）
+    - 摘要欄位以同一 session 最新完成的背景工作結果為準（前景載入的可能是舊的）
+    """
+    session_id = state.get("session_id")
+    if not session_id:
+        return
+    group_id = state.get("group_id")
+    path = _state_path(session_id, group_id)
+    with _save_lock:
+        out = dict(state)
+        if os.path.exists(path):
+            saved = _load_state(session_id, group_id)
+            if len(saved.get("messages") or []) > len(out.get("messages") or []):
+                out["messages"] = saved["messages"]
+        latest = background_jobs.get_registry().latest(session_id)
+        if latest:
+            out.update(latest)
+        with open(path, "wb") as f:
+            pickle.dump(out, f)
+    _logger.info(f"已儲存 state 到 {path}")
 
 def _serialize_messages(messages: List[Any], tail: int = 12):
     out: List[Dict[str, str]] = []
@@ -112,12 +156,20 @@ def _serialize_messages(messages: List[Any], tail: int = 12):
         out.append({"role": role, "content": getattr(m, 'content', '')})
     return out
 
+def _get_background_graph():
+    """取得背景 graph；setup() 傳入的是建立函式時，於第一次使用時才呼叫"""
+    graph = _background_graph
+    if graph is not None and not hasattr(graph, "stream"):
+        graph = graph()
+    return graph
+
 # ----------------- 主工具函式 -----------------
 
-def background_update_tool(session_id: str, prev_ai_prompt: str, user_prompt: str) -> Dict[str, Any]:
+def background_update_tool(session_id: str, prev_ai_prompt: str, user_prompt: str,
+                           group_id: Optional[str] = None) -> Dict[str, Any]:
     if _background_graph is None:
         raise RuntimeError("background_update_tool 尚未經過 setup() 初始化背景圖。")
-    state = _load_state(session_id)
+    state = _load_state(session_id, group_id)
 
     # 附加上一輪 AI（避免重複）
     if prev_ai_prompt and (not state["messages"] or state["messages"][-1].content != prev_ai_prompt):  # type: ignore
@@ -126,22 +178,8 @@ def background_update_tool(session_id: str, prev_ai_prompt: str, user_prompt: st
     if user_prompt:
         state["messages"].append(_HumanMessage(content=user_prompt))  # type: ignore
 
-    # 執行背景 graph：攤平每個節點輸出的內層 dict
-    for event in _background_graph.stream(state):  # type: ignore
-        if isinstance(event, dict):
-            for node_name, node_state in event.items():
-                if isinstance(node_state, dict):
-                    # 合併 node_state 到 root
-                    for k, v in node_state.items():
-                        state[k] = v
-                    # 也保留 node_name -> node_state 以便除錯
-                    state[node_name] = node_state
-    # 再次攤平
-    state = _flatten_graph_state(state)
-
-    # 儲存
-    with open(_state_path(session_id), "wb") as f:
-        pickle.dump(state, f)
+    # 呼叫端需要本次結果，直接執行；與背景工作相同地記錄結果並經由 save_state 儲存
+    _run_bookkeeping(state, _get_background_graph())
 
     return {
         "session_id": session_id,
@@ -171,6 +209,11 @@ def _background_update_run(session_id: str, prev_ai_prompt: str, user_prompt: st
     return result
 
 def setup(background_graph, AIMessage, HumanMessage, logger: Optional[logging.Logger] = None):
+    """
+    注入背景 graph 與訊息類別
+
+    background_graph 可為編譯好的 graph，或回傳 graph 的函式（延後到第一次執行時才編譯）。
+    """
     global _background_graph, _AIMessage, _HumanMessage, _logger, BACKGROUND_UPDATE_STRUCTURED_TOOL
     _background_graph = background_graph
     _AIMessage = AIMessage
@@ -202,45 +245,65 @@ def list_available_tools():
 
 # ----------------- 非同步執行背景 Graph -----------------
 
-def run_async(state: Dict[str, Any]):
-    """在背景執行 background_graph，完成後儲存 state。"""
+def _run_bookkeeping(state: Dict[str, Any], graph) -> Dict[str, Any]:
+    """
+    執行 bookkeeping graph 並儲存結果（背景工作與 background_update_tool 共用）
+
+    以同一 session 上一個背景工作的結果為起點，完成後記錄到 JobRegistry，並經由 save_state 儲存。
+    """
+    session_id = state.get("session_id")
+    registry = background_jobs.get_registry()
+
+    # 套用同一 session 上一個背景工作的結果（送出時可能尚未完成）
+    latest = registry.latest(session_id)
+    if latest:
+        state.update(latest)
+
+    # 執行背景 graph：攤平每個節點輸出的內層 dict
+    for event in graph.stream(state):
+        if isinstance(event, dict):
+            for node_name, node_state in event.items():
+                if isinstance(node_state, dict):
+                    # 合併到 root
+                    for k, v in node_state.items():
+                        state[k] = v
+                    # 保留 node 結構
+                    state[node_name] = node_state
+
+    # 攤平結構
+    _flatten_graph_state(state)
+    registry.remember(session_id, {k: state[k] for k in BOOKKEEPING_FIELDS if k in state})
+
+    save_state(state)
+    return state
+
+def run_async(state: Dict[str, Any], graph=None) -> bool:
+    """
+    在背景執行 background_graph（或指定的 graph），完成後儲存 state。
+
+    工作交由 background_jobs 的 worker pool 執行；同一 session 的同一輪已送出過時不再執行。
+    同一 session 的背景工作依序執行，開始時先套用上一個工作的結果，
+    避免以送出時較舊的摘要欄位覆寫較新的結果。同一 session 還有等待中的工作時
+    （BACKGROUND_COALESCE），本輪的工作直接取代它，由 summary/score 一次處理所有尚未處理的輪次。
+
+    Returns:
+        是否已排入背景佇列
+    """
+    if not background_jobs.claim(state):
+        return False
+    graph = graph or _get_background_graph()
+    # 前景下一輪會繼續 append 同一個 messages list，背景工作需保留本輪的快照
+    state["messages"] = list(state.get("messages") or [])
+
     def _run_in_thread():
         try:
             _logger.info(f"[run_async] 開始執行背景 workflow，session_id: {state.get('session_id')}")
-            session_id = state.get("session_id")
-            group_id = state.get("group_id")
-            
-            # 執行背景 graph
-            for event in _background_graph.stream(state):
-                if isinstance(event, dict):
-                    for node_name, node_state in event.items():
-                        if isinstance(node_state, dict):
-                            # 合併到 root
-                            for k, v in node_state.items():
-                                state[k] = v
-                            # 保留 node 結構
-                            state[node_name] = node_state
-            
-            # 攤平結構
-            _flatten_graph_state(state)
-            
-            # 儲存 state
-            if session_id:
-                if group_id:
-                    group_dir = os.path.join(os.getenv("GROUPS_DIR", "groups_data"), group_id)
-                    os.makedirs(group_dir, exist_ok=True)
-                    state_path = os.path.join(group_dir, f"state_{session_id}.pkl")
-                else:
-                    state_path = _state_path(session_id)
-                
-                with open(state_path, "wb") as f:
-                    pickle.dump(state, f)
-                
-                _logger.info(f"[run_async] 背景 workflow 完成，已儲存 state 到 {state_path}")
+            _run_bookkeeping(state, graph)
+            _logger.info(f"[run_async] 背景 workflow 完成，session_id: {state.get('session_id')}")
         except Exception as e:
             _logger.error(f"[run_async] 背景 workflow 執行失敗: {e}", exc_info=True)
     
-    # 在新的 thread 中執行
-    thread = threading.Thread(target=_run_in_thread, daemon=True)
-    thread.start()
-    _logger.info("[run_async] 背景 thread 已啟動")
+    if not background_jobs.submit(_run_in_thread, key=state.get("session_id"), coalesce=BackgroundConfig.COALESCE):
+        return False
+    _logger.info("[run_async] 背景工作已排入佇列")
+    return True
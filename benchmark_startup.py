@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+ProjectFlow 啟動時間測試
+
+每個進入點在全新的 Python process 中匯入數次，量測：
+- import：匯入模組所需的秒數（容器冷啟動時使用者等待的主要部分）
+- first_use：匯入後第一次建立 LLM 與編譯 workflow 的秒數（延後到第一個請求時支付）
+- loaded_modules：匯入後已載入的提供者套件與其他大型套件，確認只載入 LLM_PROVIDER 選擇的提供者
+
+預設使用假 LLM（LLM_PROVIDER=fake），不需要任何金鑰。
+
+用法：
+    python benchmark_startup.py --repeat 5
+    python benchmark_startup.py --entry api_server --entry projectflow_graph
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# 進入點：模組名稱 → 第一次使用時的初始化程式碼
+ENTRY_POINTS = {
+    "projectflow_graph": "import projectflow_graph as m; m.get_graph('main_graph'); m.get_graph('bookkeeping_graph'); m.llm",
+    "api_server": "import projectflow_graph as g; g.get_graph('amain_graph'); g.get_graph('bookkeeping_graph'); m.teacher_agent.llm",
+    "student_interface": "import projectflow_graph as g; g.get_graph('main_graph'); g.get_graph('bookkeeping_graph')",
+    "teacher_interface": "m.teacher_agent.llm",
+    "projectflow_web": "import projectflow_graph as g; g.get_graph('main_graph'); g.get_graph('bookkeeping_graph')",
+    "llm_client": "m.get_llm(temperature=0)",
+}
+
+# 匯入較慢、應延後到使用時才載入的套件（gradio 為介面本身的依賴）
+TRACKED_MODULES = ("langchain_openai", "langchain_google_vertexai", "langgraph", "tiktoken", "gradio")
+
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module} as m
+imported = time.perf_counter()
+loaded = [name for name in {tracked!r} if name in sys.modules]
+{first_use}
+done = time.perf_counter()
+print(json.dumps({{"import": imported - started, "first_use": done - imported, "loaded_modules": loaded}}))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ProjectFlow 啟動時間測試")
+    parser.add_argument("--entry", action="append", choices=sorted(ENTRY_POINTS), help="要測試的進入點（可重複），預設全部")
+    parser.add_argument("--repeat", type=int, default=3, help="每個進入點執行的次數")
+    parser.add_argument("--real", action="store_true", help="使用 .env 設定的真實提供者")
+    return parser.parse_args()
+
+
+def run_once(module: str, env: dict) -> dict:
+    code = _PROBE.format(module=module, tracked=TRACKED_MODULES, first_use=ENTRY_POINTS[module])
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{module} 執行失敗：{result.stderr.strip().splitlines()[-1:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(values):
+    return {
+        "median": round(statistics.median(values), 3),
+        "min": round(min(values), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def main():
+    args = parse_args()
+    env = dict(os.environ)
+    if not args.real:
+        env["LLM_PROVIDER"] = "fake"
+    env.setdefault("SESSION_DIR", tempfile.mkdtemp(prefix="projectflow_startup_"))
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env.setdefault("MODULE_LOG_LEVEL", "WARNING")
+
+    report = {}
+    for module in args.entry or list(ENTRY_POINTS):
+        try:
+            runs = [run_once(module, env) for _ in range(max(1, args.repeat))]
+        except Exception as e:
+            report[module] = {"error": str(e)}
+            continue
+        report[module] = {
+            "import_seconds": summarize([r["import"] for r in runs]),
+            "first_use_seconds": summarize([r["first_use"] for r in runs]),
+            "loaded_modules": runs[-1]["loaded_modules"],
+        }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
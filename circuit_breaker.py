@@ -0,0 +1,201 @@
+"""
+ProjectFlow LLM 斷路器模組
+
+提供者故障時，每個請求都要等到逾時與重試結束才失敗，會長時間卡住 thread 與學生。
+斷路器依近期呼叫結果切換狀態：
+- closed：正常呼叫，記錄成功/失敗
+- open：錯誤率或連續失敗達門檻後開啟，期間所有呼叫立即拋出 CircuitOpenError
+- half_open：開啟一段時間後放行少量試探呼叫，成功則關閉，失敗則再次開啟
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+import metrics
+from config import CircuitBreakerConfig
+from utils import LLMError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(LLMError):
+    """斷路器開啟中，呼叫被立即拒絕"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"LLM 斷路器 {name} 開啟中，{retry_after:.0f} 秒後重試")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """以滑動視窗錯誤率與連續失敗次數判斷的斷路器"""
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = 0.5,
+        min_calls: int = 10,
+        window: int = 20,
+        consecutive_failures: int = 5,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 1,
+    ):
+        """
+        Args:
+            name: 斷路器名稱（通常為 提供者/模型）
+            failure_rate: 視窗內錯誤率達此值時開啟
+            min_calls: 以錯誤率判斷前視窗內所需的最少呼叫數
+            window: 滑動視窗保留的最近呼叫數
+            consecutive_failures: 連續失敗達此次數時開啟
+            open_seconds: 開啟後多久進入 half_open
+            half_open_calls: half_open 時同時放行的試探呼叫數
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.consecutive_failures = consecutive_failures
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._results: Deque[bool] = deque(maxlen=window)
+        self._failures_in_row = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._trials = 0
+            self._opened_at = now
+            logger.info(f"[CircuitBreaker] {self.name} 進入 half_open，放行試探呼叫")
+        elif self._state == HALF_OPEN and now - self._opened_at >= self.open_seconds:
+            # 試探呼叫遲遲沒有結果（例如被取消），重新放行
+            self._trials = 0
+            self._opened_at = now
+        return self._state
+
+    def allow(self) -> None:
+        """
+        檢查是否允許呼叫
+
+        Raises:
+            CircuitOpenError: 斷路器開啟中（或 half_open 試探額度已滿）
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return
+            retry_after = max(0.0, self.open_seconds - (now - self._opened_at))
+        metrics.inc("llm_circuit_rejected", breaker=self.name)
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures_in_row = 0
+            self._results.append(True)
+            if self._state == HALF_OPEN:
+                self._transition(CLOSED)
+                self._results.clear()
+
+    def record_failure(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._failures_in_row += 1
+            self._results.append(False)
+            if self._state == HALF_OPEN:
+                self._open(now)
+            elif self._state == CLOSED and self._should_open():
+                self._open(now)
+
+    def _failure_ratio(self) -> float:
+        if not self._results:
+            return 0.0
+        return self._results.count(False) / len(self._results)
+
+    def _should_open(self) -> bool:
+        if self._failures_in_row >= self.consecutive_failures:
+            return True
+        return len(self._results) >= self.min_calls and self._failure_ratio() >= self.failure_rate
+
+    def _open(self, now: float) -> None:
+        self._opened_at = now
+        self._transition(OPEN)
+        metrics.inc("llm_circuit_opened", breaker=self.name)
+        logger.warning(
+            f"[CircuitBreaker] {self.name} 開啟 {self.open_seconds:.0f}s"
+            f"（連續失敗 {self._failures_in_row} 次，錯誤率 {self._failure_ratio():.2f}）"
+        )
+
+    def _transition(self, state: str) -> None:
+        self._state = state
+        metrics.set_gauge("llm_circuit_open", 0 if state == CLOSED else 1, breaker=self.name)
+        if state == CLOSED:
+            logger.info(f"[CircuitBreaker] {self.name} 恢復正常 (closed)")
+
+    def stats(self) -> Dict[str, Any]:
+        """取得斷路器狀態"""
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            return {
+                "name": self.name,
+                "state": state,
+                "failure_rate": round(self._failure_ratio(), 4),
+                "calls_in_window": len(self._results),
+                "consecutive_failures": self._failures_in_row,
+                "retry_after": round(max(0.0, self.open_seconds - (now - self._opened_at)), 1)
+                if state == OPEN else 0.0,
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: str, model: Optional[str]) -> Optional[CircuitBreaker]:
+    """
+    取得指定提供者/模型的共用斷路器
+
+    Returns:
+        CircuitBreaker 實例，未啟用斷路器時回傳 None
+    """
+    if not CircuitBreakerConfig.ENABLED:
+        return None
+    name = f"{provider}/{model}"
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(
+                name,
+                failure_rate=CircuitBreakerConfig.FAILURE_RATE,
+                min_calls=CircuitBreakerConfig.MIN_CALLS,
+                window=CircuitBreakerConfig.WINDOW,
+                consecutive_failures=CircuitBreakerConfig.CONSECUTIVE_FAILURES,
+                open_seconds=CircuitBreakerConfig.OPEN_SECONDS,
+                half_open_calls=CircuitBreakerConfig.HALF_OPEN_CALLS,
+            )
+        return breaker
+
+
+def all_stats() -> List[Dict[str, Any]]:
+    """取得所有斷路器的狀態"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return [b.stats() for b in breakers]
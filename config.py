@@ -10,7 +10,7 @@ ProjectFlow 配置管理模組
 
 import os
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 import logging
 
@@ -26,25 +26,74 @@ SESSION_DIR.mkdir(exist_ok=True)
 class LLMConfig:
     """LLM 相關配置"""
     
+    # 提供者：azure、openai、vertexai 或 fake（離線測試用的假 LLM）
+    PROVIDER: str = os.getenv("LLM_PROVIDER", "openai").lower()
+    
     # OpenAI 或相容 API 設定
-    AZURE_ENDPOINT: Optional[str] = os.getenv("AZURE_OPENAI_ENDPOINT")
+    # 多個 OpenAI 相容端點（例如多台 vLLM），格式：url|權重，以逗號分隔，權重預設為 1
+    # 例如 http://vllm-a:8000|2,http://vllm-b:8000
+    ENDPOINTS: List[Tuple[str, float]] = [
+        (item.split("|")[0].strip(), float(item.split("|")[1]) if "|" in item else 1.0)
+        for item in os.getenv("AZURE_OPENAI_ENDPOINTS", "").split(",") if item.strip()
+    ]
+    AZURE_ENDPOINT: Optional[str] = os.getenv("AZURE_OPENAI_ENDPOINT") or (ENDPOINTS[0][0] if ENDPOINTS else None)
     AZURE_API_KEY: Optional[str] = os.getenv("AZURE_OPENAI_API_KEY")
     DEPLOYMENT: str = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
+    AZURE_API_VERSION: str = os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview")
     
     # Google Vertex AI 設定
     GOOGLE_CREDENTIALS: Optional[str] = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    VERTEX_MODEL: str = os.getenv("VERTEX_MODEL", "gemini-2.5-flash")
+    VERTEX_MODEL: str = os.getenv("VERTEX_AI_MODEL", os.getenv("VERTEX_MODEL", "gemini-2.5-flash"))
     
     # LLM 通用設定
     TEMPERATURE: float = float(os.getenv("LLM_TEMPERATURE", "0.7"))
     TIMEOUT: int = int(os.getenv("LLM_TIMEOUT", "60"))
     MAX_RETRIES: int = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    # 每輪對話的整體期限（秒），期限內未完成的 LLM 呼叫會被取消並改用備援回覆，0 表示不設期限
+    TURN_DEADLINE: float = float(os.getenv("TURN_DEADLINE_SECONDS", "45"))
+    # prompt 組裝方式：inline（單一訊息）或 prefix（靜態內容在前、動態欄位在後，利於提供者前綴快取）
+    PROMPT_LAYOUT: str = os.getenv("PROMPT_LAYOUT", "inline").lower()
+    # 背景以單一 summary_score_agent 取代 summary_agent → score_agent，每輪少一次 LLM 呼叫
+    FUSED_SUMMARY_SCORE: bool = os.getenv("FUSED_SUMMARY_SCORE", "false").lower() == "true"
+    # summary/score/decision 使用提供者原生的 JSON schema 結構化輸出（不支援的提供者沿用文字解析）
+    STRUCTURED_OUTPUT: bool = os.getenv("LLM_STRUCTURED_OUTPUT", "false").lower() == "true"
+    
+    # 各 agent 的提供者與模型（<PREFIX>_PROVIDER / <PREFIX>_MODEL，未設定時使用上方預設）
+    # 例如 SUMMARY_MODEL=gpt-4o-mini 讓背景 summary_agent 使用較便宜的模型
+    AGENT_PREFIXES: Dict[str, str] = {
+        "summary_agent": "SUMMARY",
+        "score_agent": "SCORE",
+        "summary_score_agent": "SUMMARY_SCORE",
+        "decision_agent": "DECISION",
+        "response_agent": "RESPONSE",
+        "teacher_analysis": "TEACHER",
+    }
+    AGENT_MODELS: Dict[str, Dict[str, Optional[str]]] = {
+        agent: {
+            "provider": os.getenv(f"{prefix}_PROVIDER"),
+            "model": os.getenv(f"{prefix}_MODEL"),
+        }
+        for agent, prefix in AGENT_PREFIXES.items()
+    }
+    
+    # HTTP 連線池設定（所有 OpenAI / Azure 客戶端共用）
+    HTTP_MAX_CONNECTIONS: int = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+    HTTP_MAX_KEEPALIVE: int = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "20"))
+    HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "30"))
+    HTTP2: bool = os.getenv("LLM_HTTP2", "false").lower() == "true"
+    CONNECT_TIMEOUT: float = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
     
     @classmethod
     def use_openai(cls) -> bool:
         """判斷是否使用 OpenAI 或相容 API"""
         return bool(cls.AZURE_ENDPOINT and cls.AZURE_API_KEY)
     
+    @classmethod
+    def agent_model(cls, agent: str) -> Tuple[Optional[str], Optional[str]]:
+        """取得指定 agent 的 (提供者, 模型)，未設定的欄位為 None"""
+        setting = cls.AGENT_MODELS.get(agent, {})
+        return setting.get("provider"), setting.get("model")
+    
     @classmethod
     def get_openai_endpoint(cls) -> str:
         """取得完整的 OpenAI API 端點 (確保有 /v1)"""
@@ -55,6 +104,221 @@ class LLMConfig:
             endpoint = endpoint.rstrip("/") + "/v1"
         return endpoint
 
+# === 輸出長度上限 ===
+# 預設上限：summary 需輸出完整的專案文件，上限較寬；決策與評分輸出較短
+_DEFAULT_MAX_TOKENS: Dict[str, int] = {
+    "summary_agent": 4000,
+    "score_agent": 1500,
+    "summary_score_agent": 5000,
+    "decision_agent": 600,
+    "response_agent": 1000,
+    "teacher_analysis": 1500,
+}
+
+
+class OutputBudgetConfig:
+    """各 agent 的輸出 token 上限（<PREFIX>_MAX_TOKENS，0 表示不限制）"""
+    
+    MAX_TOKENS: Dict[str, int] = {
+        agent: int(os.getenv(f"{prefix}_MAX_TOKENS", str(_DEFAULT_MAX_TOKENS.get(agent, 0))))
+        for agent, prefix in LLMConfig.AGENT_PREFIXES.items()
+    }
+    # 依負載縮減上限的 agent（學生等待中的回覆）
+    ADAPTIVE_AGENTS: frozenset = frozenset(
+        a.strip() for a in os.getenv("LLM_ADAPTIVE_BUDGET_AGENTS", "response_agent").split(",") if a.strip()
+    )
+    # 縮減後的最小上限
+    MIN_TOKENS: int = int(os.getenv("LLM_BUDGET_MIN_TOKENS", "300"))
+    # 進行中的 LLM 呼叫數超過 LOW 開始縮減，達 HIGH 時為最小上限
+    LOAD_LOW: int = int(os.getenv("LLM_BUDGET_LOAD_LOW", "8"))
+    LOAD_HIGH: int = int(os.getenv("LLM_BUDGET_LOAD_HIGH", "32"))
+    
+    @classmethod
+    def max_tokens(cls, agent: str) -> Optional[int]:
+        """取得 agent 的固定輸出上限，未設定或為 0 時回傳 None"""
+        return cls.MAX_TOKENS.get(agent) or None
+
+
+# === 假 LLM 設定（LLM_PROVIDER=fake） ===
+class FakeLLMConfig:
+    """離線壓力測試用假 LLM 的配置"""
+    
+    # 平均延遲（毫秒）與分布：fixed、uniform、exponential、lognormal
+    LATENCY_MS: float = float(os.getenv("FAKE_LLM_LATENCY_MS", "0"))
+    LATENCY_DISTRIBUTION: str = os.getenv("FAKE_LLM_LATENCY_DISTRIBUTION", "fixed").lower()
+    LATENCY_SIGMA: float = float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.5"))
+    # 主要文字欄位的平均長度（字數）與變動比例
+    OUTPUT_LENGTH: int = int(os.getenv("FAKE_LLM_OUTPUT_LENGTH", "120"))
+    OUTPUT_JITTER: float = float(os.getenv("FAKE_LLM_OUTPUT_JITTER", "0.3"))
+    ERROR_RATE: float = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+    CHUNK_SIZE: int = int(os.getenv("FAKE_LLM_CHUNK_SIZE", "4"))
+    SEED: int = int(os.getenv("FAKE_LLM_SEED", "42"))
+
+# === LLM 回應快取設定 ===
+class CacheConfig:
+    """LLM 回應快取相關配置（記憶體 LRU + SQLite）"""
+    
+    ENABLED: bool = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+    # 啟用快取的 agent（逗號分隔），未列出的 agent 一律直接呼叫 LLM
+    AGENTS: frozenset = frozenset(
+        a.strip() for a in os.getenv(
+            "LLM_CACHE_AGENTS", "teacher_analysis,decision_agent,summary_agent,score_agent,summary_score_agent"
+        ).split(",") if a.strip()
+    )
+    MEMORY_MAX_ENTRIES: int = int(os.getenv("LLM_CACHE_MEMORY_MAX_ENTRIES", "512"))
+    # 設為空字串表示只使用記憶體快取
+    DISK_PATH: str = os.getenv("LLM_CACHE_PATH", str(SESSION_DIR / "llm_cache.sqlite3"))
+    DISK_MAX_ENTRIES: int = int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", "10000"))
+    TTL_SECONDS: float = float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+    # 相同 prompt 的請求同時進行時合併為一次呼叫（與快取開關無關，所有 agent 適用）
+    SINGLEFLIGHT: bool = os.getenv("LLM_SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+    
+    @classmethod
+    def enabled_for(cls, agent: str) -> bool:
+        """判斷指定 agent 是否啟用快取"""
+        return cls.ENABLED and agent in cls.AGENTS
+
+# === LLM 速率限制設定 ===
+class RateLimitConfig:
+    """LLM 速率限制相關配置（每個提供者/部署各自計算）"""
+    
+    # 每分鐘請求數 / token 數上限，0 表示不限制
+    RPM: int = int(os.getenv("LLM_RPM", "0"))
+    TPM: int = int(os.getenv("LLM_TPM", "0"))
+    # 個別部署覆寫，格式：部署名稱=RPM:TPM，以逗號分隔，例如 gpt-4o=300:50000,gpt-4o-mini=1000:200000
+    OVERRIDES: Dict[str, Tuple[int, int]] = {
+        name.strip(): (int(limits.split(":")[0]), int(limits.split(":")[1]))
+        for name, limits in (
+            item.split("=", 1) for item in os.getenv("LLM_RATE_LIMITS", "").split(",") if "=" in item
+        )
+    }
+    # TPM 估算時每次請求預留的輸出 token 數
+    OUTPUT_TOKEN_ESTIMATE: int = int(os.getenv("LLM_OUTPUT_TOKEN_ESTIMATE", "500"))
+    
+    @classmethod
+    def limits_for(cls, provider: str, model: Optional[str]) -> Tuple[int, int]:
+        """取得指定提供者/部署的 (RPM, TPM)"""
+        for name in (f"{provider}/{model}", model, provider):
+            if name in cls.OVERRIDES:
+                return cls.OVERRIDES[name]
+        return cls.RPM, cls.TPM
+
+# === 多端點負載平衡設定 ===
+class EndpointPoolConfig:
+    """多個 OpenAI 相容端點的負載平衡與健康檢查配置（LLMConfig.ENDPOINTS 有兩個以上時啟用）"""
+    
+    # 錯誤率 / 延遲的 EWMA 平滑係數
+    EWMA_ALPHA: float = float(os.getenv("LLM_ENDPOINT_EWMA_ALPHA", "0.2"))
+    # 剔除條件：錯誤率、連續失敗次數、延遲超過其他端點中位數的倍數
+    EJECT_ERROR_RATE: float = float(os.getenv("LLM_ENDPOINT_EJECT_ERROR_RATE", "0.5"))
+    EJECT_CONSECUTIVE_FAILURES: int = int(os.getenv("LLM_ENDPOINT_EJECT_FAILURES", "3"))
+    EJECT_LATENCY_FACTOR: float = float(os.getenv("LLM_ENDPOINT_EJECT_LATENCY_FACTOR", "3"))
+    MIN_REQUESTS: int = int(os.getenv("LLM_ENDPOINT_MIN_REQUESTS", "5"))
+    # 剔除秒數（重複剔除時加倍，直到上限）
+    EJECT_SECONDS: float = float(os.getenv("LLM_ENDPOINT_EJECT_SECONDS", "30"))
+    MAX_EJECT_SECONDS: float = float(os.getenv("LLM_ENDPOINT_MAX_EJECT_SECONDS", "300"))
+    # 錯誤率在沒有新結果時減半的秒數
+    ERROR_HALF_LIFE: float = float(os.getenv("LLM_ENDPOINT_ERROR_HALF_LIFE", "30"))
+    
+    @classmethod
+    def enabled(cls) -> bool:
+        return len(LLMConfig.ENDPOINTS) > 1
+
+# === 對沖請求設定 ===
+class HedgeConfig:
+    """對沖請求 (hedged requests) 相關配置：慢請求超過門檻時送出第二個相同請求"""
+    
+    ENABLED: bool = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+    # 啟用對沖的 agent（逗號分隔）
+    AGENTS: frozenset = frozenset(
+        a.strip() for a in os.getenv("LLM_HEDGE_AGENTS", "response_agent").split(",") if a.strip()
+    )
+    # 以近期延遲的第幾百分位數作為對沖門檻（串流以第一個 chunk 的時間計算）
+    PERCENTILE: float = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+    # 累積足夠樣本前不對沖
+    MIN_SAMPLES: int = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+    # 門檻下限（秒），避免延遲很低時幾乎每次都對沖
+    MIN_DELAY: float = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+    # 設定多個端點時，對沖請求改送其他端點
+    OTHER_ENDPOINT: bool = os.getenv("LLM_HEDGE_OTHER_ENDPOINT", "true").lower() == "true"
+    MAX_WORKERS: int = int(os.getenv("LLM_HEDGE_MAX_WORKERS", "32"))
+    
+    @classmethod
+    def enabled_for(cls, agent: str) -> bool:
+        """判斷指定 agent 是否啟用對沖"""
+        return cls.ENABLED and agent in cls.AGENTS
+
+# === 斷路器設定 ===
+class CircuitBreakerConfig:
+    """LLM 斷路器相關配置（每個提供者/模型各自計算）"""
+    
+    ENABLED: bool = os.getenv("LLM_CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+    # 滑動視窗內錯誤率達門檻（且呼叫數足夠）或連續失敗達次數時開啟
+    FAILURE_RATE: float = float(os.getenv("LLM_CIRCUIT_FAILURE_RATE", "0.5"))
+    MIN_CALLS: int = int(os.getenv("LLM_CIRCUIT_MIN_CALLS", "10"))
+    WINDOW: int = int(os.getenv("LLM_CIRCUIT_WINDOW", "20"))
+    CONSECUTIVE_FAILURES: int = int(os.getenv("LLM_CIRCUIT_CONSECUTIVE_FAILURES", "5"))
+    # 開啟秒數，之後放行少量試探呼叫
+    OPEN_SECONDS: float = float(os.getenv("LLM_CIRCUIT_OPEN_SECONDS", "30"))
+    HALF_OPEN_CALLS: int = int(os.getenv("LLM_CIRCUIT_HALF_OPEN_CALLS", "1"))
+
+class RetryConfig:
+    """LLM 重試相關配置（集中在 llm_client 處理，客戶端本身不再重試）"""
+    
+    ENABLED: bool = os.getenv("LLM_RETRY_ENABLED", "true").lower() == "true"
+    # 第一次呼叫失敗後最多再試幾次
+    MAX_RETRIES: int = LLMConfig.MAX_RETRIES
+    # 指數退避：第 n 次重試在 0 ~ min(MAX_DELAY, BASE_DELAY * 2^n) 秒之間隨機等待 (full jitter)
+    BASE_DELAY: float = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+    MAX_DELAY: float = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+    # 提供者要求的 Retry-After 超過此秒數時不重試，直接失敗
+    MAX_RETRY_AFTER: float = float(os.getenv("LLM_RETRY_MAX_RETRY_AFTER", "30"))
+    
+    @classmethod
+    def client_max_retries(cls) -> int:
+        """LLM 客戶端內建的重試次數（啟用集中重試時為 0，避免重複重試）"""
+        return 0 if cls.ENABLED else LLMConfig.MAX_RETRIES
+
+class TeacherAnalysisConfig:
+    """教師「分析所有組別」的批次執行配置"""
+    
+    # 同時分析的組別數上限
+    CONCURRENCY: int = int(os.getenv("TEACHER_ANALYSIS_CONCURRENCY", "8"))
+    # 單一組別的分析期限（秒，含重試與排隊），逾時的組別回傳逾時結果，不影響其他組別
+    GROUP_TIMEOUT: float = float(os.getenv("TEACHER_ANALYSIS_GROUP_TIMEOUT", "60"))
+
+class BackgroundConfig:
+    """背景摘要/評分工作的執行配置（固定大小的 worker pool + 有上限的佇列）"""
+    
+    # 同時執行背景工作的 worker 數
+    WORKERS: int = int(os.getenv("BACKGROUND_WORKERS", "4"))
+    # 等待中的背景工作上限
+    QUEUE_SIZE: int = int(os.getenv("BACKGROUND_QUEUE_SIZE", "100"))
+    # 佇列已滿時的處理方式：block（等待空位）、drop_oldest（丟棄最舊的工作）、reject（丟棄新工作）
+    OVERFLOW: str = os.getenv("BACKGROUND_QUEUE_OVERFLOW", "drop_oldest").lower()
+    # block 模式最多等待的秒數，逾時則丟棄新工作，避免前景請求被卡住
+    BLOCK_TIMEOUT: float = float(os.getenv("BACKGROUND_QUEUE_BLOCK_TIMEOUT", "5"))
+    # 同一 session 還有等待中的工作時，以新一輪的工作取代（一次處理所有尚未處理的輪次）
+    COALESCE: bool = os.getenv("BACKGROUND_COALESCE", "true").lower() == "true"
+    # summary/score 每次最多讀取的對話訊息數（合併多輪時的上限）
+    MAX_DIALOG_MESSAGES: int = int(os.getenv("BACKGROUND_MAX_DIALOG_MESSAGES", "20"))
+
+class SummaryPolicyConfig:
+    """摘要頻率配置：對話變化不足時略過 summary，略過的輪次併入下一次摘要"""
+    
+    ENABLED: bool = os.getenv("SUMMARY_POLICY_ENABLED", "true").lower() == "true"
+    # 自上次摘要後使用者輸入累積達此 token 數時執行
+    MIN_TOKENS: int = int(os.getenv("SUMMARY_POLICY_MIN_TOKENS", "30"))
+    # 最多連續略過的輪數，超過時一定執行（避免摘要過舊）
+    MAX_SKIPPED_TURNS: int = int(os.getenv("SUMMARY_POLICY_MAX_SKIPPED_TURNS", "2"))
+    # 使用者輸入出現這些詞（換主題、階段、計畫等）時一定執行
+    KEYWORDS: List[str] = [
+        k.strip() for k in os.getenv(
+            "SUMMARY_POLICY_KEYWORDS",
+            "換主題,換題目,改成,改為,改變,放棄,重新,新的想法,決定,下一階段,階段,行動計畫,計畫,目標,SDG",
+        ).split(",") if k.strip()
+    ]
+
 # === 日誌設定 ===
 class LogConfig:
     """日誌相關配置"""
@@ -116,6 +380,8 @@ class WebConfig:
     SHARE: bool = os.getenv("WEB_SHARE", "false").lower() == "true"
     MAX_THREADS: int = int(os.getenv("WEB_MAX_THREADS", "40"))
     SHOW_ERROR: bool = os.getenv("WEB_SHOW_ERROR", "true").lower() == "true"
+    # 串流模式：response_agent 的輸出逐段推送到聊天視窗
+    STREAMING: bool = os.getenv("WEB_STREAMING", "true").lower() == "true"
 
 # === Token 統計設定 ===
 class TokenConfig:
@@ -0,0 +1,153 @@
+"""
+ProjectFlow 每輪對話期限 (per-turn deadline) 模組
+
+學生每一輪對話有一個整體期限，在 run_graph / stream_graph 進入時設定，
+以 contextvars 傳遞到該輪所有的 LLM 呼叫：
+- 每次呼叫的逾時不超過剩餘時間，速率限制排隊與對沖也只使用剩餘時間
+- 期限已過時不再送出新的呼叫，拋出 DeadlineExceeded，由 graph 改用備援回覆
+- 非同步呼叫與串流在期限到時直接取消
+
+asyncio task 會複製建立時的 context；背景的摘要/評分不屬於該輪的等待時間，
+需以 clear() 移除期限。同步串流可能在不同 thread 中逐步執行，
+請用 iterate() / aiterate() 在每一步重新套用期限。
+"""
+
+import asyncio
+import contextlib
+import time
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+import metrics
+from utils import LLMError
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(LLMError):
+    """本輪對話的期限已過"""
+
+    def __init__(self, stage: str = ""):
+        super().__init__(f"本輪對話已超過期限{f'（{stage}）' if stage else ''}")
+        self.stage = stage
+
+
+class Deadline:
+    """以 time.monotonic() 表示的絕對期限"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("projectflow_deadline", default=None)
+
+
+def start(seconds: float) -> Optional[Deadline]:
+    """建立新的期限（seconds <= 0 表示不設期限，回傳 None）"""
+    return Deadline(seconds) if seconds and seconds > 0 else None
+
+
+def current() -> Optional[Deadline]:
+    """目前 context 的期限"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def use(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    """在 with 區塊內套用期限（None 表示不設期限）"""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def clear() -> None:
+    """移除目前 context 的期限（用於從該輪複製 context 的背景 task）"""
+    _current.set(None)
+
+
+def remaining() -> Optional[float]:
+    """剩餘秒數，未設期限時回傳 None"""
+    deadline = _current.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def timeout(default: Optional[float]) -> Optional[float]:
+    """單次呼叫的逾時：不超過剩餘時間"""
+    left = remaining()
+    if left is None:
+        return default
+    return left if default is None else min(default, left)
+
+
+def exceeded(stage: str = "") -> DeadlineExceeded:
+    """記錄一次逾期並回傳對應的例外（由呼叫端 raise）"""
+    metrics.inc("turn_deadline_exceeded", stage=stage or "unknown")
+    return DeadlineExceeded(stage)
+
+
+def check(stage: str = "") -> None:
+    """
+    檢查期限是否已過
+
+    Raises:
+        DeadlineExceeded: 期限已過
+    """
+    deadline = _current.get()
+    if deadline is not None and deadline.expired():
+        raise exceeded(stage)
+
+
+async def wait(awaitable: Awaitable[T], stage: str = "") -> T:
+    """
+    在剩餘時間內等待 awaitable，期限到時取消並拋出 DeadlineExceeded
+    """
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(left, 0.0))
+    except asyncio.TimeoutError:
+        raise exceeded(stage) from None
+
+
+def iterate(iterator: Iterator[T], deadline: Optional[Deadline]) -> Iterator[T]:
+    """逐步執行同步 generator，每一步都套用期限（不論呼叫端在哪個 thread 取下一個值）"""
+    try:
+        while True:
+            with use(deadline):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            with use(deadline):
+                close()
+
+
+async def aiterate(iterator: AsyncIterator[T], deadline: Optional[Deadline]) -> AsyncIterator[T]:
+    """iterate 的非同步版本"""
+    try:
+        while True:
+            with use(deadline):
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            with use(deadline):
+                await aclose()
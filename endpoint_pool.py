@@ -0,0 +1,211 @@
+"""
+ProjectFlow LLM 端點池模組
+
+在多個 OpenAI 相容端點（例如多台 vLLM）之間分配請求：
+- 加權最少進行中請求 (weighted least-outstanding-requests) 選擇端點
+- 被動健康評分：以錯誤率與延遲的指數移動平均 (EWMA) 調整選擇分數，
+  錯誤率隨時間衰減，偶發錯誤的端點在流量少時也能逐漸恢復
+- 自動剔除：連續失敗、錯誤率過高或延遲明顯落後其他端點時暫時移出
+- 自動恢復：剔除期滿後重新加入，重複剔除時剔除時間加倍
+"""
+
+import logging
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    """單一端點的負載與健康狀態"""
+
+    def __init__(self, url: str, weight: float = 1.0):
+        self.url = url
+        self.weight = max(weight, 0.01)
+        self.outstanding = 0
+        self.requests = 0
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.updated = time.monotonic()
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def to_dict(self, now: float) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "latency_ewma": round(self.latency_ewma, 4) if self.latency_ewma is not None else None,
+            "error_ewma": round(self.error_ewma, 4),
+            "ejected": self.is_ejected(now),
+            "ejections": self.ejections,
+        }
+
+
+class EndpointPool:
+    """加權最少進行中請求 + 被動健康檢查的端點池"""
+
+    def __init__(
+        self,
+        endpoints: List[Tuple[str, float]],
+        ewma_alpha: float = 0.2,
+        eject_error_rate: float = 0.5,
+        eject_consecutive_failures: int = 3,
+        eject_latency_factor: float = 3.0,
+        min_requests: int = 5,
+        eject_seconds: float = 30.0,
+        max_eject_seconds: float = 300.0,
+        error_half_life: float = 30.0,
+    ):
+        """
+        初始化端點池
+
+        Args:
+            endpoints: (url, weight) 列表
+            ewma_alpha: EWMA 平滑係數，越大越重視近期結果
+            eject_error_rate: 錯誤率 EWMA 達此值時剔除
+            eject_consecutive_failures: 連續失敗達此次數時剔除
+            eject_latency_factor: 延遲 EWMA 超過其他端點中位數的倍數時剔除
+            min_requests: 以錯誤率/延遲判斷剔除前所需的最少請求數
+            eject_seconds: 首次剔除秒數，之後每次加倍
+            max_eject_seconds: 剔除秒數上限
+            error_half_life: 錯誤率 EWMA 在沒有新結果時減半所需的秒數
+        """
+        if not endpoints:
+            raise ValueError("EndpointPool 至少需要一個端點")
+        self.endpoints = [Endpoint(url, weight) for url, weight in endpoints]
+        self.ewma_alpha = ewma_alpha
+        self.eject_error_rate = eject_error_rate
+        self.eject_consecutive_failures = eject_consecutive_failures
+        self.eject_latency_factor = eject_latency_factor
+        self.min_requests = min_requests
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.error_half_life = error_half_life
+        self._lock = threading.Lock()
+
+    def _reference_latency(self, candidates: List[Endpoint]) -> Optional[float]:
+        latencies = [e.latency_ewma for e in candidates if e.latency_ewma is not None]
+        return statistics.median(latencies) if latencies else None
+
+    def _decay(self, endpoint: Endpoint, now: float) -> None:
+        """錯誤率隨時間衰減"""
+        if self.error_half_life > 0 and endpoint.error_ewma:
+            endpoint.error_ewma *= 0.5 ** ((now - endpoint.updated) / self.error_half_life)
+        endpoint.updated = now
+
+    def _score(self, endpoint: Endpoint, reference_latency: Optional[float]) -> float:
+        """分數越低越優先：進行中請求數 / 權重，再依延遲與錯誤率加權"""
+        score = (endpoint.outstanding + 1) / endpoint.weight
+        if reference_latency and endpoint.latency_ewma:
+            score *= max(1.0, endpoint.latency_ewma / reference_latency)
+        return score * (1 + 4 * endpoint.error_ewma)
+
+    def acquire(self, exclude: Optional[Endpoint] = None) -> Endpoint:
+        """
+        選擇一個端點並標記為進行中
+
+        Args:
+            exclude: 盡量避開的端點（例如對沖請求時避開原端點）
+
+        Returns:
+            被選中的 Endpoint，使用完畢後必須呼叫 release()
+        """
+        now = time.monotonic()
+        with self._lock:
+            for e in self.endpoints:
+                self._decay(e, now)
+            healthy = [e for e in self.endpoints if not e.is_ejected(now)]
+            if not healthy:
+                # 全部被剔除時，仍選最早恢復的端點，避免完全無法服務
+                healthy = [min(self.endpoints, key=lambda e: e.ejected_until)]
+            candidates = [e for e in healthy if e is not exclude] or healthy
+            reference = self._reference_latency(candidates)
+            endpoint = min(candidates, key=lambda e: self._score(e, reference))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, latency: float, error: bool = False) -> None:
+        """
+        回報請求結果並更新健康狀態
+
+        Args:
+            endpoint: acquire() 取得的端點
+            latency: 請求耗時秒數
+            error: 是否為端點造成的失敗（逾時、連線錯誤、5xx 等）
+        """
+        now = time.monotonic()
+        a = self.ewma_alpha
+        with self._lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+            self._decay(endpoint, now)
+            endpoint.error_ewma = (1 - a) * endpoint.error_ewma + a * (1.0 if error else 0.0)
+            if error:
+                endpoint.consecutive_failures += 1
+                endpoint.consecutive_successes = 0
+            else:
+                endpoint.consecutive_failures = 0
+                endpoint.consecutive_successes += 1
+                if endpoint.latency_ewma is None:
+                    endpoint.latency_ewma = latency
+                else:
+                    endpoint.latency_ewma = (1 - a) * endpoint.latency_ewma + a * latency
+                # 恢復後穩定運作一段時間，重設剔除退避
+                if endpoint.consecutive_successes >= self.min_requests:
+                    endpoint.ejections = 0
+
+            reason = self._eject_reason(endpoint, now)
+            if reason:
+                self._eject(endpoint, now, reason)
+
+    def _eject_reason(self, endpoint: Endpoint, now: float) -> Optional[str]:
+        if endpoint.is_ejected(now):
+            return None
+        if endpoint.consecutive_failures >= self.eject_consecutive_failures:
+            return f"連續失敗 {endpoint.consecutive_failures} 次"
+        if endpoint.requests < self.min_requests:
+            return None
+        if endpoint.error_ewma >= self.eject_error_rate:
+            return f"錯誤率 {endpoint.error_ewma:.2f}"
+        others = [e for e in self.endpoints if e is not endpoint and not e.is_ejected(now)]
+        reference = self._reference_latency(others)
+        if (
+            reference
+            and endpoint.latency_ewma
+            and endpoint.latency_ewma > reference * self.eject_latency_factor
+        ):
+            return f"延遲 {endpoint.latency_ewma:.2f}s 遠高於其他端點 {reference:.2f}s"
+        return None
+
+    def _eject(self, endpoint: Endpoint, now: float, reason: str) -> None:
+        # 至少保留一個可用端點
+        if all(e.is_ejected(now) for e in self.endpoints if e is not endpoint):
+            return
+        duration = min(self.max_eject_seconds, self.eject_seconds * (2 ** endpoint.ejections))
+        endpoint.ejections += 1
+        endpoint.ejected_until = now + duration
+        # 剔除期滿後以乾淨的健康狀態重新加入
+        endpoint.error_ewma = 0.0
+        endpoint.latency_ewma = None
+        endpoint.consecutive_failures = 0
+        endpoint.consecutive_successes = 0
+        endpoint.requests = 0
+        metrics.inc("llm_endpoint_ejections", endpoint=endpoint.url)
+        logger.warning(f"[EndpointPool] 剔除端點 {endpoint.url} {duration:.0f}s：{reason}")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """取得各端點的狀態"""
+        now = time.monotonic()
+        with self._lock:
+            return [e.to_dict(now) for e in self.endpoints]
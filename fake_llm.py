@@ -0,0 +1,297 @@
+"""
+ProjectFlow 假 LLM 模組（LLM_PROVIDER=fake）
+
+不呼叫任何外部服務，依 prompt 辨識呼叫的 agent 並回傳符合格式的輸出，
+供離線壓力測試與延遲測試使用：
+- SummaryG / ScoreG / SummaryScoreG / DecideG：回傳 extract_first_json_list 可解析的 JSON list
+- BuddyG：回傳純文字回覆
+- TeacherAnalysisAgent：回傳 difficulties / suggestions / analysis_summary JSON
+- theme_setter：回傳主題設定 YAML，或原樣回傳待修改的 prompt
+
+開頭的 SystemMessage 曾出現過時，usage 會回報 cache_read 以模擬提供者的前綴快取。
+
+同一個 prompt 永遠得到相同內容；延遲與錯誤依 FAKE_LLM_SEED 產生可重現的序列。
+呼叫時帶入 timeout（秒）且抽到的延遲超過時，等待 timeout 秒後拋出 FakeLLMTimeout。
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from utils import LLMError
+
+# 組成假內容用的詞彙
+_WORDS = [
+    "永續", "社區", "觀察", "問題", "探索", "資料", "行動", "環境", "訪談", "紀錄",
+    "同學", "校園", "能源", "垃圾", "減量", "水資源", "空氣", "交通", "分析", "反思",
+]
+
+
+class FakeLLMError(LLMError):
+    """假 LLM 依設定的錯誤率產生的錯誤（模擬提供者 503）"""
+
+    status_code = 503
+
+
+class FakeLLMTimeout(LLMError):
+    """延遲超過單次請求逾時（模擬 HTTP 讀取逾時）"""
+
+
+def _filler(rng: random.Random, length: int) -> str:
+    """產生約 length 個字的假內容"""
+    parts: List[str] = []
+    size = 0
+    while size < length:
+        word = rng.choice(_WORDS)
+        parts.append(word)
+        size += len(word)
+        if rng.random() < 0.15:
+            parts.append("，")
+    return "".join(parts) + "。"
+
+
+def _original_prompt(prompt: str) -> Optional[str]:
+    """取出 theme_setter 修改 prompt 請求中的原始 prompt"""
+    match = re.search(r"原始的 Agent Prompt：\n([\s\S]*?)\n\n請根據課程主題設定", prompt)
+    return match.group(1) if match else None
+
+
+def fake_output(prompt: str, length: int, rng: random.Random) -> str:
+    """
+    依 prompt 中的 agent 標記產生符合格式的輸出
+
+    Args:
+        prompt: 渲染後的完整 prompt
+        length: 主要文字欄位的目標長度（字數）
+        rng: 以 prompt 為種子的亂數產生器
+
+    Returns:
+        模型輸出文字
+    """
+    if "SummaryScoreG" in prompt:
+        return json.dumps([{
+            "project_content": _filler(rng, length),
+            "ACTION_PLAN": _filler(rng, length // 2),
+            "HISTORICAL_LOG": _filler(rng, length // 2),
+            "stage_number": 1,
+            "current_progress": _filler(rng, length),
+        }], ensure_ascii=False)
+    if "SummaryG" in prompt:
+        return json.dumps([{
+            "project_content": _filler(rng, length),
+            "ACTION_PLAN": _filler(rng, length // 2),
+            "HISTORICAL_LOG": _filler(rng, length // 2),
+            "stage_number": 1,
+        }], ensure_ascii=False)
+    if "ScoreG" in prompt:
+        return json.dumps([{"current_progress": _filler(rng, length)}], ensure_ascii=False)
+    if "DecideG" in prompt:
+        return json.dumps([{"Guidance_and_Strategy": _filler(rng, length // 2)}], ensure_ascii=False)
+    if "analysis_summary" in prompt:
+        return json.dumps({
+            "difficulties": [_filler(rng, length // 4) for _ in range(2)],
+            "suggestions": [_filler(rng, length // 4) for _ in range(2)],
+            "analysis_summary": _filler(rng, length),
+        }, ensure_ascii=False)
+    original = _original_prompt(prompt)
+    if original is not None:
+        return original
+    if "course_name" in prompt:
+        return "\n".join([
+            f'course_name: "{_filler(rng, 6)}"',
+            f'course_description: "{_filler(rng, 20)}"',
+            f'project_theme: "{_filler(rng, 10)}"',
+            "project_goals:",
+            *[f'  - "{_filler(rng, 12)}"' for _ in range(3)],
+            f'project_scope: "{_filler(rng, 20)}"',
+            "exploration_directions:",
+            *[f'  - "{_filler(rng, 12)}"' for _ in range(3)],
+            "evaluation_points:",
+            *[f'  - "{_filler(rng, 12)}"' for _ in range(3)],
+            "related_sdgs:",
+            '  - "SDG 11: 永續城市與社區"',
+        ])
+    # BuddyG 及其他：純文字回覆
+    return _filler(rng, length)
+
+
+class FakeChatModel(BaseChatModel):
+    """可設定延遲、輸出長度與錯誤率的假 chat model"""
+
+    model_name: str = "fake"
+    temperature: float = 0
+    # 延遲分布：fixed、uniform（0 ~ 2 倍平均）、exponential、lognormal
+    latency_ms: float = 0.0
+    latency_distribution: str = "fixed"
+    latency_sigma: float = 0.5
+    # 主要文字欄位的平均長度（字數），實際長度在 ±jitter 比例內變動
+    output_length: int = 120
+    output_jitter: float = 0.3
+    error_rate: float = 0.0
+    # 串流時每個 chunk 的字數
+    chunk_size: int = 4
+    seed: int = 42
+
+    _rng: random.Random = PrivateAttr()
+    _rng_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    # 已見過的 SystemMessage 前綴，模擬提供者的前綴快取
+    _prefixes: set = PrivateAttr(default_factory=set)
+
+    def model_post_init(self, __context: Any) -> None:
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _sample(self) -> tuple:
+        """依序抽出本次呼叫的 (延遲秒數, 是否失敗)"""
+        with self._rng_lock:
+            mean = self.latency_ms / 1000.0
+            if mean <= 0:
+                latency = 0.0
+            elif self.latency_distribution == "uniform":
+                latency = self._rng.uniform(0, 2 * mean)
+            elif self.latency_distribution == "exponential":
+                latency = self._rng.expovariate(1 / mean)
+            elif self.latency_distribution == "lognormal":
+                # 調整 mu 讓平均值等於 latency_ms
+                mu = math.log(mean) - self.latency_sigma ** 2 / 2
+                latency = self._rng.lognormvariate(mu, self.latency_sigma)
+            else:
+                latency = mean
+            failed = self._rng.random() < self.error_rate
+        return latency, failed
+
+    @staticmethod
+    def _wait_time(latency: float, timeout: Optional[float]) -> float:
+        """實際等待的秒數（超過 timeout 時只等到逾時為止）"""
+        return latency if timeout is None else min(latency, timeout)
+
+    @staticmethod
+    def _check(latency: float, timeout: Optional[float], failed: bool) -> None:
+        if timeout is not None and latency > timeout:
+            raise FakeLLMTimeout(f"假 LLM 模擬請求逾時 ({timeout:.2f}s)")
+        if failed:
+            raise FakeLLMError("假 LLM 模擬提供者錯誤 (503)")
+
+    def _content(self, messages: List[BaseMessage]) -> str:
+        prompt = "\n".join(str(m.content) for m in messages)
+        digest = hashlib.sha256(f"{self.seed}:{prompt}".encode("utf-8")).hexdigest()
+        rng = random.Random(digest)
+        jitter = self.output_jitter
+        length = max(1, int(self.output_length * rng.uniform(1 - jitter, 1 + jitter)))
+        return fake_output(prompt, length, rng)
+
+    def _usage(self, messages: List[BaseMessage], content: str) -> dict:
+        input_tokens = sum(len(str(m.content)) for m in messages)
+        cached = 0
+        if messages and isinstance(messages[0], SystemMessage):
+            prefix = str(messages[0].content)
+            with self._rng_lock:
+                if prefix in self._prefixes:
+                    cached = len(prefix)
+                self._prefixes.add(prefix)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": len(content),
+            "total_tokens": input_tokens + len(content),
+            "input_token_details": {"cache_read": cached},
+        }
+
+    def _limit(self, content: str, max_tokens: Optional[int]) -> tuple:
+        """依 max_tokens（以字數計）截斷輸出，回傳 (內容, finish_reason)"""
+        if max_tokens and len(content) > max_tokens:
+            return content[:max_tokens], "length"
+        return content, "stop"
+
+    def _chunks(self, content: str) -> List[str]:
+        size = max(1, self.chunk_size)
+        return [content[i:i + size] for i in range(0, len(content), size)]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        latency, failed = self._sample()
+        time.sleep(self._wait_time(latency, kwargs.get("timeout")))
+        self._check(latency, kwargs.get("timeout"), failed)
+        content, reason = self._limit(self._content(messages), kwargs.get("max_tokens"))
+        message = AIMessage(
+            content=content,
+            usage_metadata=self._usage(messages, content),
+            response_metadata={"finish_reason": reason},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        latency, failed = self._sample()
+        await asyncio.sleep(self._wait_time(latency, kwargs.get("timeout")))
+        self._check(latency, kwargs.get("timeout"), failed)
+        content, reason = self._limit(self._content(messages), kwargs.get("max_tokens"))
+        message = AIMessage(
+            content=content,
+            usage_metadata=self._usage(messages, content),
+            response_metadata={"finish_reason": reason},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # 延遲視為第一個 chunk 前的等待時間
+        latency, failed = self._sample()
+        time.sleep(self._wait_time(latency, kwargs.get("timeout")))
+        self._check(latency, kwargs.get("timeout"), failed)
+        content, reason = self._limit(self._content(messages), kwargs.get("max_tokens"))
+        for piece in self._chunks(content):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            usage_metadata=self._usage(messages, content),
+            response_metadata={"finish_reason": reason},
+        ))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        latency, failed = self._sample()
+        await asyncio.sleep(self._wait_time(latency, kwargs.get("timeout")))
+        self._check(latency, kwargs.get("timeout"), failed)
+        content, reason = self._limit(self._content(messages), kwargs.get("max_tokens"))
+        for piece in self._chunks(content):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            usage_metadata=self._usage(messages, content),
+            response_metadata={"finish_reason": reason},
+        ))
@@ -0,0 +1,336 @@
+"""
+ProjectFlow LLM 對沖請求 (hedged requests) 模組
+
+針對延遲長尾：若第一個請求在「近期延遲的指定百分位數」內仍沒有產出，
+再送出一個相同的請求，採用先完成者，並取消較慢的一方。
+
+- 一般呼叫以完成時間判斷，串流呼叫以第一個 chunk 的時間判斷
+- 樣本數不足時不對沖，避免在冷啟動時加倍流量
+- 記錄對沖率、對沖勝出次數與額外消耗的 token，供調整百分位數使用
+
+同步呼叫無法中斷已送出的 HTTP 請求，較慢的一方會在背景完成後丟棄；
+同步串流會在下一個 chunk 到達時關閉；非同步版本則直接取消。
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, List, Optional
+
+import metrics
+from config import HedgeConfig
+from utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# 完成時間 / 第一個 chunk 時間的指標名稱
+LATENCY_METRIC = "llm_latency_seconds"
+FIRST_CHUNK_METRIC = "llm_first_chunk_seconds"
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=HedgeConfig.MAX_WORKERS, thread_name_prefix="llm-hedge"
+            )
+        return _executor
+
+
+def hedge_delay(agent: str, metric: str = LATENCY_METRIC) -> Optional[float]:
+    """
+    取得對沖等待秒數
+
+    Args:
+        agent: agent 名稱
+        metric: 依據的延遲指標（LATENCY_METRIC 或 FIRST_CHUNK_METRIC）
+
+    Returns:
+        等待秒數；未啟用或樣本不足時回傳 None（不對沖）
+    """
+    if not HedgeConfig.enabled_for(agent):
+        return None
+    if metrics.sample_count(metric, agent=agent) < HedgeConfig.MIN_SAMPLES:
+        return None
+    delay = metrics.percentile(metric, HedgeConfig.PERCENTILE, agent=agent)
+    if delay is None:
+        return None
+    return max(delay, HedgeConfig.MIN_DELAY)
+
+
+def _record_call(agent: str, hedged: bool) -> None:
+    metrics.inc("llm_hedge_calls", agent=agent)
+    if hedged:
+        metrics.inc("llm_hedges", agent=agent)
+        logger.info(f"[hedging] {agent} 超過對沖門檻，送出第二個請求")
+    calls = metrics.get_counter("llm_hedge_calls", agent=agent)
+    metrics.set_gauge("llm_hedge_rate", metrics.get_counter("llm_hedges", agent=agent) / calls, agent=agent)
+
+
+def _record_winner(agent: str, index: int) -> None:
+    if index:
+        metrics.inc("llm_hedge_wins", agent=agent)
+
+
+def _response_tokens(response: Any, input_tokens: int) -> int:
+    """估算一次完整回應消耗的 token（優先使用提供者回報的用量）"""
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("total_tokens"):
+        return usage["total_tokens"]
+    content = getattr(response, "content", "")
+    return input_tokens + (count_tokens(content) if isinstance(content, str) else 0)
+
+
+def _record_extra_tokens(agent: str, tokens: int) -> None:
+    metrics.inc("llm_hedge_extra_tokens", tokens, agent=agent)
+
+
+# === 一般呼叫 ===
+
+def _timed(agent: str, attempt: Callable[[int], Any], index: int) -> Any:
+    # 只記錄原始請求的延遲，避免較快的對沖結果讓門檻越來越低
+    started = time.monotonic()
+    response = attempt(index)
+    if index == 0:
+        metrics.observe(LATENCY_METRIC, time.monotonic() - started, agent=agent)
+    return response
+
+
+def hedged_call(agent: str, attempt: Callable[[int], Any], delay: float, input_tokens: int = 0) -> Any:
+    """
+    以對沖方式執行同步呼叫
+
+    Args:
+        agent: agent 名稱
+        attempt: 執行單次請求的函式，參數為第幾個請求（0 為原始請求，1 為對沖請求）
+        delay: 等待多久沒有結果後送出對沖請求
+        input_tokens: 輸入 token 數（估算額外消耗用）
+
+    Returns:
+        先成功完成的回應；兩者都失敗時拋出原始請求的例外
+    """
+    executor = _get_executor()
+    futures: List[Future] = [executor.submit(_timed, agent, attempt, 0)]
+    done, _ = wait(futures, timeout=delay)
+    _record_call(agent, hedged=not done)
+    if not done:
+        futures.append(executor.submit(_timed, agent, attempt, 1))
+
+    pending = set(futures)
+    errors: List[BaseException] = []
+    winner: Optional[Future] = None
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                winner = future
+                break
+            errors.append(future.exception())
+
+    for future in futures:
+        if future is winner or future.done():
+            if future is not winner and future.exception() is None:
+                _record_extra_tokens(agent, _response_tokens(future.result(), input_tokens))
+            continue
+        # 較慢的一方無法中斷，完成後只記錄浪費的 token
+        future.add_done_callback(
+            lambda f: _record_extra_tokens(
+                agent, _response_tokens(f.result(), input_tokens) if f.exception() is None else input_tokens
+            )
+        )
+
+    if winner is None:
+        raise errors[0]
+    _record_winner(agent, futures.index(winner))
+    return winner.result()
+
+
+async def _atimed(agent: str, attempt: Callable[[int], Awaitable[Any]], index: int) -> Any:
+    started = time.monotonic()
+    response = await attempt(index)
+    if index == 0:
+        metrics.observe(LATENCY_METRIC, time.monotonic() - started, agent=agent)
+    return response
+
+
+async def ahedged_call(
+    agent: str, attempt: Callable[[int], Awaitable[Any]], delay: float, input_tokens: int = 0
+) -> Any:
+    """hedged_call 的非同步版本，較慢的一方會被取消"""
+    tasks = [asyncio.ensure_future(_atimed(agent, attempt, 0))]
+    started = time.monotonic()
+    winner: Optional[asyncio.Task] = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        _record_call(agent, hedged=not done)
+        if not done:
+            tasks.append(asyncio.ensure_future(_atimed(agent, attempt, 1)))
+
+        pending = set(tasks)
+        errors: List[BaseException] = []
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    break
+                errors.append(task.exception())
+        if winner is None:
+            raise errors[0]
+        _record_winner(agent, tasks.index(winner))
+        return winner.result()
+    finally:
+        for task in tasks:
+            if task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+                _record_extra_tokens(agent, input_tokens)
+                if task is tasks[0]:
+                    # 被取消的原始請求至少花了這麼久，仍計入延遲分布
+                    metrics.observe(LATENCY_METRIC, time.monotonic() - started, agent=agent)
+            elif not task.cancelled() and task.exception() is None:
+                _record_extra_tokens(agent, _response_tokens(task.result(), input_tokens))
+
+
+# === 串流呼叫 ===
+
+def hedged_stream(
+    agent: str, attempt: Callable[[int], Iterator[Any]], delay: float, input_tokens: int = 0
+) -> Iterator[Any]:
+    """
+    以對沖方式執行同步串流，以第一個 chunk 決定勝出者
+
+    每個請求在獨立的 thread 中讀取串流並放入共用佇列；
+    勝出者決定後，其他請求在下一個 chunk 到達時停止並關閉串流。
+
+    Args:
+        同 hedged_call，attempt 回傳 chunk 的 iterator
+    """
+    items: "queue.Queue" = queue.Queue()
+    stops: List[threading.Event] = []
+    started = time.monotonic()
+
+    def pump(index: int) -> None:
+        stop = threading.Event()
+        stops.append(stop)
+
+        def run():
+            try:
+                chunks = attempt(index)
+                try:
+                    for chunk in chunks:
+                        if stop.is_set():
+                            break
+                        items.put((index, "chunk", chunk))
+                finally:
+                    close = getattr(chunks, "close", None)
+                    if close:
+                        close()
+                items.put((index, "end", None))
+            except Exception as e:
+                items.put((index, "error", e))
+
+        threading.Thread(target=run, daemon=True, name=f"llm-hedge-stream-{index}").start()
+
+    pump(0)
+    winner: Optional[int] = None
+    try:
+        try:
+            first = items.get(timeout=delay)
+            _record_call(agent, hedged=False)
+        except queue.Empty:
+            _record_call(agent, hedged=True)
+            pump(1)
+            first = items.get()
+
+        errors: List[BaseException] = []
+        finished = 0
+        while True:
+            index, kind, payload = first
+            if kind == "error":
+                errors.append(payload)
+                finished += 1
+                if finished == len(stops):
+                    raise errors[0]
+                first = items.get()
+                continue
+            winner = index
+            break
+
+        # 以原始請求開始計時；對沖勝出時即為原始請求延遲的下限
+        metrics.observe(FIRST_CHUNK_METRIC, time.monotonic() - started, agent=agent)
+        _record_winner(agent, winner)
+        for index, stop in enumerate(stops):
+            if index != winner:
+                stop.set()
+                _record_extra_tokens(agent, input_tokens)
+
+        index, kind, payload = first
+        while True:
+            if index == winner:
+                if kind == "chunk":
+                    yield payload
+                elif kind == "end":
+                    return
+                else:
+                    raise payload
+            index, kind, payload = items.get()
+    finally:
+        for stop in stops:
+            stop.set()
+
+
+async def ahedged_stream(
+    agent: str, attempt: Callable[[int], AsyncIterator[Any]], delay: float, input_tokens: int = 0
+) -> AsyncIterator[Any]:
+    """hedged_stream 的非同步版本，較慢的串流會被直接取消並關閉"""
+    streams = [attempt(0)]
+    nexts = {asyncio.ensure_future(streams[0].__anext__()): 0}
+    started = time.monotonic()
+    winner: Optional[int] = None
+    first: Any = None
+    try:
+        done, _ = await asyncio.wait(nexts, timeout=delay)
+        _record_call(agent, hedged=not done)
+        if not done:
+            streams.append(attempt(1))
+            nexts[asyncio.ensure_future(streams[1].__anext__())] = 1
+
+        errors: List[BaseException] = []
+        while nexts and winner is None:
+            done, _ = await asyncio.wait(nexts, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = nexts.pop(task)
+                error = task.exception()
+                if error is None or isinstance(error, StopAsyncIteration):
+                    winner = index
+                    first = task.result() if error is None else None
+                    break
+                errors.append(error)
+        if winner is None:
+            raise errors[0]
+
+        metrics.observe(FIRST_CHUNK_METRIC, time.monotonic() - started, agent=agent)
+        _record_winner(agent, winner)
+    finally:
+        for task, index in nexts.items():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await streams[index].aclose()
+            _record_extra_tokens(agent, input_tokens)
+
+    try:
+        if first is not None:
+            yield first
+            async for chunk in streams[winner]:
+                yield chunk
+    finally:
+        await streams[winner].aclose()
@@ -0,0 +1,195 @@
+"""
+ProjectFlow LLM 回應快取模組
+
+兩層快取：
+- 第一層：記憶體 LRU（process 內，最快）
+- 第二層：SQLite 磁碟儲存（跨 process / 重啟仍有效）
+
+快取鍵由提供者、模型、溫度與渲染後 prompt 的雜湊組成，
+支援 TTL 過期與依筆數上限淘汰最久未使用的項目。
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """記憶體 LRU + SQLite 的兩層 LLM 回應快取"""
+
+    def __init__(
+        self,
+        path: Optional[Union[str, Path]] = None,
+        max_memory_entries: int = 512,
+        max_disk_entries: int = 10000,
+        ttl_seconds: float = 86400,
+    ):
+        """
+        初始化快取
+
+        Args:
+            path: SQLite 檔案路徑，None 表示只使用記憶體
+            max_memory_entries: 記憶體 LRU 最大筆數
+            max_disk_entries: 磁碟最大筆數，超過時淘汰最久未使用的項目
+            ttl_seconds: 項目存活秒數，<= 0 表示不過期
+        """
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+        if path:
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(path), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(provider: str, model: Optional[str], temperature: Any, prompt: str) -> str:
+        """
+        產生快取鍵
+
+        Args:
+            provider: 提供者類型
+            model: 模型或部署名稱
+            temperature: 取樣溫度
+            prompt: 渲染後的完整 prompt
+
+        Returns:
+            SHA-256 十六進位字串
+        """
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        raw = json.dumps([provider, model, temperature, prompt_hash], ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        取得快取值，依序查詢記憶體與磁碟
+
+        Returns:
+            快取的回應內容，不存在或已過期時回傳 None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits["memory"] += 1
+                    return value
+                del self._memory[key]
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if not self._expired(created_at, now):
+                        self._conn.execute(
+                            "UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key)
+                        )
+                        self._conn.commit()
+                        self._remember(key, value, created_at)
+                        self.hits["disk"] += 1
+                        return value
+                    self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        """寫入快取（同時寫入記憶體與磁碟）"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                self._evict_disk(now)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"[LLMCache] 寫入磁碟快取失敗: {e}")
+
+    def _evict_disk(self, now: float) -> None:
+        """移除過期項目，並在超過筆數上限時淘汰最久未使用的項目"""
+        if self.ttl_seconds > 0:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,)
+            )
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        overflow = count - self.max_disk_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY accessed_at ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def clear(self) -> None:
+        """清除所有快取"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM llm_cache")
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """取得快取統計"""
+        with self._lock:
+            disk_entries = 0
+            if self._conn is not None:
+                (disk_entries,) = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            total_hits = self.hits["memory"] + self.hits["disk"]
+            lookups = total_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "hit_rate": round(total_hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        """關閉磁碟連線"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,1095 @@
+"""
+ProjectFlow LLM 客戶端模組
+
+集中建立並共用所有 agent 的 LLM 實例，包括：
+- 共用 HTTP 連線池（keep-alive、最大連線數、HTTP/2、逾時）
+- 依 LLM_PROVIDER 建立 ChatOpenAI / AzureChatOpenAI / ChatVertexAI（或離線測試用的 FakeChatModel）
+- 以相同參數取得時重用同一個實例
+- 設定多個 OpenAI 相容端點時，依負載與健康狀態分流（見 endpoint_pool）
+- 慢請求的對沖 (hedged requests)（見 hedging）
+- 提供者故障時立即失敗的斷路器（見 circuit_breaker）
+- 暫時性錯誤的指數退避重試（見 retry）
+- 相同 prompt 的進行中請求合併為一次呼叫（見 singleflight）
+- 提供者原生的 JSON schema 結構化輸出（LLM_STRUCTURED_OUTPUT）
+- 各 agent 的輸出 token 上限與截斷偵測（response_agent 依負載縮減）
+- 每輪對話期限：逾時、速率限制排隊與對沖只使用剩餘時間，期限到時取消呼叫（見 deadline）
+
+提供者套件（langchain_openai、langchain_google_vertexai）只在第一次建立該提供者的模型時匯入，
+縮短只使用其中一個提供者（或假 LLM）時的啟動時間。
+
+四個 agent、TeacherAnalysisAgent 與 theme_setter 都應透過 get_llm() 取得模型，
+避免每個呼叫點各自建立客戶端、重複 TLS 握手與連線；
+實際呼叫則透過 invoke() / ainvoke()，以套用回應快取、速率限制等共用處理。
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Type
+
+import httpx
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.messages.ai import add_usage
+from langchain_core.runnables import Runnable, RunnableBinding
+from pydantic import BaseModel
+
+import circuit_breaker
+import deadline
+import hedging
+import metrics
+import rate_limiter
+import retry
+from config import (
+    CacheConfig, EndpointPoolConfig, FakeLLMConfig, HedgeConfig, LLMConfig, OutputBudgetConfig, RateLimitConfig,
+    RetryConfig,
+)
+from endpoint_pool import Endpoint, EndpointPool
+from fake_llm import FakeChatModel
+from llm_cache import LLMCache
+from singleflight import AsyncSingleFlight, SingleFlight
+from deadline import DeadlineExceeded
+from utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_PROVIDERS = ("azure", "openai", "vertexai", "fake")
+
+_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_async_http_client: Optional[httpx.AsyncClient] = None
+_llm_instances: Dict[Tuple, Any] = {}
+_cache: Optional[LLMCache] = None
+_endpoint_pool: Optional[EndpointPool] = None
+_flights = SingleFlight()
+_aflights = AsyncSingleFlight()
+
+
+# === HTTP 連線池 ===
+
+def _http2_enabled() -> bool:
+    """HTTP/2 需要額外的 h2 套件，未安裝時退回 HTTP/1.1"""
+    if not LLMConfig.HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("LLM_HTTP2 已啟用但未安裝 h2，改用 HTTP/1.1。建議安裝: pip install httpx[http2]")
+        return False
+    return True
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLMConfig.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=LLMConfig.HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=LLMConfig.HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def _http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(LLMConfig.TIMEOUT, connect=LLMConfig.CONNECT_TIMEOUT)
+
+
+def get_http_client() -> httpx.Client:
+    """取得共用的同步 HTTP 客戶端（整個 process 共用一個連線池）"""
+    global _http_client
+    with _lock:
+        if _http_client is None or _http_client.is_closed:
+            _http_client = httpx.Client(
+                limits=_http_limits(),
+                timeout=_http_timeout(),
+                http2=_http2_enabled(),
+            )
+        return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    取得共用的非同步 HTTP 客戶端
+
+    注意：httpx.AsyncClient 的連線綁定建立它的 event loop，
+    應只在同一個長駐 event loop（例如 FastAPI / uvicorn）中使用。
+    """
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None or _async_http_client.is_closed:
+            _async_http_client = httpx.AsyncClient(
+                limits=_http_limits(),
+                timeout=_http_timeout(),
+                http2=_http2_enabled(),
+            )
+        return _async_http_client
+
+
+def close_http_clients() -> None:
+    """關閉共用的同步 HTTP 客戶端（非同步客戶端由其 event loop 負責關閉）"""
+    global _http_client
+    with _lock:
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+
+
+# === LLM 建立 ===
+
+# 提供者的 chat model 類別（模組, 類別名稱），用於判斷實例所屬的提供者
+_OPENAI_CLASS = ("langchain_openai.chat_models.base", "BaseChatOpenAI")
+_VERTEX_CLASS = ("langchain_google_vertexai.chat_models", "ChatVertexAI")
+
+
+def _is_instance(llm, provider_class: Tuple[str, str]) -> bool:
+    """
+    判斷 llm 是否為指定提供者的模型
+
+    提供者套件尚未匯入時不可能已有其實例，直接回傳 False，不會因此匯入套件。
+    """
+    module = sys.modules.get(provider_class[0])
+    cls = getattr(module, provider_class[1], None) if module is not None else None
+    return cls is not None and isinstance(llm, cls)
+
+
+def _openai_endpoint(endpoint: str) -> str:
+    """確保 OpenAI 相容 API 的 endpoint 有 /v1 路徑"""
+    if not endpoint.endswith("/v1"):
+        endpoint = endpoint.rstrip("/") + "/v1"
+    return endpoint
+
+
+def create_llm(
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+    temperature: float = 0,
+    endpoint: Optional[str] = None,
+):
+    """
+    建立新的 LLM 實例（共用 HTTP 連線池）
+
+    Args:
+        provider: azure、openai、vertexai 或 fake，預設為 LLMConfig.PROVIDER
+        model: 模型或部署名稱，預設依提供者取 DEPLOYMENT / VERTEX_MODEL
+        temperature: 取樣溫度
+        endpoint: API endpoint，預設為 AZURE_OPENAI_ENDPOINT
+
+    Returns:
+        LangChain chat model 實例
+
+    Raises:
+        ValueError: 提供者不支援或缺少必要設定
+    """
+    provider = (provider or LLMConfig.PROVIDER).lower()
+    endpoint = endpoint or LLMConfig.AZURE_ENDPOINT
+
+    if provider == "azure":
+        # Azure OpenAI 官方服務
+        logger.info(f"使用 Azure OpenAI 官方服務: {endpoint}")
+        if not endpoint or not LLMConfig.AZURE_API_KEY:
+            raise ValueError("使用 Azure OpenAI 需要設定 AZURE_OPENAI_ENDPOINT 和 AZURE_OPENAI_API_KEY")
+        from langchain_openai import AzureChatOpenAI
+
+        return AzureChatOpenAI(
+            azure_deployment=model or LLMConfig.DEPLOYMENT,
+            azure_endpoint=endpoint,
+            api_key=LLMConfig.AZURE_API_KEY,
+            api_version=LLMConfig.AZURE_API_VERSION,
+            temperature=temperature,
+            timeout=LLMConfig.TIMEOUT,
+            max_retries=RetryConfig.client_max_retries(),
+            # 串流時也回傳 usage（含前綴快取命中的 cached_tokens）
+            stream_usage=True,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
+        )
+
+    if provider == "openai":
+        # 本地 OpenAI 相容 API (ngrok, vLLM, Ollama, etc.)
+        logger.info(f"使用 OpenAI 相容 API: {endpoint}")
+        if not endpoint or not LLMConfig.AZURE_API_KEY:
+            raise ValueError("使用 OpenAI API 需要設定 AZURE_OPENAI_ENDPOINT 和 AZURE_OPENAI_API_KEY")
+        from langchain_openai import ChatOpenAI
+
+        return ChatOpenAI(
+            model=model or LLMConfig.DEPLOYMENT,
+            base_url=_openai_endpoint(endpoint),
+            api_key=LLMConfig.AZURE_API_KEY,
+            temperature=temperature,
+            timeout=LLMConfig.TIMEOUT,
+            max_retries=RetryConfig.client_max_retries(),
+            # 串流時也回傳 usage（含前綴快取命中的 cached_tokens）
+            stream_usage=True,
+            http_client=get_http_client(),
+            http_async_client=get_async_http_client(),
+        )
+
+    if provider == "vertexai":
+        # Google Vertex AI（使用 Google 自己的傳輸層，不經過 httpx 連線池）
+        vertex_model = model or LLMConfig.VERTEX_MODEL
+        logger.info(f"使用 Google Vertex AI: {vertex_model}")
+        from langchain_google_vertexai import ChatVertexAI
+
+        return ChatVertexAI(
+            model_name=vertex_model,
+            temperature=temperature,
+            timeout=LLMConfig.TIMEOUT,
+            max_retries=RetryConfig.client_max_retries(),
+        )
+
+    if provider == "fake":
+        # 離線測試用的假 LLM，不呼叫任何外部服務
+        logger.info(f"使用假 LLM: 延遲 {FakeLLMConfig.LATENCY_MS}ms ({FakeLLMConfig.LATENCY_DISTRIBUTION})")
+        return FakeChatModel(
+            model_name=model or "fake",
+            temperature=temperature,
+            latency_ms=FakeLLMConfig.LATENCY_MS,
+            latency_distribution=FakeLLMConfig.LATENCY_DISTRIBUTION,
+            latency_sigma=FakeLLMConfig.LATENCY_SIGMA,
+            output_length=FakeLLMConfig.OUTPUT_LENGTH,
+            output_jitter=FakeLLMConfig.OUTPUT_JITTER,
+            error_rate=FakeLLMConfig.ERROR_RATE,
+            chunk_size=FakeLLMConfig.CHUNK_SIZE,
+            seed=FakeLLMConfig.SEED,
+        )
+
+    raise ValueError(f"不支援的 LLM_PROVIDER: {provider}，請使用 azure、openai、vertexai 或 fake")
+
+
+def get_llm(
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+    temperature: float = 0,
+    endpoint: Optional[str] = None,
+):
+    """
+    取得共用的 LLM 實例，相同參數只會建立一次
+
+    Args:
+        同 create_llm
+
+    Returns:
+        LangChain chat model 實例
+    """
+    key = (
+        (provider or LLMConfig.PROVIDER).lower(),
+        model,
+        temperature,
+        endpoint or LLMConfig.AZURE_ENDPOINT,
+    )
+    instance = _llm_instances.get(key)
+    if instance is None:
+        instance = create_llm(provider, model, temperature, endpoint)
+        with _lock:
+            instance = _llm_instances.setdefault(key, instance)
+    return instance
+
+
+def get_agent_llm(agent: str):
+    """
+    取得指定 agent 的 LLM 實例
+
+    依 LLMConfig.AGENT_MODELS（例如 SUMMARY_MODEL、SCORE_PROVIDER）決定提供者與模型，
+    未設定時使用預設實例；設定相同的 agent 共用同一個實例。
+
+    Args:
+        agent: agent 名稱，例如 "summary_agent"
+
+    Returns:
+        LangChain chat model 實例
+    """
+    provider, model = LLMConfig.agent_model(agent)
+    return get_llm(provider=provider, model=model)
+
+
+# === 結構化輸出 ===
+
+def structured_llm(llm, schema: Type[BaseModel]):
+    """
+    取得綁定 JSON schema 的 LLM（提供者端強制輸出符合 schema 的 JSON）
+
+    使用 with_structured_output 產生的模型綁定（OpenAI/Azure 為 json_schema，
+    Vertex AI 為 response_schema），但不套用其輸出解析器，
+    讓呼叫仍回傳 AIMessage 以沿用快取、請求合併與 usage 統計；內容由呼叫端以 schema 驗證。
+
+    Args:
+        llm: LangChain chat model 實例
+        schema: Pydantic 輸出 schema
+
+    Returns:
+        綁定 schema 的 Runnable，提供者不支援時回傳 None
+    """
+    if _is_instance(llm, _OPENAI_CLASS):
+        method = "json_schema"
+    elif _is_instance(llm, _VERTEX_CLASS):
+        method = "json_mode"
+    else:
+        return None
+    return llm.with_structured_output(schema, method=method).first
+
+
+def _with_schema(llm, schema: Optional[Type[BaseModel]]):
+    """LLM_STRUCTURED_OUTPUT 啟用且提供者支援時綁定 schema，否則回傳原本的 llm"""
+    if schema is None or not LLMConfig.STRUCTURED_OUTPUT:
+        return llm
+    return structured_llm(llm, schema) or llm
+
+
+# === 輸出長度上限 ===
+
+# 目前進行中的 LLM 呼叫數（所有 agent），作為負載指標
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+# 提供者回報「因達到輸出上限而停止」的 finish_reason
+_TRUNCATED_REASONS = {"length", "max_tokens", "MAX_TOKENS"}
+
+
+def _track_in_flight(delta: int) -> None:
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight += delta
+        current = _in_flight
+    metrics.set_gauge("llm_in_flight", current)
+
+
+def in_flight() -> int:
+    """目前進行中的 LLM 呼叫數"""
+    with _in_flight_lock:
+        return _in_flight
+
+
+def output_budget(agent: str) -> Optional[int]:
+    """
+    取得 agent 本次呼叫的輸出 token 上限
+
+    一般 agent 為固定上限（<PREFIX>_MAX_TOKENS）；LLM_ADAPTIVE_BUDGET_AGENTS 中的 agent
+    在進行中的呼叫數超過 LLM_BUDGET_LOAD_LOW 後線性縮減，達 LLM_BUDGET_LOAD_HIGH 時為最小值，
+    以負載高時較短的回覆換取每輪延遲的上限。
+
+    Returns:
+        token 上限，未設定上限時回傳 None
+    """
+    cap = OutputBudgetConfig.max_tokens(agent)
+    if not cap or agent not in OutputBudgetConfig.ADAPTIVE_AGENTS:
+        return cap
+    low, high = OutputBudgetConfig.LOAD_LOW, OutputBudgetConfig.LOAD_HIGH
+    floor = min(cap, OutputBudgetConfig.MIN_TOKENS)
+    load = in_flight()
+    if load <= low:
+        budget = cap
+    elif load >= high:
+        budget = floor
+    else:
+        budget = int(cap - (cap - floor) * (load - low) / (high - low))
+    metrics.set_gauge("llm_output_budget", budget, agent=agent)
+    return budget
+
+
+def _with_max_tokens(llm, max_tokens: Optional[int]):
+    """綁定輸出 token 上限（Vertex AI 為 max_output_tokens）"""
+    if not max_tokens or not isinstance(llm, Runnable):
+        return llm
+    base = llm.bound if isinstance(llm, RunnableBinding) else llm
+    param = "max_output_tokens" if _is_instance(base, _VERTEX_CLASS) else "max_tokens"
+    return llm.bind(**{param: max_tokens})
+
+
+def _configure(llm, schema: Optional[Type[BaseModel]] = None, max_tokens: Optional[int] = None):
+    """依呼叫選項綁定輸出 schema 與輸出 token 上限"""
+    return _with_max_tokens(_with_schema(llm, schema), max_tokens)
+
+
+def _with_deadline(llm):
+    """
+    依本輪剩餘時間綁定單次請求的逾時（未設期限時回傳原本的 llm）
+
+    只有 OpenAI 相容客戶端與假 LLM 支援單次請求的 timeout；
+    其他提供者沿用建立時的 LLM_TIMEOUT，由呼叫前後的期限檢查把關。
+    """
+    if deadline.remaining() is None or not isinstance(llm, Runnable):
+        return llm
+    base = llm.bound if isinstance(llm, RunnableBinding) else llm
+    if not (isinstance(base, FakeChatModel) or _is_instance(base, _OPENAI_CLASS)):
+        return llm
+    return llm.bind(timeout=max(deadline.timeout(LLMConfig.TIMEOUT), 0.001))
+
+
+def is_truncated(message) -> bool:
+    """回應是否因達到輸出上限而被截斷"""
+    metadata = getattr(message, "response_metadata", None) or {}
+    reason = metadata.get("finish_reason") or metadata.get("stop_reason")
+    return str(reason) in _TRUNCATED_REASONS
+
+
+def _record_truncation(agent: str, max_tokens: Optional[int]) -> None:
+    metrics.inc("llm_truncated", agent=agent)
+    logger.warning(f"[{agent}] 輸出達上限 {max_tokens} tokens 被截斷")
+
+
+# === 回應快取 ===
+
+def get_cache() -> LLMCache:
+    """取得共用的 LLM 回應快取"""
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = LLMCache(
+                path=CacheConfig.DISK_PATH or None,
+                max_memory_entries=CacheConfig.MEMORY_MAX_ENTRIES,
+                max_disk_entries=CacheConfig.DISK_MAX_ENTRIES,
+                ttl_seconds=CacheConfig.TTL_SECONDS,
+            )
+        return _cache
+
+
+def _llm_identity(llm) -> Tuple[str, Optional[str], Any]:
+    """取得 (提供者, 模型, 溫度)，作為快取鍵的一部分"""
+    provider = getattr(llm, "_llm_type", type(llm).__name__)
+    model = (
+        getattr(llm, "deployment_name", None)
+        or getattr(llm, "model_name", None)
+        or getattr(llm, "model", None)
+    )
+    return provider, model, getattr(llm, "temperature", None)
+
+
+def render_messages(messages: List[BaseMessage]) -> str:
+    """將訊息列表渲染成單一字串（用於快取鍵與 token 估算）"""
+    return "\n".join(f"{m.type}: {m.content}" for m in messages)
+
+
+def _request_text(llm, messages: List[BaseMessage]) -> str:
+    """快取鍵與請求合併用的請求內容（綁定 schema 時附上 schema 名稱，與一般輸出分開）"""
+    text = render_messages(messages)
+    if isinstance(llm, RunnableBinding):
+        output_format = llm.kwargs.get("ls_structured_output_format") or {}
+        text += "\nschema: " + json.dumps(output_format.get("schema"), sort_keys=True, ensure_ascii=False, default=str)
+    return text
+
+
+def _cache_key(agent: str, llm, messages: List[BaseMessage]) -> Optional[str]:
+    if not CacheConfig.enabled_for(agent):
+        return None
+    provider, model, temperature = _llm_identity(llm)
+    return LLMCache.make_key(provider, model, temperature, _request_text(llm, messages))
+
+
+def _cache_lookup(agent: str, key: Optional[str]) -> Optional[AIMessage]:
+    if key is None:
+        return None
+    cached = get_cache().get(key)
+    if cached is None:
+        metrics.inc("llm_cache_misses", agent=agent)
+        return None
+    metrics.inc("llm_cache_hits", agent=agent)
+    logger.info(f"[llm_client] {agent} 命中回應快取")
+    return AIMessage(content=cached)
+
+
+def _cache_store(key: Optional[str], response) -> None:
+    if key is not None and isinstance(response.content, str) and response.content:
+        get_cache().set(key, response.content)
+
+
+# === 速率限制 ===
+
+def _limiter_for(llm, messages: List[BaseMessage]) -> Tuple[rate_limiter.RateLimiter, int]:
+    """取得對應的限制器與本次請求預估的 token 數（輸入 + 預留輸出）"""
+    provider, model, _ = _llm_identity(llm)
+    limiter = rate_limiter.get_limiter(provider, model)
+    if not limiter.enabled:
+        return limiter, 0
+    tokens = count_tokens(render_messages(messages)) + RateLimitConfig.OUTPUT_TOKEN_ESTIMATE
+    return limiter, tokens
+
+
+def _acquire(agent: str, llm, messages: List[BaseMessage]) -> None:
+    """取得速率限制額度；排隊時間超過本輪剩餘時間時拋出 DeadlineExceeded"""
+    limiter, tokens = _limiter_for(llm, messages)
+    waited = limiter.acquire(tokens, max_wait=deadline.remaining())
+    if waited is None:
+        raise deadline.exceeded(agent)
+    if waited:
+        metrics.observe("llm_rate_limit_agent_wait_seconds", waited, agent=agent)
+
+
+async def _aacquire(agent: str, llm, messages: List[BaseMessage]) -> None:
+    limiter, tokens = _limiter_for(llm, messages)
+    waited = await limiter.aacquire(tokens, max_wait=deadline.remaining())
+    if waited is None:
+        raise deadline.exceeded(agent)
+    if waited:
+        metrics.observe("llm_rate_limit_agent_wait_seconds", waited, agent=agent)
+
+
+# === 多端點負載平衡 ===
+
+def get_endpoint_pool() -> Optional[EndpointPool]:
+    """取得共用的端點池，AZURE_OPENAI_ENDPOINTS 少於兩個時回傳 None"""
+    global _endpoint_pool
+    if not EndpointPoolConfig.enabled():
+        return None
+    with _lock:
+        if _endpoint_pool is None:
+            _endpoint_pool = EndpointPool(
+                LLMConfig.ENDPOINTS,
+                ewma_alpha=EndpointPoolConfig.EWMA_ALPHA,
+                eject_error_rate=EndpointPoolConfig.EJECT_ERROR_RATE,
+                eject_consecutive_failures=EndpointPoolConfig.EJECT_CONSECUTIVE_FAILURES,
+                eject_latency_factor=EndpointPoolConfig.EJECT_LATENCY_FACTOR,
+                min_requests=EndpointPoolConfig.MIN_REQUESTS,
+                eject_seconds=EndpointPoolConfig.EJECT_SECONDS,
+                max_eject_seconds=EndpointPoolConfig.MAX_EJECT_SECONDS,
+                error_half_life=EndpointPoolConfig.ERROR_HALF_LIFE,
+            )
+        return _endpoint_pool
+
+
+def _pool_target(
+    agent: str, llm, options: Optional[Dict[str, Any]] = None
+) -> Optional[Tuple[EndpointPool, str, Optional[str], Dict[str, Any]]]:
+    """
+    判斷本次呼叫是否經過端點池
+
+    只有未指定 llm（依 agent 路由）且提供者為 openai 時才分流；
+    明確傳入的 llm 實例一律照原樣呼叫。
+
+    Returns:
+        (端點池, 提供者, 模型, 呼叫選項（見 _configure）)，不分流時回傳 None
+    """
+    if llm is not None:
+        return None
+    pool = get_endpoint_pool()
+    if pool is None:
+        return None
+    provider, model = LLMConfig.agent_model(agent)
+    provider = (provider or LLMConfig.PROVIDER).lower()
+    if provider != "openai":
+        return None
+    return pool, provider, model, options or {}
+
+
+def _is_provider_error(exc: BaseException) -> bool:
+    """逾時、連線錯誤、429 與 5xx 視為提供者/端點問題；其他 4xx 是請求本身的問題，不影響健康狀態"""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        return True
+    return status >= 500 or status == 429
+
+
+def _release_endpoint(pool: EndpointPool, endpoint: Endpoint, started: float, error: Optional[BaseException]) -> None:
+    latency = time.monotonic() - started
+    failed = error is not None and _is_provider_error(error)
+    pool.release(endpoint, latency, error=failed)
+    metrics.observe("llm_endpoint_latency_seconds", latency, endpoint=endpoint.url)
+    if failed:
+        metrics.inc("llm_endpoint_errors", endpoint=endpoint.url)
+
+
+def _pooled_invoke(target, messages: List[BaseMessage], tried: Optional[List[Endpoint]] = None):
+    """
+    經由端點池呼叫
+
+    Args:
+        target: _pool_target() 的結果
+        messages: 輸入訊息
+        tried: 已使用過的端點，會盡量避開並附加本次使用的端點（對沖請求用）
+    """
+    pool, provider, model, options = target
+    endpoint = pool.acquire(exclude=tried[0] if tried else None)
+    if tried is not None:
+        tried.append(endpoint)
+    started = time.monotonic()
+    try:
+        llm = _configure(get_llm(provider=provider, model=model, endpoint=endpoint.url), **options)
+        response = _with_deadline(llm).invoke(messages)
+    except Exception as e:
+        _release_endpoint(pool, endpoint, started, e)
+        raise
+    _release_endpoint(pool, endpoint, started, None)
+    return response
+
+
+async def _apooled_invoke(target, messages: List[BaseMessage], tried: Optional[List[Endpoint]] = None):
+    """_pooled_invoke 的非同步版本"""
+    pool, provider, model, options = target
+    endpoint = pool.acquire(exclude=tried[0] if tried else None)
+    if tried is not None:
+        tried.append(endpoint)
+    started = time.monotonic()
+    try:
+        llm = _configure(get_llm(provider=provider, model=model, endpoint=endpoint.url), **options)
+        response = await _with_deadline(llm).ainvoke(messages)
+    except Exception as e:
+        _release_endpoint(pool, endpoint, started, e)
+        raise
+    _release_endpoint(pool, endpoint, started, None)
+    return response
+
+
+def _stream_once(target, llm, messages: List[BaseMessage], tried: Optional[List[Endpoint]] = None):
+    """單次串流呼叫（依 target 決定是否經由端點池）"""
+    if target is None:
+        yield from _with_deadline(llm).stream(messages)
+        return
+    pool, provider, model, options = target
+    endpoint = pool.acquire(exclude=tried[0] if tried else None)
+    if tried is not None:
+        tried.append(endpoint)
+    started = time.monotonic()
+    error = None
+    try:
+        llm = _configure(get_llm(provider=provider, model=model, endpoint=endpoint.url), **options)
+        yield from _with_deadline(llm).stream(messages)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _release_endpoint(pool, endpoint, started, error)
+
+
+async def _astream_once(target, llm, messages: List[BaseMessage], tried: Optional[List[Endpoint]] = None):
+    """_stream_once 的非同步版本"""
+    if target is None:
+        async for chunk in _with_deadline(llm).astream(messages):
+            yield chunk
+        return
+    pool, provider, model, options = target
+    endpoint = pool.acquire(exclude=tried[0] if tried else None)
+    if tried is not None:
+        tried.append(endpoint)
+    started = time.monotonic()
+    error = None
+    try:
+        llm = _configure(get_llm(provider=provider, model=model, endpoint=endpoint.url), **options)
+        async for chunk in _with_deadline(llm).astream(messages):
+            yield chunk
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _release_endpoint(pool, endpoint, started, error)
+
+
+# === 斷路器 ===
+
+def _allow(llm) -> Optional[circuit_breaker.CircuitBreaker]:
+    """取得對應的斷路器並檢查是否允許呼叫，開啟中時拋出 CircuitOpenError"""
+    provider, model, _ = _llm_identity(llm)
+    breaker = circuit_breaker.get_breaker(provider, model)
+    if breaker is not None:
+        breaker.allow()
+    return breaker
+
+
+def _record_outcome(breaker: Optional[circuit_breaker.CircuitBreaker], error: Optional[BaseException]) -> None:
+    if breaker is None:
+        return
+    # 因本輪期限到而中止（或逾時被縮短）的呼叫不代表提供者的狀態
+    if error is not None and (isinstance(error, DeadlineExceeded) or deadline.remaining() == 0):
+        return
+    if error is not None and _is_provider_error(error):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def _raise_if_expired(agent: str, error: BaseException) -> None:
+    """呼叫因本輪期限已過而失敗（逾時被縮短）時，改拋出 DeadlineExceeded"""
+    if not isinstance(error, DeadlineExceeded) and deadline.remaining() == 0:
+        raise deadline.exceeded(agent) from error
+
+
+# === 單次呼叫與對沖 ===
+
+def _tried_list() -> Optional[List[Endpoint]]:
+    return [] if HedgeConfig.OTHER_ENDPOINT else None
+
+
+def _hedge_delay(agent: str, metric: str = hedging.LATENCY_METRIC) -> Optional[float]:
+    """對沖門檻；本輪剩餘時間不足以等到門檻時不對沖"""
+    delay = hedging.hedge_delay(agent, metric)
+    left = deadline.remaining()
+    if delay is not None and left is not None and left <= delay:
+        return None
+    return delay
+
+
+def _call(agent: str, llm, target, messages: List[BaseMessage]):
+    """執行一次呼叫（不含快取），超過對沖門檻時改以對沖方式執行"""
+    delay = _hedge_delay(agent)
+    if delay is None:
+        started = time.monotonic()
+        response = _pooled_invoke(target, messages) if target else _with_deadline(llm).invoke(messages)
+        metrics.observe(hedging.LATENCY_METRIC, time.monotonic() - started, agent=agent)
+        return response
+
+    tried = _tried_list()
+    turn = deadline.current()
+
+    def attempt(index: int):
+        # 對沖在另一個 thread 執行，需帶入本輪期限
+        with deadline.use(turn):
+            if index:
+                # 對沖請求同樣受速率限制
+                _acquire(agent, llm, messages)
+            return _pooled_invoke(target, messages, tried) if target else _with_deadline(llm).invoke(messages)
+
+    return hedging.hedged_call(agent, attempt, delay, count_tokens(render_messages(messages)))
+
+
+async def _acall(agent: str, llm, target, messages: List[BaseMessage]):
+    """_call 的非同步版本"""
+    delay = _hedge_delay(agent)
+    if delay is None:
+        started = time.monotonic()
+        response = await _apooled_invoke(target, messages) if target else await _with_deadline(llm).ainvoke(messages)
+        metrics.observe(hedging.LATENCY_METRIC, time.monotonic() - started, agent=agent)
+        return response
+
+    tried = _tried_list()
+
+    async def attempt(index: int):
+        if index:
+            await _aacquire(agent, llm, messages)
+        return await _apooled_invoke(target, messages, tried) if target else await _with_deadline(llm).ainvoke(messages)
+
+    return await hedging.ahedged_call(agent, attempt, delay, count_tokens(render_messages(messages)))
+
+
+# === 呼叫入口 ===
+
+def _record_usage(agent: str, usage: Optional[dict]) -> None:
+    """
+    依提供者回傳的 usage_metadata 記錄 token 用量與前綴快取命中
+
+    cache_read 為提供者 prompt 快取命中的輸入 token 數（OpenAI 的 cached_tokens、
+    Gemini 的 cached_content_token_count），提供者未回報時視為 0。
+    """
+    if not usage:
+        return
+    input_tokens = usage.get("input_tokens") or 0
+    cached = (usage.get("input_token_details") or {}).get("cache_read") or 0
+    metrics.inc("llm_input_tokens", input_tokens, agent=agent)
+    metrics.inc("llm_output_tokens", usage.get("output_tokens") or 0, agent=agent)
+    metrics.inc("llm_cached_input_tokens", cached, agent=agent)
+    total = metrics.get_counter("llm_input_tokens", agent=agent)
+    if total:
+        metrics.set_gauge(
+            "llm_prefix_cache_hit_ratio",
+            round(metrics.get_counter("llm_cached_input_tokens", agent=agent) / total, 4),
+            agent=agent,
+        )
+
+
+def _finish_invoke(agent: str, response, key: Optional[str], max_tokens: Optional[int]):
+    """記錄 usage 與截斷；被截斷的回應不寫入快取"""
+    _record_usage(agent, getattr(response, "usage_metadata", None))
+    if is_truncated(response):
+        _record_truncation(agent, max_tokens)
+    else:
+        _cache_store(key, response)
+    return response
+
+
+def _attempt(agent: str, llm, target, messages: List[BaseMessage]):
+    """單次嘗試（期限檢查 → 斷路器 → 速率限制 → 呼叫/對沖），每次重試都重新經過斷路器與速率限制"""
+    deadline.check(agent)
+    breaker = _allow(llm)
+    _acquire(agent, llm, messages)
+    _track_in_flight(1)
+    try:
+        response = _call(agent, llm, target, messages)
+    except Exception as e:
+        _record_outcome(breaker, e)
+        _raise_if_expired(agent, e)
+        raise
+    finally:
+        _track_in_flight(-1)
+    _record_outcome(breaker, None)
+    return response
+
+
+async def _aattempt(agent: str, llm, target, messages: List[BaseMessage]):
+    """_attempt 的非同步版本（期限到時取消進行中的呼叫）"""
+    deadline.check(agent)
+    breaker = _allow(llm)
+    await _aacquire(agent, llm, messages)
+    _track_in_flight(1)
+    try:
+        response = await deadline.wait(_acall(agent, llm, target, messages), agent)
+    except Exception as e:
+        _record_outcome(breaker, e)
+        _raise_if_expired(agent, e)
+        raise
+    finally:
+        _track_in_flight(-1)
+    _record_outcome(breaker, None)
+    return response
+
+
+def _invoke_uncached(
+    agent: str, llm, target, messages: List[BaseMessage], key: Optional[str], max_tokens: Optional[int] = None
+):
+    """實際呼叫提供者（暫時性錯誤依重試策略重試，見 retry），完成後寫入快取"""
+    response = retry.call(agent, lambda index: _attempt(agent, llm, target, messages))
+    return _finish_invoke(agent, response, key, max_tokens)
+
+
+async def _ainvoke_uncached(
+    agent: str, llm, target, messages: List[BaseMessage], key: Optional[str], max_tokens: Optional[int] = None
+):
+    """_invoke_uncached 的非同步版本"""
+    response = await retry.acall(agent, lambda index: _aattempt(agent, llm, target, messages))
+    return _finish_invoke(agent, response, key, max_tokens)
+
+
+def _flight_key(llm, messages: List[BaseMessage], cache_key: Optional[str]) -> Optional[str]:
+    """請求合併用的 key，與快取鍵相同（未啟用快取時另外計算）"""
+    if not CacheConfig.SINGLEFLIGHT:
+        return None
+    if cache_key is not None:
+        return cache_key
+    provider, model, temperature = _llm_identity(llm)
+    return LLMCache.make_key(provider, model, temperature, _request_text(llm, messages))
+
+
+def _shared(agent: str, response):
+    """共用其他呼叫的結果時複製一份，避免呼叫端互相修改"""
+    metrics.inc("llm_singleflight_shared", agent=agent)
+    logger.info(f"[llm_client] {agent} 合併至進行中的相同請求")
+    return response.model_copy() if hasattr(response, "model_copy") else response
+
+
+def invoke(
+    agent: str,
+    messages: List[BaseMessage],
+    llm=None,
+    schema: Optional[Type[BaseModel]] = None,
+    max_tokens: Optional[int] = None,
+):
+    """
+    呼叫 LLM 的統一入口（同步）
+
+    相同 prompt 的請求同時進行時只會送出一次，其餘呼叫者共用結果；
+    暫時性錯誤（逾時、429、5xx 等）依 retry 的退避策略重試。
+
+    Args:
+        agent: 呼叫者名稱，例如 "summary_agent"，用於快取開關與指標標籤
+        messages: 輸入訊息
+        llm: 指定的 LLM 實例，預設依 agent 取得（見 get_agent_llm），
+             並在設定多個端點時經由端點池分流
+        schema: 輸出的 Pydantic schema，LLM_STRUCTURED_OUTPUT=true 且提供者支援時
+                以結構化輸出呼叫（回傳內容為符合 schema 的 JSON），否則忽略
+        max_tokens: 輸出 token 上限，預設為 output_budget(agent)；
+                    被截斷的回應不寫入快取，可用 is_truncated() 判斷
+
+    Returns:
+        AIMessage
+
+    Raises:
+        CircuitOpenError: 斷路器開啟中（快取命中時仍會回傳快取結果）
+        DeadlineExceeded: 本輪對話期限已過（見 deadline），未設期限時不會發生
+    """
+    max_tokens = max_tokens or output_budget(agent)
+    options = {"schema": schema, "max_tokens": max_tokens}
+    target = _pool_target(agent, llm, options)
+    llm = _configure(llm or get_agent_llm(agent), **options)
+    key = _cache_key(agent, llm, messages)
+    cached = _cache_lookup(agent, key)
+    if cached is not None:
+        return cached
+    flight_key = _flight_key(llm, messages, key)
+    if flight_key is None:
+        return _invoke_uncached(agent, llm, target, messages, key, max_tokens)
+    response, shared = _flights.do(
+        flight_key, lambda: _invoke_uncached(agent, llm, target, messages, key, max_tokens), agent
+    )
+    return _shared(agent, response) if shared else response
+
+
+async def ainvoke(
+    agent: str,
+    messages: List[BaseMessage],
+    llm=None,
+    schema: Optional[Type[BaseModel]] = None,
+    max_tokens: Optional[int] = None,
+):
+    """invoke 的非同步版本"""
+    max_tokens = max_tokens or output_budget(agent)
+    options = {"schema": schema, "max_tokens": max_tokens}
+    target = _pool_target(agent, llm, options)
+    llm = _configure(llm or get_agent_llm(agent), **options)
+    key = _cache_key(agent, llm, messages)
+    cached = _cache_lookup(agent, key)
+    if cached is not None:
+        return cached
+    flight_key = _flight_key(llm, messages, key)
+    if flight_key is None:
+        return await _ainvoke_uncached(agent, llm, target, messages, key, max_tokens)
+    response, shared = await _aflights.do(
+        flight_key, lambda: _ainvoke_uncached(agent, llm, target, messages, key, max_tokens), agent
+    )
+    return _shared(agent, response) if shared else response
+
+
+def _stream_chunks(agent: str, llm, target, messages: List[BaseMessage]) -> Iterator[AIMessageChunk]:
+    """執行一次串流呼叫，超過對沖門檻時改以對沖方式執行"""
+    delay = _hedge_delay(agent, hedging.FIRST_CHUNK_METRIC)
+    if delay is None:
+        started = time.monotonic()
+        first = True
+        for chunk in _stream_once(target, llm, messages):
+            if first:
+                metrics.observe(hedging.FIRST_CHUNK_METRIC, time.monotonic() - started, agent=agent)
+                first = False
+            yield chunk
+        return
+
+    tried = _tried_list()
+    turn = deadline.current()
+
+    def attempt(index: int):
+        # 對沖串流在另一個 thread 逐步執行，需帶入本輪期限
+        with deadline.use(turn):
+            if index:
+                _acquire(agent, llm, messages)
+        return deadline.iterate(_stream_once(target, llm, messages, tried), turn)
+
+    yield from hedging.hedged_stream(agent, attempt, delay, count_tokens(render_messages(messages)))
+
+
+async def _astream_chunks(agent: str, llm, target, messages: List[BaseMessage]) -> AsyncIterator[AIMessageChunk]:
+    """_stream_chunks 的非同步版本"""
+    delay = _hedge_delay(agent, hedging.FIRST_CHUNK_METRIC)
+    if delay is None:
+        started = time.monotonic()
+        first = True
+        async for chunk in _astream_once(target, llm, messages):
+            if first:
+                metrics.observe(hedging.FIRST_CHUNK_METRIC, time.monotonic() - started, agent=agent)
+                first = False
+            yield chunk
+        return
+
+    tried = _tried_list()
+
+    async def attempt_stream(index: int):
+        # 對沖請求同樣受速率限制
+        if index:
+            await _aacquire(agent, llm, messages)
+        async for chunk in _astream_once(target, llm, messages, tried):
+            yield chunk
+
+    async for chunk in hedging.ahedged_stream(
+        agent, attempt_stream, delay, count_tokens(render_messages(messages))
+    ):
+        yield chunk
+
+
+def _stream_attempt(agent: str, llm, target, messages: List[BaseMessage]) -> Iterator[AIMessageChunk]:
+    """單次串流嘗試（期限檢查 → 斷路器 → 速率限制 → 串流/對沖）"""
+    deadline.check(agent)
+    breaker = _allow(llm)
+    _acquire(agent, llm, messages)
+    error = None
+    chunks = _stream_chunks(agent, llm, target, messages)
+    _track_in_flight(1)
+    try:
+        for chunk in chunks:
+            # 同步串流無法中斷等待中的讀取（由單次請求逾時把關），每收到一段就檢查期限
+            deadline.check(agent)
+            yield chunk
+    except Exception as e:
+        error = e
+        _raise_if_expired(agent, e)
+        raise
+    finally:
+        chunks.close()
+        _track_in_flight(-1)
+        _record_outcome(breaker, error)
+
+
+async def _astream_attempt(agent: str, llm, target, messages: List[BaseMessage]) -> AsyncIterator[AIMessageChunk]:
+    """_stream_attempt 的非同步版本（期限到時取消等待中的讀取）"""
+    deadline.check(agent)
+    breaker = _allow(llm)
+    await _aacquire(agent, llm, messages)
+    error = None
+    chunks = _astream_chunks(agent, llm, target, messages)
+    _track_in_flight(1)
+    try:
+        while True:
+            try:
+                chunk = await deadline.wait(chunks.__anext__(), agent)
+            except StopAsyncIteration:
+                break
+            yield chunk
+    except Exception as e:
+        error = e
+        _raise_if_expired(agent, e)
+        raise
+    finally:
+        await chunks.aclose()
+        _track_in_flight(-1)
+        _record_outcome(breaker, error)
+
+
+def stream(
+    agent: str, messages: List[BaseMessage], llm=None, max_tokens: Optional[int] = None
+) -> Iterator[AIMessageChunk]:
+    """
+    串流呼叫 LLM（同步），逐段 yield AIMessageChunk
+
+    串流輸出不經過回應快取；啟用對沖時以第一個 chunk 的時間判斷是否對沖。
+    暫時性錯誤只在尚未輸出任何 chunk 前重試。
+    達到輸出上限時最後的 chunk 帶有 finish_reason，可用 is_truncated() 判斷。
+
+    Args:
+        同 invoke
+
+    Raises:
+        CircuitOpenError: 斷路器開啟中
+        DeadlineExceeded: 本輪對話期限已過（可能已輸出部分 chunk）
+    """
+    max_tokens = max_tokens or output_budget(agent)
+    options = {"max_tokens": max_tokens}
+    target = _pool_target(agent, llm, options)
+    llm = _configure(llm or get_agent_llm(agent), **options)
+    usage = None
+    truncated = False
+    chunks = retry.stream(agent, lambda index: _stream_attempt(agent, llm, target, messages))
+    try:
+        for chunk in chunks:
+            if chunk.usage_metadata:
+                usage = add_usage(usage, chunk.usage_metadata)
+            truncated = truncated or is_truncated(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+    _record_usage(agent, usage)
+    if truncated:
+        _record_truncation(agent, max_tokens)
+
+
+async def astream(
+    agent: str, messages: List[BaseMessage], llm=None, max_tokens: Optional[int] = None
+) -> AsyncIterator[AIMessageChunk]:
+    """stream 的非同步版本（期限到時取消等待中的讀取）"""
+    max_tokens = max_tokens or output_budget(agent)
+    options = {"max_tokens": max_tokens}
+    target = _pool_target(agent, llm, options)
+    llm = _configure(llm or get_agent_llm(agent), **options)
+    usage = None
+    truncated = False
+    chunks = retry.astream(agent, lambda index: _astream_attempt(agent, llm, target, messages))
+    try:
+        async for chunk in chunks:
+            if chunk.usage_metadata:
+                usage = add_usage(usage, chunk.usage_metadata)
+            truncated = truncated or is_truncated(chunk)
+            yield chunk
+    finally:
+        await chunks.aclose()
+    _record_usage(agent, usage)
+    if truncated:
+        _record_truncation(agent, max_tokens)
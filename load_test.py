@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+ProjectFlow 離線壓力測試
+
+預設使用假 LLM（LLM_PROVIDER=fake），不消耗任何 token。
+模擬多個 session 同時對話，量測每一輪的首字延遲與完整回覆時間，並輸出 metrics 快照。
+
+用法：
+    python load_test.py --sessions 50 --turns 3 --latency-ms 800 --latency-distribution lognormal
+    python load_test.py --error-rate 0.05 --output-length 300
+    python load_test.py --mode invoke
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ProjectFlow 離線壓力測試")
+    parser.add_argument("--sessions", type=int, default=20, help="同時對話的 session 數")
+    parser.add_argument("--turns", type=int, default=3, help="每個 session 的對話輪數")
+    parser.add_argument("--concurrency", type=int, default=0, help="同時執行的 session 上限，0 表示全部同時")
+    parser.add_argument("--latency-ms", type=float, help="假 LLM 平均延遲（毫秒）")
+    parser.add_argument("--latency-distribution", choices=["fixed", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--output-length", type=int, help="假 LLM 主要輸出長度（字數）")
+    parser.add_argument("--error-rate", type=float, help="假 LLM 錯誤率 (0-1)")
+    parser.add_argument("--mode", choices=["stream", "invoke"], default="stream",
+                        help="stream 使用 stream_graph，invoke 使用 run_graph（一次回傳完整回覆）")
+    parser.add_argument("--real", action="store_true", help="使用 .env 設定的真實提供者（會消耗 token）")
+    return parser.parse_args()
+
+
+def configure_env(args):
+    """在匯入 ProjectFlow 模組前設定環境變數"""
+    if not args.real:
+        os.environ["LLM_PROVIDER"] = "fake"
+    for name, value in (
+        ("FAKE_LLM_LATENCY_MS", args.latency_ms),
+        ("FAKE_LLM_LATENCY_DISTRIBUTION", args.latency_distribution),
+        ("FAKE_LLM_OUTPUT_LENGTH", args.output_length),
+        ("FAKE_LLM_ERROR_RATE", args.error_rate),
+    ):
+        if value is not None:
+            os.environ[name] = str(value)
+    # 測試產生的 state 檔寫到暫存目錄
+    os.environ.setdefault("SESSION_DIR", tempfile.mkdtemp(prefix="projectflow_load_"))
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("MODULE_LOG_LEVEL", "WARNING")
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "avg": round(statistics.mean(ordered), 3),
+        "p50": round(pick(50), 3),
+        "p95": round(pick(95), 3),
+        "p99": round(pick(99), 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+def main():
+    args = parse_args()
+    configure_env(args)
+
+    from langchain_core.messages import AIMessage, HumanMessage
+    import metrics
+    from projectflow_graph import run_graph, stream_graph
+
+    first_token, full_reply = [], []
+    errors = []
+    lock = threading.Lock()
+
+    def run_session(index):
+        state = {
+            "messages": [AIMessage(content="嗨！請問你在生活中有沒有碰到讓你關心的問題呢？")],
+            "project_content": "",
+            "action_plan": "",
+            "historical_log": "",
+            "current_progress": "",
+            "guidance_strategy": "",
+            "score": "",
+            "next_response": "",
+            "session_id": f"load-{index}-{uuid.uuid4().hex[:8]}",
+            "next_agent": None,
+            "stage_number": 1,
+        }
+        for turn in range(args.turns):
+            state["messages"].append(HumanMessage(content=f"第 {turn + 1} 輪：我觀察到校園裡的垃圾問題 ({index})"))
+            started = time.monotonic()
+            first = None
+            try:
+                if args.mode == "invoke":
+                    run_graph(state)
+                    first = time.monotonic() - started
+                else:
+                    for _ in stream_graph(state):
+                        if first is None:
+                            first = time.monotonic() - started
+            except Exception as e:
+                with lock:
+                    errors.append(f"{type(e).__name__}: {e}")
+                continue
+            with lock:
+                if first is not None:
+                    first_token.append(first)
+                full_reply.append(time.monotonic() - started)
+
+    workers = args.concurrency or args.sessions
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run_session, range(args.sessions)))
+    elapsed = time.monotonic() - started
+
+    report = {
+        "sessions": args.sessions,
+        "turns": args.turns,
+        "elapsed_seconds": round(elapsed, 3),
+        "turns_per_second": round(len(full_reply) / elapsed, 2) if elapsed else 0,
+        "errors": len(errors),
+        "first_token_seconds": percentiles(first_token),
+        "full_reply_seconds": percentiles(full_reply),
+        "metrics": metrics.snapshot(),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if errors:
+        print(f"\n前幾個錯誤：{errors[:5]}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+ProjectFlow 執行指標模組
+
+提供 process 內的輕量指標收集，供容量規劃與調校使用：
+- 計數器 (counter)：快取命中、重試次數等累計值
+- 量測值 (gauge)：佇列深度等即時值
+- 分布統計 (summary)：延遲、等待時間等，保留近期樣本以計算百分位數
+
+所有函式皆為 thread-safe，可由任意 thread 呼叫。
+"""
+
+import math
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# 每個 summary 保留的近期樣本數（用於百分位數計算）
+SAMPLE_SIZE = 1000
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Tuple], float] = {}
+_gauges: Dict[Tuple[str, Tuple], float] = {}
+_summaries: Dict[Tuple[str, Tuple], "_Summary"] = {}
+
+
+class _Summary:
+    """單一分布統計的累計值與近期樣本"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples: Deque[float] = deque(maxlen=SAMPLE_SIZE)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        idx = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+        return ordered[idx]
+
+
+def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_key(key: Tuple[str, Tuple]) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """
+    累加計數器
+
+    Args:
+        name: 指標名稱
+        value: 累加值
+        **labels: 標籤，例如 agent="summary_agent"
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    """設定量測值"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """記錄一筆分布樣本（例如延遲秒數）"""
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.get(key)
+        if summary is None:
+            summary = _summaries[key] = _Summary()
+        summary.add(value)
+
+
+def get_counter(name: str, **labels) -> float:
+    """取得計數器目前的值"""
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def get_gauge(name: str, **labels) -> Optional[float]:
+    """取得量測值，未設定時回傳 None"""
+    with _lock:
+        return _gauges.get(_key(name, labels))
+
+
+def percentile(name: str, q: float, **labels) -> Optional[float]:
+    """
+    取得近期樣本的百分位數
+
+    Args:
+        name: 指標名稱
+        q: 百分位 (0-100)
+        **labels: 標籤
+
+    Returns:
+        百分位數值，尚無樣本時回傳 None
+    """
+    with _lock:
+        summary = _summaries.get(_key(name, labels))
+        return summary.percentile(q) if summary else None
+
+
+def sample_count(name: str, **labels) -> int:
+    """取得分布統計的累計樣本數"""
+    with _lock:
+        summary = _summaries.get(_key(name, labels))
+        return summary.count if summary else 0
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """
+    取得所有指標的快照（可直接序列化為 JSON）
+
+    Returns:
+        {"counters": {...}, "gauges": {...}, "summaries": {...}}
+    """
+    with _lock:
+        summaries = {}
+        for key, summary in _summaries.items():
+            summaries[_format_key(key)] = {
+                "count": summary.count,
+                "sum": round(summary.total, 6),
+                "avg": round(summary.total / summary.count, 6) if summary.count else 0.0,
+                "max": round(summary.max, 6),
+                "p50": summary.percentile(50),
+                "p95": summary.percentile(95),
+                "p99": summary.percentile(99),
+            }
+        return {
+            "counters": {_format_key(k): v for k, v in _counters.items()},
+            "gauges": {_format_key(k): v for k, v in _gauges.items()},
+            "summaries": summaries,
+        }
+
+
+def reset() -> None:
+    """清除所有指標（主要供測試使用）"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _summaries.clear()
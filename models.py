@@ -40,3 +40,29 @@ class TeacherAnalysis(BaseModel):
     suggestions: List[str] = Field(default_factory=list, description="介入建議")
     analysis_summary: str = Field(default="", description="分析摘要")
     generated_at: datetime = Field(default_factory=_utc_now, description="分析時間")
+
+
+# === Agent 結構化輸出（LLM_STRUCTURED_OUTPUT=true 時作為提供者端的 JSON schema） ===
+# 欄位名稱與各 prompt 要求的 JSON key 相同，且全部為必填（OpenAI strict json_schema 的要求）
+
+class SummaryOutput(BaseModel):
+    """summary_agent 輸出"""
+    project_content: str = Field(..., description="更新後的專案內容")
+    ACTION_PLAN: str = Field(..., description="更新後的計畫執行清單")
+    HISTORICAL_LOG: str = Field(..., description="更新後的歷史摘要與狀態階段紀錄")
+    stage_number: int = Field(..., description="階段編號")
+
+
+class ScoreOutput(BaseModel):
+    """score_agent 輸出"""
+    current_progress: str = Field(..., description="更新後的當前狀態與評分")
+
+
+class SummaryScoreOutput(SummaryOutput):
+    """summary_score_agent 輸出"""
+    current_progress: str = Field(..., description="更新後的當前狀態與評分")
+
+
+class DecisionOutput(BaseModel):
+    """decision_agent 輸出"""
+    Guidance_and_Strategy: str = Field(..., description="下一步的引導與決策策略")
@@ -3,25 +3,40 @@ import os
 import json
 import yaml
 import threading
-import pickle
 import uuid
 import logging
 import re
+import time
 
-from langgraph.graph import END, StateGraph
-from langchain_openai import ChatOpenAI, AzureChatOpenAI
-from langchain_google_vertexai import ChatVertexAI
-from langchain_core.messages import HumanMessage, AIMessage
-from typing import TypedDict, List, Optional
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from pydantic import BaseModel, ValidationError
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, TypedDict, List, Optional, Tuple, Type
+
+if TYPE_CHECKING:
+    from langgraph.graph import StateGraph
 
 import prompts
+import prompt_layout
 
 # 新增: 導入模組化背景工具
+import background_jobs
 import background_tool
 
 # 導入工具函式
 from utils import clean_llm_response
 
+import deadline
+import llm_client
+import metrics
+import summary_policy
+from circuit_breaker import CircuitOpenError
+from config import BackgroundConfig, LLMConfig, OutputBudgetConfig
+from deadline import DeadlineExceeded
+from models import DecisionOutput, ScoreOutput, SummaryOutput, SummaryScoreOutput
+
+# 斷路器開啟或本輪期限已過時改走降級路徑（沿用先前狀態、備援回覆），不讓整輪失敗
+DEGRADED_ERRORS = (CircuitOpenError, DeadlineExceeded)
+
 
 logger = logging.getLogger(__name__)
 # === Logging 設定，確保在直接執行時能輸出到 Terminal ===
@@ -62,6 +77,34 @@ def extract_first_json_list(text: str):
     return []
 
 
+def parse_agent_output(agent: str, text: str, schema: Type[BaseModel]) -> dict:
+    """
+    解析 agent 的 JSON 輸出，回傳第一個物件；失敗時回傳 {}
+
+    結構化輸出模式下內容應為符合 schema 的 JSON 物件，直接以 schema 驗證，
+    不需以正則掃描整段輸出；驗證失敗（例如提供者不支援而回傳一般文字）才改用 extract_first_json_list。
+    """
+    if LLMConfig.STRUCTURED_OUTPUT:
+        try:
+            return schema.model_validate_json(text).model_dump()
+        except ValidationError:
+            metrics.inc("llm_structured_output_fallbacks", agent=agent)
+    parsed_list = extract_first_json_list(text)
+    result = parsed_list[0] if parsed_list and isinstance(parsed_list[0], dict) else {}
+    if not result:
+        metrics.inc("llm_parse_failures", agent=agent)
+        logger.warning(f"[{agent}] 無法解析 JSON 輸出，本次結果不套用")
+    return result
+
+
+def _discard_truncated(agent: str, response) -> bool:
+    """輸出達上限被截斷時不套用（截斷的 JSON 可能被部分解析而寫壞 state），沿用原本的欄位"""
+    if not llm_client.is_truncated(response):
+        return False
+    logger.warning(f"[{agent}] 輸出被截斷，本次結果不套用")
+    return True
+
+
 # Define state
 class AgentState(TypedDict):
     messages: List
@@ -76,63 +119,16 @@ class AgentState(TypedDict):
     next_agent: Optional[str]
     stage_number: Optional[int]
     group_id: Optional[str]  # 新增組別 ID 支援
+    turn_id: Optional[str]  # 本輪對話的識別碼（背景工作去重用，見 background_jobs）
+    summary_cursor: Optional[int]  # summary 已處理到的訊息數
+    score_cursor: Optional[int]  # score 已處理到的訊息數
 
 
 # Load environment config
 load_dotenv("./.env")
 
-# Set LLM Provider (透過 .env 決定使用哪個提供者)
-llm_provider = os.getenv("LLM_PROVIDER", "openai").lower()  # azure, openai, vertexai
-azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-azure_api_key = os.getenv("AZURE_OPENAI_API_KEY")
-deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
-azure_api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview")
-
-# Init LLM based on provider
-if llm_provider == "azure":
-    # Azure OpenAI 官方服務
-    logger.info(f"使用 Azure OpenAI 官方服務: {azure_endpoint}")
-    if not azure_endpoint or not azure_api_key:
-        raise ValueError("使用 Azure OpenAI 需要設定 AZURE_OPENAI_ENDPOINT 和 AZURE_OPENAI_API_KEY")
-    
-    llm = AzureChatOpenAI(
-        azure_deployment=deployment_name,
-        azure_endpoint=azure_endpoint,
-        api_key=azure_api_key,
-        api_version=azure_api_version,
-        temperature=0,
-        timeout=60,
-        max_retries=2
-    )
-
-elif llm_provider == "openai":
-    # 本地 OpenAI 相容 API (ngrok, vLLM, Ollama, etc.)
-    logger.info(f"使用 OpenAI 相容 API: {azure_endpoint}")
-    if not azure_endpoint or not azure_api_key:
-        raise ValueError("使用 OpenAI API 需要設定 AZURE_OPENAI_ENDPOINT 和 AZURE_OPENAI_API_KEY")
-    
-    # 確保 endpoint 有 /v1 路徑
-    endpoint = azure_endpoint
-    if not endpoint.endswith("/v1"):
-        endpoint = endpoint.rstrip("/") + "/v1"
-    
-    llm = ChatOpenAI(
-        model=deployment_name,
-        base_url=endpoint,
-        api_key=azure_api_key,
-        temperature=0,
-        timeout=60,
-        max_retries=2
-    )
-
-elif llm_provider == "vertexai":
-    # Google Vertex AI
-    vertex_model = os.getenv("VERTEX_AI_MODEL", "gemini-2.5-flash")
-    logger.info(f"使用 Google Vertex AI: {vertex_model}")
-    llm = ChatVertexAI(model_name=vertex_model)
-
-else:
-    raise ValueError(f"不支援的 LLM_PROVIDER: {llm_provider}，請使用 azure、openai 或 vertexai")
+# 預設 LLM 實例（模組屬性 llm）在第一次存取時才由 llm_client 建立，見 __getattr__；
+# 各 agent 實際使用的模型由 llm_client.get_agent_llm 依 SUMMARY_MODEL 等設定決定
 
 # Summary agent
 # 依據新prompt，需傳遞更多欄位，並解析新格式
@@ -165,31 +161,82 @@ def build_current_progress(stage_number, messages, stage_settings):
     return current_progress
 
 
-def summary_agent(state: AgentState) -> AgentState:
+def load_stage_settings() -> dict:
+    """讀取 prompts/stage_setting.yaml 的階段設定"""
+    with open("prompts/stage_setting.yaml", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+
+def build_fallback_reply(state: AgentState) -> str:
+    """
+    LLM 無法使用（斷路器開啟）時的本地備援回覆
+
+    依目前階段的名稱與核心問題引導學生先自行思考，不需呼叫 LLM。
+    """
+    stage_number = state.get("stage_number") or 1
+    stage = load_stage_settings().get(f"stage_{stage_number}", {})
+    stage_name = stage.get("name", f"階段{stage_number}")
+    main_issue = stage.get("main_issue", "")
+    reply = f"目前系統連線比較不穩定，暫時沒辦法給你完整的回饋，請稍後再傳一次訊息。\n\n我們現在在「{stage_name}」"
+    if main_issue:
+        reply += f"，這個階段的核心問題是：{main_issue}"
+    reply += "\n\n在等待的時候，可以先把你目前的想法整理下來，我們稍後繼續討論！"
+    return reply
+
+
+def dialog_since(state: AgentState, cursor_key: str) -> str:
+    """
+    背景 agent 要處理的對話：自上次處理到的位置起的所有訊息
+
+    預設為最近 3 則（上一輪 AI 回覆、使用者輸入、本輪回覆）；多輪合併成一次背景工作時，
+    從 state[cursor_key] 的前一則開始涵蓋所有尚未處理的輪次，最多 BACKGROUND_MAX_DIALOG_MESSAGES 則。
+    """
+    messages = state["messages"]
+    start = len(messages) - 3
+    cursor = state.get(cursor_key)
+    if isinstance(cursor, int) and cursor <= len(messages):
+        start = min(start, cursor - 1)
+    start = max(0, start, len(messages) - BackgroundConfig.MAX_DIALOG_MESSAGES)
+    return "\n".join([m.content for m in messages[start:]])
+
+
+def _prepare_summary(state: AgentState) -> List[BaseMessage]:
     logger.info(f"[summary_agent] state id: {id(state)}")
     logger.info(f"[summary_agent] state: {state}")
-    prompt = prompts.SUMMARY_AGENT_PROMPT.format(
-        current_dialog="\n".join([m.content for m in state["messages"][-3:]]),
+    messages = prompt_layout.build_messages(
+        prompts.SUMMARY_AGENT_PROMPT,
+        current_dialog=dialog_since(state, "summary_cursor"),
         project_content=state.get("project_content", ""),
         action_plan=state.get("action_plan", ""),
         historical_log=state.get("historical_log", ""),
         current_progress=state.get("current_progress", ""),
     )
+    prompt = prompt_layout.render(messages)
     input_tokens = count_tokens(prompt)
     TOKEN_STATS["summary_agent"]["input"] += input_tokens
     logger.info(
         f"[summary_agent] 輸入 tokens: {input_tokens}, 累計輸入: {TOKEN_STATS['summary_agent']['input']}"
     )
     logger.info(f"📝 SummaryAgent 輸入prompt：{prompt}")
-    response = llm.invoke([HumanMessage(content=prompt)])
+    return messages
+
+
+def _finish_summary(state: AgentState, response) -> AgentState:
     output_tokens = count_tokens(response.content)
     TOKEN_STATS["summary_agent"]["output"] += output_tokens
     logger.info(
         f"[summary_agent] 輸出 tokens: {output_tokens}, 累計輸出: {TOKEN_STATS['summary_agent']['output']}"
     )
     logger.info(f"result(raw): {response.content}")
-    parsed_list = extract_first_json_list(response.content)
-    result = parsed_list[0] if parsed_list else {}
+    if _discard_truncated("summary_agent", response):
+        return state
+    result = parse_agent_output("summary_agent", response.content, SummaryOutput)
+    state["summary_cursor"] = len(state["messages"])
+    return _apply_summary(state, result)
+
+
+def _apply_summary(state: AgentState, result: dict) -> AgentState:
+    """將摘要結果（project_content、ACTION_PLAN、HISTORICAL_LOG、stage_number）寫回 state"""
     with open("prompts/stage_setting.yaml", encoding="utf-8") as f:
         stage_settings = yaml.safe_load(f)
     prev_stage = state.get("stage_number", None)
@@ -212,19 +259,45 @@ def summary_agent(state: AgentState) -> AgentState:
     return state
 
 
+def summary_agent(state: AgentState) -> AgentState:
+    if not summary_policy.should_summarize(state, "summary_agent"):
+        return state
+    messages = _prepare_summary(state)
+    try:
+        response = llm_client.invoke("summary_agent", messages, schema=SummaryOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[summary_agent] {e}，略過本次更新")
+        return state
+    return _finish_summary(state, response)
+
+
+async def asummary_agent(state: AgentState) -> AgentState:
+    if not summary_policy.should_summarize(state, "summary_agent"):
+        return state
+    messages = _prepare_summary(state)
+    try:
+        response = await llm_client.ainvoke("summary_agent", messages, schema=SummaryOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[summary_agent] {e}，略過本次更新")
+        return state
+    return _finish_summary(state, response)
+
+
 # Score agent
 # 需傳遞 action_plan, current_progress
 
 
-def score_agent(state: AgentState) -> AgentState:
+def _prepare_score(state: AgentState) -> List[BaseMessage]:
     logger.info(f"[score_agent] state id: {id(state)}")
     logger.info(f"[score_agent] state: {state}")
-    prompt = prompts.SCORE_AGENT_PROMPT.format(
-        current_dialog="\n".join([m.content for m in state["messages"][-3:]]),
+    messages = prompt_layout.build_messages(
+        prompts.SCORE_AGENT_PROMPT,
+        current_dialog=dialog_since(state, "score_cursor"),
         project_content=state.get("project_content", ""),
         action_plan=state.get("action_plan", ""),
         current_progress=state.get("current_progress", ""),
     )
+    prompt = prompt_layout.render(messages)
     # 計算與累計 input token 數量
     input_tokens = count_tokens(prompt)
     TOKEN_STATS["score_agent"]["input"] += input_tokens
@@ -232,7 +305,10 @@ def score_agent(state: AgentState) -> AgentState:
         f"[score_agent] 輸入 tokens: {input_tokens}, 累計輸入: {TOKEN_STATS['score_agent']['input']}"
     )
     logger.info(f"📝 ScoreAgent 輸入prompt：{prompt}")
-    response = llm.invoke([HumanMessage(content=prompt)])
+    return messages
+
+
+def _finish_score(state: AgentState, response) -> AgentState:
     logger.info(f"result(raw): {response.content}")
     # 計算與累計 output token 數量
     output_tokens = count_tokens(response.content)
@@ -241,34 +317,120 @@ def score_agent(state: AgentState) -> AgentState:
         f"[score_agent] 輸出 tokens: {output_tokens}, 累計輸出: {TOKEN_STATS['score_agent']['output']}"
     )
 
-    try:
-        parsed_list = extract_first_json_list(response.content)
-        result = parsed_list[0] if parsed_list else {}
-    except Exception:
-        result = {}
+    if _discard_truncated("score_agent", response):
+        return state
+    result = parse_agent_output("score_agent", response.content, ScoreOutput)
+    state["score_cursor"] = len(state["messages"])
     state["current_progress"] = result.get(
         "current_progress", state.get("current_progress", "")
     )
     return state
 
 
+def score_agent(state: AgentState) -> AgentState:
+    messages = _prepare_score(state)
+    try:
+        response = llm_client.invoke("score_agent", messages, schema=ScoreOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[score_agent] {e}，略過本次更新")
+        return state
+    return _finish_score(state, response)
+
+
+async def ascore_agent(state: AgentState) -> AgentState:
+    messages = _prepare_score(state)
+    try:
+        response = await llm_client.ainvoke("score_agent", messages, schema=ScoreOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[score_agent] {e}，略過本次更新")
+        return state
+    return _finish_score(state, response)
+
+
+# Summary + Score 合併 agent
+# 一次呼叫同時更新摘要欄位與 current_progress，取代 summary_agent → score_agent 兩次呼叫
+
+
+def _prepare_summary_score(state: AgentState) -> List[BaseMessage]:
+    logger.info(f"[summary_score_agent] state id: {id(state)}")
+    messages = prompt_layout.build_messages(
+        prompts.SUMMARY_SCORE_AGENT_PROMPT,
+        current_dialog=dialog_since(state, "summary_cursor"),
+        project_content=state.get("project_content", ""),
+        action_plan=state.get("action_plan", ""),
+        historical_log=state.get("historical_log", ""),
+        current_progress=state.get("current_progress", ""),
+    )
+    prompt = prompt_layout.render(messages)
+    input_tokens = count_tokens(prompt)
+    TOKEN_STATS["summary_score_agent"]["input"] += input_tokens
+    logger.info(
+        f"[summary_score_agent] 輸入 tokens: {input_tokens}, 累計輸入: {TOKEN_STATS['summary_score_agent']['input']}"
+    )
+    logger.info(f"📝 SummaryScoreAgent 輸入prompt：{prompt}")
+    return messages
+
+
+def _finish_summary_score(state: AgentState, response) -> AgentState:
+    output_tokens = count_tokens(response.content)
+    TOKEN_STATS["summary_score_agent"]["output"] += output_tokens
+    logger.info(
+        f"[summary_score_agent] 輸出 tokens: {output_tokens}, 累計輸出: {TOKEN_STATS['summary_score_agent']['output']}"
+    )
+    logger.info(f"result(raw): {response.content}")
+    if _discard_truncated("summary_score_agent", response):
+        return state
+    result = parse_agent_output("summary_score_agent", response.content, SummaryScoreOutput)
+    state["summary_cursor"] = state["score_cursor"] = len(state["messages"])
+    prev_stage = state.get("stage_number")
+    _apply_summary(state, result)
+    # 階段改變時 current_progress 已重建為新階段的評分表，模型的評分針對的是舊階段，不採用
+    if state["stage_number"] == prev_stage and result.get("current_progress"):
+        state["current_progress"] = result["current_progress"]
+    return state
+
+
+def summary_score_agent(state: AgentState) -> AgentState:
+    # 只略過摘要時評分仍照常執行，與 summary_agent → score_agent 的結果一致
+    if not summary_policy.should_summarize(state, "summary_score_agent"):
+        return score_agent(state)
+    messages = _prepare_summary_score(state)
+    try:
+        response = llm_client.invoke("summary_score_agent", messages, schema=SummaryScoreOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[summary_score_agent] {e}，略過本次更新")
+        return state
+    return _finish_summary_score(state, response)
+
+
+async def asummary_score_agent(state: AgentState) -> AgentState:
+    if not summary_policy.should_summarize(state, "summary_score_agent"):
+        return await ascore_agent(state)
+    messages = _prepare_summary_score(state)
+    try:
+        response = await llm_client.ainvoke("summary_score_agent", messages, schema=SummaryScoreOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[summary_score_agent] {e}，略過本次更新")
+        return state
+    return _finish_summary_score(state, response)
+
+
 # Decision agent
 # 需傳遞更多欄位，並解析 Guidance_and_Strategy
 
 
-def decision_agent(state: AgentState) -> AgentState:
+def _prepare_decision(state: AgentState) -> List[BaseMessage]:
     logger.info(f"[decision_agent] state id: {id(state)}")
     logger.info(f"[decision_agent] state: {state}")
-    prompt = prompts.DECISION_AGENT_PROMPT.format(
+    messages = prompt_layout.build_messages(
+        prompts.DECISION_AGENT_PROMPT,
         current_dialog="\n".join([m.content for m in state["messages"][-3:]]),
         project_content=state.get("project_content", ""),
         action_plan=state.get("action_plan", ""),
         historical_log=state.get("historical_log", ""),
         current_progress=state.get("current_progress", ""),
     )
-    _state_copy = state.copy()
-    thread = threading.Thread(target=run_background_graph, args=(_state_copy,))
-    thread.start()
+    prompt = prompt_layout.render(messages)
     # 計算與累計 input token 數量
     input_tokens = count_tokens(prompt)
     TOKEN_STATS["decision_agent"]["input"] += input_tokens
@@ -276,7 +438,10 @@ def decision_agent(state: AgentState) -> AgentState:
         f"[decision_agent] 輸入 tokens: {input_tokens}, 累計輸入: {TOKEN_STATS['decision_agent']['input']}"
     )
     logger.info(f"📝 DecisionAgent 輸入prompt：{prompt}")
-    response = llm.invoke([HumanMessage(content=prompt)])
+    return messages
+
+
+def _finish_decision(state: AgentState, response) -> AgentState:
     logger.info(f"result(raw): {response.content}")
     # 計算與累計 output token 數量
     output_tokens = count_tokens(response.content)
@@ -285,33 +450,72 @@ def decision_agent(state: AgentState) -> AgentState:
         f"[decision_agent] 輸出 tokens: {output_tokens}, 累計輸出: {TOKEN_STATS['decision_agent']['output']}"
     )
 
-    try:
-        parsed_list = extract_first_json_list(response.content)
-        result = parsed_list[0] if parsed_list else {}
-    except Exception:
-        result = {}
+    if _discard_truncated("decision_agent", response):
+        return state
+    result = parse_agent_output("decision_agent", response.content, DecisionOutput)
     state["guidance_strategy"] = result.get("Guidance_and_Strategy", "")
     return state
 
 
+def _decide(state: AgentState, messages: List[BaseMessage]) -> AgentState:
+    try:
+        response = llm_client.invoke("decision_agent", messages, schema=DecisionOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[decision_agent] {e}，沿用先前的引導策略")
+        return state
+    return _finish_decision(state, response)
+
+
+async def _adecide(state: AgentState, messages: List[BaseMessage]) -> AgentState:
+    try:
+        response = await llm_client.ainvoke("decision_agent", messages, schema=DecisionOutput)
+    except DEGRADED_ERRORS as e:
+        logger.warning(f"[decision_agent] {e}，沿用先前的引導策略")
+        return state
+    return _finish_decision(state, response)
+
+
+def decision_agent(state: AgentState) -> AgentState:
+    return _decide(state, _prepare_decision(state))
+
+
+async def adecision_agent(state: AgentState) -> AgentState:
+    return await _adecide(state, _prepare_decision(state))
+
+
 # PBL response agent
 # 需傳遞 guidance_strategy
 
+# RESPONSE_AGENT_PROMPT 中代表「專案內容總結」位置的標記
+PROJECT_CONTENT_MARKER = "[CURRENT_PROJECT_CONTENT]"
 
-def response_agent(state: AgentState) -> AgentState:
+
+# 回覆達輸出上限被截斷時附加的結尾
+TRUNCATION_SUFFIX = "……"
+
+
+def _prepare_response(state: AgentState) -> Tuple[List[BaseMessage], Optional[int]]:
+    """組出 response_agent 的訊息，並依負載決定本次的輸出上限 (訊息, max_tokens)"""
     logger.info(f"[response_agent] state id: {id(state)}")
     logger.info(f"state: {state}")
 
-    prompt = prompts.RESPONSE_AGENT_PROMPT.format(
+    messages = prompt_layout.build_messages(
+        prompts.RESPONSE_AGENT_PROMPT,
         all_dialogs="\n".join([m.content for m in state["messages"][-10:]]),
         guidance_strategy=state.get("guidance_strategy", ""),
         project_content=state.get("project_content", ""),
         action_plan=state.get("action_plan", ""),
     )
-    logger.info(f"📝 ResponseAgent 輸入prompt：{prompt}")
-    if "[CURRENT_PROJECT_CONTENT]" in prompt:
+    if LLMConfig.PROMPT_LAYOUT != "prefix":
+        # prefix 模式不替換，以免專案內容混入靜態前綴；改在 _finish_response 替換回覆中的標記
         current_project_content = state.get("project_content", "")
-        prompt = prompt.replace("[CURRENT_PROJECT_CONTENT]", current_project_content)
+        for message in messages:
+            message.content = message.content.replace(PROJECT_CONTENT_MARKER, current_project_content)
+    budget = llm_client.output_budget("response_agent")
+    if budget and budget < OutputBudgetConfig.max_tokens("response_agent"):
+        # 負載高時上限縮減，提示模型縮短回覆，避免句子被截斷（放在最後，不影響前綴快取）
+        messages[-1].content += f"\n（請將本次回覆控制在約 {int(budget * 0.7)} 字以內，並完整結束句子）"
+    prompt = prompt_layout.render(messages)
     # 計算與累計 input token 數量
     input_tokens = count_tokens(prompt)
     TOKEN_STATS["response_agent"]["input"] += input_tokens
@@ -319,7 +523,10 @@ def response_agent(state: AgentState) -> AgentState:
         f"[response_agent] 輸入 tokens: {input_tokens}, 累計輸入: {TOKEN_STATS['response_agent']['input']}"
     )
     logger.info(f"📝 ResponseAgent 輸入prompt：{prompt}")
-    response = llm.invoke([HumanMessage(content=prompt)])
+    return messages, budget
+
+
+def _finish_response(state: AgentState, response) -> AgentState:
     # 計算與累計 output token 數量
     output_tokens = count_tokens(response.content)
     TOKEN_STATS["response_agent"]["output"] += output_tokens
@@ -330,6 +537,10 @@ def response_agent(state: AgentState) -> AgentState:
     
     # 清理 LLM 回應中的內部推理標記
     cleaned_response = clean_llm_response(response.content)
+    if llm_client.is_truncated(response):
+        cleaned_response += TRUNCATION_SUFFIX
+    if PROJECT_CONTENT_MARKER in cleaned_response:
+        cleaned_response = cleaned_response.replace(PROJECT_CONTENT_MARKER, state.get("project_content", ""))
     logger.info(f"📝 ResponseAgent 清理後回覆：{cleaned_response}")
     
     state["messages"].append(AIMessage(content=cleaned_response))
@@ -337,84 +548,307 @@ def response_agent(state: AgentState) -> AgentState:
     return state
 
 
-# Workflow definition
-# 主 workflow： 只有 decision_agent（立即回傳給使用者）
-main_graph_builder = StateGraph(AgentState)
-main_graph_builder.add_node("decision_agent", decision_agent)
-main_graph_builder.set_entry_point("decision_agent")
+class _MarkerFilter:
+    """串流時將 PROJECT_CONTENT_MARKER 替換為專案內容（標記可能被切在不同 chunk）"""
 
-main_graph = main_graph_builder.compile()
+    def __init__(self, replacement: str):
+        self.replacement = replacement
+        self.pending = ""
 
-# 背景 workflow：response_agent → summary_agent → score_agent
-background_graph_builder = StateGraph(AgentState)
-background_graph_builder.add_node("response_agent", response_agent)
-background_graph_builder.add_node("summary_agent", summary_agent)
-background_graph_builder.add_node("score_agent", score_agent)
+    def feed(self, text: str) -> str:
+        text = (self.pending + text).replace(PROJECT_CONTENT_MARKER, self.replacement)
+        # 保留結尾可能是標記開頭的部分，等下一個 chunk 再判斷
+        start = text.rfind("[")
+        if start != -1 and PROJECT_CONTENT_MARKER.startswith(text[start:]):
+            self.pending = text[start:]
+            return text[:start]
+        self.pending = ""
+        return text
 
-background_graph_builder.set_entry_point("response_agent")
-background_graph_builder.add_edge("response_agent", "summary_agent")
-background_graph_builder.add_edge("summary_agent", "score_agent")
+    def flush(self) -> str:
+        text, self.pending = self.pending, ""
+        return text
 
-background_graph = background_graph_builder.compile()
 
-# 建立 background_tool (模組化) 並設定
-background_tool.setup(background_graph, AIMessage, HumanMessage, logger=logger)
+def _fallback_response(state: AgentState, error: Exception) -> AIMessage:
+    logger.warning(f"[response_agent] {error}，改用備援回覆")
+    metrics.inc("llm_fallback_replies", agent="response_agent")
+    return AIMessage(content=build_fallback_reply(state))
 
 
-def run_background_graph(state):
-    logger.info(f"[run_background_graph] state id: {id(state)}")
-    session_id = state.get("session_id")
-    group_id = state.get("group_id")
-    
-    # 執行背景 workflow (response_agent → summary_agent → score_agent)
-    for event in background_graph.stream(state):
-        if isinstance(event, dict):
-            state.update(event)
-    
-    if session_id:
-        # 如果有 group_id，儲存到組別目錄
-        if group_id:
-            import os
-            group_dir = os.path.join(os.getenv("GROUPS_DIR", "groups_data"), group_id)
-            os.makedirs(group_dir, exist_ok=True)
-            state_path = os.path.join(group_dir, f"state_{session_id}.pkl")
+def response_agent(state: AgentState) -> AgentState:
+    messages, budget = _prepare_response(state)
+    try:
+        response = llm_client.invoke("response_agent", messages, max_tokens=budget)
+    except DEGRADED_ERRORS as e:
+        response = _fallback_response(state, e)
+    return _finish_response(state, response)
+
+
+async def aresponse_agent(state: AgentState) -> AgentState:
+    messages, budget = _prepare_response(state)
+    try:
+        response = await llm_client.ainvoke("response_agent", messages, max_tokens=budget)
+    except DEGRADED_ERRORS as e:
+        response = _fallback_response(state, e)
+    return _finish_response(state, response)
+
+
+def stream_response_agent(state: AgentState) -> Iterator[str]:
+    """response_agent 的串流版本：逐段 yield 模型輸出，結束後與 response_agent 相同地寫回 state"""
+    messages, budget = _prepare_response(state)
+    chunks = []
+    truncated = False
+    marker = _MarkerFilter(state.get("project_content", ""))
+    try:
+        for chunk in llm_client.stream("response_agent", messages, max_tokens=budget):
+            truncated = truncated or llm_client.is_truncated(chunk)
+            if chunk.content:
+                chunks.append(chunk.content)
+                delta = marker.feed(chunk.content)
+                if delta:
+                    yield delta
+    except DEGRADED_ERRORS as e:
+        if chunks:
+            # 期限到時已輸出部分內容：保留已輸出的部分並以省略號結尾
+            logger.warning(f"[response_agent] {e}，回覆未完成即中止")
+            truncated = True
         else:
-            # 否則儲存到預設目錄
-            import os
-            session_dir = os.getenv("SESSION_DIR", "session_data")
-            os.makedirs(session_dir, exist_ok=True)
-            state_path = os.path.join(session_dir, f"state_{session_id}.pkl")
-        
-        with open(state_path, "wb") as f:
-            pickle.dump(state, f)
-    
-    logger.info("[Thread] 背景 workflow (response_agent → summary_agent → score_agent) 執行完成，已儲存 state")
+            chunks = [_fallback_response(state, e).content]
+            yield chunks[0]
+    rest = marker.flush()
+    if truncated:
+        rest += TRUNCATION_SUFFIX
+        chunks.append(TRUNCATION_SUFFIX)
+    if rest:
+        yield rest
+    _finish_response(state, AIMessage(content="".join(chunks)))
+
+
+async def astream_response_agent(state: AgentState) -> AsyncIterator[str]:
+    messages, budget = _prepare_response(state)
+    chunks = []
+    truncated = False
+    marker = _MarkerFilter(state.get("project_content", ""))
+    try:
+        async for chunk in llm_client.astream("response_agent", messages, max_tokens=budget):
+            truncated = truncated or llm_client.is_truncated(chunk)
+            if chunk.content:
+                chunks.append(chunk.content)
+                delta = marker.feed(chunk.content)
+                if delta:
+                    yield delta
+    except DEGRADED_ERRORS as e:
+        if chunks:
+            logger.warning(f"[response_agent] {e}，回覆未完成即中止")
+            truncated = True
+        else:
+            chunks = [_fallback_response(state, e).content]
+            yield chunks[0]
+    rest = marker.flush()
+    if truncated:
+        rest += TRUNCATION_SUFFIX
+        chunks.append(TRUNCATION_SUFFIX)
+    if rest:
+        yield rest
+    _finish_response(state, AIMessage(content="".join(chunks)))
+
+
+# Workflow definition
+def build_main_graph_builder(decision, response) -> "StateGraph":
+    """主 workflow：decision_agent → response_agent（回覆立即回傳給使用者）"""
+    from langgraph.graph import StateGraph
+
+    builder = StateGraph(AgentState)
+    builder.add_node("decision_agent", decision)
+    builder.add_node("response_agent", response)
+    builder.set_entry_point("decision_agent")
+    builder.add_edge("decision_agent", "response_agent")
+    return builder
+
+
+# 回覆已在前景產生，背景只需更新摘要與評分
+def build_bookkeeping_graph_builder(summary, score, summary_score=None) -> "StateGraph":
+    """背景 workflow：summary_agent → score_agent，或單一 summary_score_agent"""
+    from langgraph.graph import StateGraph
+
+    builder = StateGraph(AgentState)
+    if summary_score is not None:
+        builder.add_node("summary_score_agent", summary_score)
+        builder.set_entry_point("summary_score_agent")
+        return builder
+
+    builder.add_node("summary_agent", summary)
+    builder.add_node("score_agent", score)
+
+    builder.set_entry_point("summary_agent")
+    builder.add_edge("summary_agent", "score_agent")
+    return builder
+
+
+def _build_graph(name: str):
+    fused = LLMConfig.FUSED_SUMMARY_SCORE
+    if name == "main_graph":
+        return build_main_graph_builder(decision_agent, response_agent).compile()
+    if name == "bookkeeping_graph":
+        return build_bookkeeping_graph_builder(
+            summary_agent, score_agent, summary_score_agent if fused else None,
+        ).compile()
+    # 非同步版本：節點改用 ainvoke，需透過 astream / ainvoke 執行
+    if name == "amain_graph":
+        return build_main_graph_builder(adecision_agent, aresponse_agent).compile()
+    raise KeyError(name)
+
+
+GRAPH_NAMES = ("main_graph", "bookkeeping_graph", "amain_graph")
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def get_graph(name: str):
+    """
+    取得編譯好的 workflow（第一次使用時才匯入 langgraph 並編譯）
+
+    Args:
+        name: GRAPH_NAMES 之一，例如 "main_graph"
+    """
+    graph = _graphs.get(name)
+    if graph is None:
+        with _graphs_lock:
+            graph = _graphs.get(name)
+            if graph is None:
+                graph = _graphs[name] = _build_graph(name)
+    return graph
+
+
+def __getattr__(name: str):
+    """延後建立的模組屬性：main_graph 等 workflow 與預設 llm（PEP 562）"""
+    if name in GRAPH_NAMES:
+        return get_graph(name)
+    if name == "llm":
+        return llm_client.get_llm(temperature=0)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# 建立 background_tool (模組化) 並設定（背景 workflow 於第一次執行時才編譯）
+background_tool.setup(lambda: get_graph("bookkeeping_graph"), AIMessage, HumanMessage, logger=logger)
+
+
+def _merge_event(state, event) -> None:
+    """將 graph.stream 的事件 {node_name: node_state} 合併回 state 頂層"""
+    if isinstance(event, dict):
+        for node_state in event.values():
+            if isinstance(node_state, dict):
+                state.update(node_state)
+
+
+def _last_ai_reply(state) -> str:
+    messages = state.get("messages") or []
+    if messages and getattr(messages[-1], "type", None) == "ai":
+        return messages[-1].content
+    return ""
+
+
+def _begin_turn(state) -> float:
+    """標記新的一輪對話（寫入 turn_id），回傳開始時間"""
+    state["turn_id"] = background_jobs.new_turn_id()
+    return time.monotonic()
+
+
+def _observe_reply(mode: str, started: float) -> None:
+    """記錄從收到訊息到完整回覆的秒數（time_to_reply_seconds）"""
+    metrics.observe("time_to_reply_seconds", time.monotonic() - started, mode=mode)
 
 
 def run_graph(state):
+    """
+    執行一輪對話：decision_agent → response_agent 並立即回傳回覆
+
+    回覆寫回 state["messages"]，摘要與評分於回覆完成後在背景執行。
+    """
     logger.info(f"[run_graph] state id: {id(state)}")
     logger.info(f"[run_graph] state: {state}")
-
-    # 執行 decision_agent 並立即取得回應
-    ai_reply = ""
-    for event in main_graph.stream(state):
-        if isinstance(event, dict):
-            state.update(event)
-        if "messages" in event:
-            for msg in event["messages"]:
-                if hasattr(msg, "type") and msg.type == "ai":
-                    ai_reply = msg.content
+    started = _begin_turn(state)
+
+    # 決策與回覆共用本輪期限
+    with deadline.use(deadline.start(LLMConfig.TURN_DEADLINE)):
+        for event in get_graph("main_graph").stream(state):
+            _merge_event(state, event)
+    ai_reply = _last_ai_reply(state)
+    _observe_reply("invoke", started)
     
-    # 啟動背景任務執行 response_agent → summary_agent → score_agent
-    background_tool.run_async(state.copy())
+    # 啟動背景任務執行 summary_agent → score_agent
+    background_tool.run_async(state.copy(), graph=get_graph("bookkeeping_graph"))
     
     return ai_reply
 
 
+async def arun_graph(state):
+    """run_graph 的非同步版本：所有 LLM 呼叫皆走 ainvoke，不佔用 OS thread。
+
+    需在 event loop 中呼叫（例如 FastAPI 的 async endpoint）。
+    """
+    logger.info(f"[arun_graph] state id: {id(state)}")
+    logger.info(f"[arun_graph] state: {state}")
+    started = _begin_turn(state)
+
+    with deadline.use(deadline.start(LLMConfig.TURN_DEADLINE)):
+        async for event in get_graph("amain_graph").astream(state):
+            _merge_event(state, event)
+    ai_reply = _last_ai_reply(state)
+    _observe_reply("ainvoke", started)
+
+    # 啟動背景任務執行 summary_agent → score_agent（與其他路徑共用 worker pool）
+    background_tool.run_async(state.copy(), graph=get_graph("bookkeeping_graph"))
+
+    return ai_reply
+
+
+def stream_graph(state) -> Iterator[str]:
+    """run_graph 的串流模式：先決策，再逐段 yield response_agent 的輸出。
+
+    回覆直接在前景串流給使用者並寫回 state["messages"]，
+    完成後才於背景執行 summary_agent → score_agent。
+    決策與回覆共用本輪期限（TURN_DEADLINE_SECONDS），逾期時以備援回覆或已輸出的部分結束。
+    """
+    logger.info(f"[stream_graph] state id: {id(state)}")
+    # 呼叫端可能在不同 thread 取下一段（例如 Gradio），由 iterate 在每一步套用期限
+    yield from deadline.iterate(_stream_turn(state), deadline.start(LLMConfig.TURN_DEADLINE))
+
+
+def _stream_turn(state) -> Iterator[str]:
+    started = _begin_turn(state)
+    _decide(state, _prepare_decision(state))
+
+    yield from stream_response_agent(state)
+    _observe_reply("stream", started)
+
+    background_tool.run_async(state.copy(), graph=get_graph("bookkeeping_graph"))
+
+
+async def astream_graph(state) -> AsyncIterator[str]:
+    """stream_graph 的非同步版本，供 SSE endpoint 使用"""
+    logger.info(f"[astream_graph] state id: {id(state)}")
+    async for delta in deadline.aiterate(_astream_turn(state), deadline.start(LLMConfig.TURN_DEADLINE)):
+        yield delta
+
+
+async def _astream_turn(state) -> AsyncIterator[str]:
+    started = _begin_turn(state)
+    await _adecide(state, _prepare_decision(state))
+
+    async for delta in astream_response_agent(state):
+        yield delta
+    _observe_reply("astream", started)
+
+    background_tool.run_async(state.copy(), graph=get_graph("bookkeeping_graph"))
+
+
 # 新增 token 統計與計數函式
 TOKEN_STATS = {
     "summary_agent": {"input": 0, "output": 0},
     "score_agent": {"input": 0, "output": 0},
+    "summary_score_agent": {"input": 0, "output": 0},
     "decision_agent": {"input": 0, "output": 0},
     "response_agent": {"input": 0, "output": 0},
 }
@@ -466,7 +900,7 @@ if __name__ == "__main__":
         "next_response": None,
         "session_id": session_id,
     }
-    for event in main_graph.stream(initial_state):
+    for event in get_graph("main_graph").stream(initial_state):
         for agent_state in event.values():
             if "messages" in agent_state:
                 for msg in agent_state["messages"]:
@@ -3,7 +3,8 @@ import gradio as gr
 import pickle
 import uuid
 import os
-from projectflow_graph import run_graph, HumanMessage, AIMessage
+from projectflow_graph import run_graph, stream_graph, HumanMessage, AIMessage
+from config import WebConfig
 import json
 import logging  # 新增
 
@@ -40,18 +41,20 @@ def get_initial_state():
         "next_agent": ""
     }
 
-def get_initial_history():
-    state = get_initial_state()
+def _messages_to_history(messages):
     history = []
-    for msg in state["messages"]:
+    for msg in messages:
         if hasattr(msg, "type") and msg.type == "ai":
             history.append({"role": "assistant", "content": msg.content})
         else:
             history.append({"role": "user", "content": msg.content})
     return history
 
-def chat(user_msg, history, state):
-    logger.info(f"[chat] state id: {id(state)}")
+def get_initial_history():
+    state = get_initial_state()
+    return _messages_to_history(state["messages"])
+
+def _load_latest_state(state):
     session_id = state.get("session_id")
     messages = state.get("messages", [])
     # 先讀取最新 state
@@ -69,6 +72,10 @@ def chat(user_msg, history, state):
             pass
     if messages:
         state["messages"] = messages
+
+def chat(user_msg, history, state):
+    logger.info(f"[chat] state id: {id(state)}")
+    _load_latest_state(state)
     logger.info(f"[chat] state: {state}")
     logger.info(f"user_msg: {user_msg}")
     state["messages"].append(HumanMessage(content=user_msg))
@@ -84,6 +91,21 @@ def chat(user_msg, history, state):
             history.append({"role": "user", "content": msg.content})
     return history, "", state
 
+# 串流模式：逐段更新最後一則助理訊息
+def chat_stream(user_msg, history, state):
+    logger.info(f"[chat_stream] state id: {id(state)}")
+    _load_latest_state(state)
+    logger.info(f"user_msg: {user_msg}")
+    state["messages"].append(HumanMessage(content=user_msg))
+    history = _messages_to_history(state["messages"])
+    history.append({"role": "assistant", "content": ""})
+    yield history, "", state
+    for delta in stream_graph(state):
+        history[-1]["content"] += delta
+        yield history, "", state
+    # 串流結束後以清理過的正式回覆重組歷史
+    yield _messages_to_history(state["messages"]), "", state
+
 def clear():
     state = get_initial_state()
     return [], "", state
@@ -149,7 +171,7 @@ with gr.Blocks() as demo:
 
     upload_file = gr.File(label="上傳pickle", file_types=[".pkl"])
 
-    send_btn.click(chat, [user_input, chatbox, state], [chatbox, user_input, state])
+    send_btn.click(chat_stream if WebConfig.STREAMING else chat, [user_input, chatbox, state], [chatbox, user_input, state])
     clear_btn.click(clear, [], [chatbox, user_input, state])
 
     btn = gr.Button("點我產生下載檔案")
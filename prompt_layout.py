@@ -0,0 +1,102 @@
+"""
+ProjectFlow prompt 組裝模組
+
+提供者的 prompt 前綴快取（prefix caching）只對「完全相同的開頭」生效。
+PROMPT_LAYOUT=prefix 時，將 prompt 模板拆成：
+- 靜態前綴：角色說明、階段說明、doc_struct 格式與範例等每輪都相同的內容，放在 SystemMessage
+- 動態欄位：含 {欄位} 的行（及其前一行的標題），依原順序接在最後的 HumanMessage
+
+PROMPT_LAYOUT=inline（預設）維持原本單一 HumanMessage 的組法。
+"""
+
+import re
+from typing import List, Tuple
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from config import LLMConfig
+
+# 單一大括號的格式欄位（{{ }} 為跳脫的字面大括號）
+_FIELD = re.compile(r"(?<!\{)\{[A-Za-z_][A-Za-z0-9_]*\}(?!\})")
+
+
+def _is_label(line: str, field_line: str) -> bool:
+    """
+    判斷欄位上一行是否為其標題，例如「- 當前對話內容：」
+
+    以冒號結尾的行一律視為標題；欄位獨佔一行時，以「- 」開頭的行也視為標題。
+    """
+    stripped = line.strip()
+    if not stripped or _FIELD.search(stripped):
+        return False
+    if stripped.endswith(("：", ":")):
+        return True
+    return stripped.startswith("- ") and bool(_FIELD.fullmatch(field_line.strip()))
+
+
+def split_template(template: str) -> Tuple[str, str]:
+    """
+    將 prompt 模板拆成靜態前綴與動態部分
+
+    含欄位的行與其標題行移到動態部分；最後一個欄位之後的內容中，
+    最後一段（例如「請回覆：」）接在動態部分最後以維持原本的結尾指示，其餘仍屬靜態前綴。
+
+    Args:
+        template: str.format 格式的 prompt 模板
+
+    Returns:
+        (靜態前綴模板, 動態模板)，兩者仍需以 str.format 填入
+    """
+    lines = template.split("\n")
+    dynamic_idx = set()
+    for i, line in enumerate(lines):
+        if _FIELD.search(line):
+            dynamic_idx.add(i)
+            if i > 0 and _is_label(lines[i - 1], line):
+                dynamic_idx.add(i - 1)
+    if not dynamic_idx:
+        return template, ""
+
+    last = max(dynamic_idx)
+    # 結尾的最後一段（去除尾端空行後，最後一個空行之後的內容）
+    end = len(lines)
+    while end > last + 1 and not lines[end - 1].strip():
+        end -= 1
+    closing_start = end
+    while closing_start > last + 1 and lines[closing_start - 1].strip():
+        closing_start -= 1
+
+    static = [
+        line for i, line in enumerate(lines)
+        if i not in dynamic_idx and (i <= last or i < closing_start)
+    ]
+    dynamic = [line for i, line in enumerate(lines) if i in dynamic_idx]
+    closing = lines[closing_start:end]
+    if closing:
+        dynamic += [""] + closing
+    return "\n".join(static).strip("\n") + "\n", "\n".join(dynamic).strip("\n") + "\n"
+
+
+def build_messages(template: str, **fields) -> List[BaseMessage]:
+    """
+    依 PROMPT_LAYOUT 將模板與欄位組成訊息列表
+
+    Args:
+        template: str.format 格式的 prompt 模板
+        **fields: 模板欄位
+
+    Returns:
+        inline：[HumanMessage]；prefix：[SystemMessage(靜態前綴), HumanMessage(動態欄位)]
+    """
+    if LLMConfig.PROMPT_LAYOUT != "prefix":
+        return [HumanMessage(content=template.format(**fields))]
+    static, dynamic = split_template(template)
+    messages: List[BaseMessage] = [SystemMessage(content=static.format())]
+    if dynamic:
+        messages.append(HumanMessage(content=dynamic.format(**fields)))
+    return messages
+
+
+def render(messages: List[BaseMessage]) -> str:
+    """將訊息合併為單一字串（用於 log 與 token 計算）"""
+    return "\n".join(str(m.content) for m in messages)
@@ -0,0 +1,171 @@
+"""
+ProjectFlow LLM 速率限制模組
+
+在每次 LLM 呼叫前，依提供者/部署分別套用：
+- RPM：每分鐘請求數
+- TPM：每分鐘 token 數（以 count_tokens 估算輸入，加上預估輸出）
+
+採用「預約制」token bucket：額度不足時不會失敗，而是預約未來的額度並等待，
+讓同時湧入的請求依到達順序排隊，避免觸發提供者的 429。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import metrics
+from config import RateLimitConfig
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """以每分鐘速率補充的 token bucket（允許預約成負值以排隊）"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        """
+        Args:
+            per_minute: 每分鐘補充量
+            capacity: 最大累積量，預設為一分鐘的額度
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        預約額度
+
+        Args:
+            amount: 需要的額度
+            now: 目前的 monotonic 時間
+
+        Returns:
+            需要等待的秒數（0 表示可立即執行）
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """單一提供者/部署的 RPM + TPM 限制器"""
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0):
+        """
+        Args:
+            name: 限制器名稱（用於指標標籤）
+            rpm: 每分鐘請求數上限，0 表示不限制
+            tpm: 每分鐘 token 數上限，0 表示不限制
+        """
+        self.name = name
+        self._requests = TokenBucket(rpm) if rpm > 0 else None
+        self._tokens = TokenBucket(tpm) if tpm > 0 else None
+        self._lock = threading.Lock()
+        self._waiting = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._requests is not None or self._tokens is not None
+
+    def reserve(self, tokens: int, max_wait: Optional[float] = None) -> float:
+        """
+        預約一次請求與指定 token 數，回傳需等待的秒數
+
+        需等待的時間超過 max_wait 時不保留預約（歸還額度），呼叫端應放棄本次請求。
+        """
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            if self._requests is not None:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.reserve(tokens, now))
+            if max_wait is not None and wait > max_wait:
+                if self._requests is not None:
+                    self._requests.tokens += 1
+                if self._tokens is not None:
+                    self._tokens.tokens += tokens
+            return wait
+
+    def _track_waiting(self, delta: int) -> None:
+        with self._lock:
+            self._waiting += delta
+            metrics.set_gauge("llm_rate_limit_queued", self._waiting, limiter=self.name)
+
+    def acquire(self, tokens: int, max_wait: Optional[float] = None) -> Optional[float]:
+        """
+        取得額度，不足時阻塞等待（同步）
+
+        Args:
+            tokens: 本次請求預估的 token 數
+            max_wait: 最多願意等待的秒數（例如本輪對話的剩餘時間），None 表示不限
+
+        Returns:
+            實際等待的秒數；需等待超過 max_wait 時不等待、不佔用額度並回傳 None
+        """
+        if not self.enabled:
+            return 0.0
+        wait = self.reserve(tokens, max_wait)
+        if max_wait is not None and wait > max_wait:
+            metrics.inc("llm_rate_limit_rejected", limiter=self.name)
+            return None
+        if wait > 0:
+            logger.info(f"[RateLimiter] {self.name} 額度不足，排隊等待 {wait:.2f}s")
+            self._track_waiting(1)
+            try:
+                time.sleep(wait)
+            finally:
+                self._track_waiting(-1)
+        metrics.observe("llm_rate_limit_wait_seconds", wait, limiter=self.name)
+        return wait
+
+    async def aacquire(self, tokens: int, max_wait: Optional[float] = None) -> Optional[float]:
+        """acquire 的非同步版本，等待時不佔用 thread"""
+        if not self.enabled:
+            return 0.0
+        wait = self.reserve(tokens, max_wait)
+        if max_wait is not None and wait > max_wait:
+            metrics.inc("llm_rate_limit_rejected", limiter=self.name)
+            return None
+        if wait > 0:
+            logger.info(f"[RateLimiter] {self.name} 額度不足，排隊等待 {wait:.2f}s")
+            self._track_waiting(1)
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._track_waiting(-1)
+        metrics.observe("llm_rate_limit_wait_seconds", wait, limiter=self.name)
+        return wait
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str, model: Optional[str]) -> RateLimiter:
+    """
+    取得指定提供者/部署的共用限制器（整個 process 共用）
+
+    個別部署可透過 LLM_RATE_LIMITS 覆寫預設的 LLM_RPM / LLM_TPM。
+
+    Args:
+        provider: 提供者類型
+        model: 模型或部署名稱
+
+    Returns:
+        RateLimiter 實例
+    """
+    name = f"{provider}/{model}"
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            rpm, tpm = RateLimitConfig.limits_for(provider, model)
+            limiter = _limiters[name] = RateLimiter(name, rpm=rpm, tpm=tpm)
+        return limiter
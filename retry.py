@@ -0,0 +1,218 @@
+"""
+ProjectFlow LLM 重試模組
+
+集中處理所有 LLM 呼叫的重試（客戶端本身的 max_retries 設為 0，見 RetryConfig）：
+- 只重試暫時性錯誤：逾時、連線錯誤、408/409/429 與 5xx；其他 4xx 是請求本身的問題
+- 指數退避加上 full jitter（0 ~ 上限之間隨機），避免提供者恢復時所有請求同時重送
+- 提供者回傳 Retry-After 時至少等待該秒數，超過 LLM_RETRY_MAX_RETRY_AFTER 則直接失敗
+- 等待時間超過本輪對話剩餘時間時不重試（見 deadline）
+- 串流只在尚未輸出任何 chunk 前重試
+
+指標：llm_retries（agent、reason）、llm_retry_delay_seconds、llm_retry_exhausted。
+"""
+
+import asyncio
+import email.utils
+import logging
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+import httpx
+
+import deadline
+import metrics
+from circuit_breaker import CircuitOpenError
+from config import RetryConfig
+from deadline import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+# 視為暫時性錯誤的 HTTP 狀態碼（另含所有 5xx）
+RETRYABLE_STATUS = frozenset({408, 409, 429})
+
+# 沒有狀態碼時，依例外類別名稱判斷的逾時/連線錯誤（不需匯入各提供者套件）
+_RETRYABLE_NAMES = frozenset({"APIConnectionError", "APITimeoutError", "FakeLLMTimeout"})
+
+
+def _status(error: BaseException) -> Optional[int]:
+    """取得例外的 HTTP 狀態碼（openai 為 status_code，google api_core 為 code）"""
+    for attr in ("status_code", "code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """判斷錯誤是否值得重試"""
+    if isinstance(error, (CircuitOpenError, DeadlineExceeded)):
+        return False
+    status = _status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    return any(cls.__name__ in _RETRYABLE_NAMES for cls in type(error).__mro__)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    取得提供者要求的等待秒數
+
+    依序讀取 retry-after-ms（OpenAI）與 retry-after（秒數或 HTTP 日期），沒有時回傳 None。
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff(retry_index: int) -> float:
+    """第 retry_index 次重試（從 0 起算）的等待秒數：full jitter 指數退避"""
+    cap = min(RetryConfig.MAX_DELAY, RetryConfig.BASE_DELAY * (2 ** retry_index))
+    return random.uniform(0, cap)
+
+
+def _reason(error: BaseException) -> str:
+    status = _status(error)
+    return str(status) if status is not None else type(error).__name__
+
+
+def next_delay(agent: str, error: BaseException, retry_index: int) -> Optional[float]:
+    """
+    決定是否重試
+
+    Args:
+        agent: agent 名稱（指標標籤）
+        error: 本次失敗的例外
+        retry_index: 已重試的次數
+
+    Returns:
+        重試前應等待的秒數；不重試時回傳 None
+    """
+    if not RetryConfig.ENABLED or not is_retryable(error):
+        return None
+    if retry_index >= RetryConfig.MAX_RETRIES:
+        metrics.inc("llm_retry_exhausted", agent=agent)
+        return None
+    delay = backoff(retry_index)
+    hint = retry_after(error)
+    if hint is not None:
+        if hint > RetryConfig.MAX_RETRY_AFTER:
+            logger.warning(f"[retry] {agent} 提供者要求等待 {hint:.0f}s，超過上限，不重試")
+            return None
+        # 在提供者要求的時間之後再加上 jitter，避免同時重送
+        delay = hint + backoff(0)
+    remaining = deadline.remaining()
+    if remaining is not None and delay >= remaining:
+        return None
+    reason = _reason(error)
+    metrics.inc("llm_retries", agent=agent, reason=reason)
+    metrics.observe("llm_retry_delay_seconds", delay, agent=agent)
+    logger.warning(f"[retry] {agent} 呼叫失敗（{reason}: {error}），{delay:.2f}s 後第 {retry_index + 1} 次重試")
+    return delay
+
+
+def call(agent: str, attempt: Callable[[int], Any]) -> Any:
+    """
+    以重試策略執行同步呼叫
+
+    Args:
+        agent: agent 名稱
+        attempt: 執行一次呼叫的函式，參數為第幾次嘗試（0 為第一次）
+    """
+    index = 0
+    while True:
+        try:
+            return attempt(index)
+        except Exception as e:
+            delay = next_delay(agent, e, index)
+            if delay is None:
+                raise
+        time.sleep(delay)
+        index += 1
+
+
+async def acall(agent: str, attempt: Callable[[int], Awaitable[Any]]) -> Any:
+    """call 的非同步版本"""
+    index = 0
+    while True:
+        try:
+            return await attempt(index)
+        except Exception as e:
+            delay = next_delay(agent, e, index)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
+        index += 1
+
+
+def stream(agent: str, attempt: Callable[[int], Iterator[Any]]) -> Iterator[Any]:
+    """
+    以重試策略執行同步串流，已輸出 chunk 後的錯誤不重試
+
+    Args:
+        agent: agent 名稱
+        attempt: 回傳一次串流的函式，參數為第幾次嘗試
+    """
+    index = 0
+    while True:
+        chunks = attempt(index)
+        started = False
+        try:
+            for chunk in chunks:
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            delay = None if started else next_delay(agent, e, index)
+            if delay is None:
+                raise
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        time.sleep(delay)
+        index += 1
+
+
+async def astream(agent: str, attempt: Callable[[int], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+    """stream 的非同步版本"""
+    index = 0
+    while True:
+        chunks = attempt(index)
+        started = False
+        try:
+            async for chunk in chunks:
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            delay = None if started else next_delay(agent, e, index)
+            if delay is None:
+                raise
+        finally:
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        await asyncio.sleep(delay)
+        index += 1
@@ -0,0 +1,107 @@
+"""
+ProjectFlow 請求合併 (single-flight) 模組
+
+相同 key 的呼叫同時進行時，只有第一個呼叫（leader）實際執行，
+其他呼叫等待並共用同一個結果或例外，例如兩位教師同時分析同一組別。
+
+同步呼叫以 thread 等待；非同步呼叫在各自的 event loop 中共用同一個 task，
+單一呼叫者被取消不會中斷其他仍在等待的呼叫者。
+等待者只等到自己的每輪期限（見 deadline），逾期時拋出 DeadlineExceeded，不受 leader 拖累。
+"""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import deadline
+
+
+class _Call:
+    """進行中的同步呼叫"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """同步版本的請求合併"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def do(self, key: str, fn: Callable[[], Any], stage: str = "") -> Tuple[Any, bool]:
+        """
+        執行或加入相同 key 的進行中呼叫
+
+        Args:
+            key: 合併用的 key（例如 prompt 雜湊）
+            fn: 實際執行的函式
+            stage: 逾期時記錄的階段（例如 agent 名稱）
+
+        Returns:
+            (結果, 是否為共用其他呼叫的結果)
+
+        Raises:
+            DeadlineExceeded: 等待其他呼叫的結果時本輪期限已過
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(deadline.remaining()):
+                raise deadline.exceeded(stage)
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        """目前進行中的呼叫數"""
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """非同步版本的請求合併（依 event loop 分開記錄）"""
+
+    def __init__(self):
+        self._calls: Dict[Tuple[int, str], asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], stage: str = "") -> Tuple[Any, bool]:
+        """do 的非同步版本，fn 為回傳 awaitable 的函式"""
+        flight_key = (id(asyncio.get_running_loop()), key)
+        task = self._calls.get(flight_key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(fn())
+            self._calls[flight_key] = task
+            task.add_done_callback(lambda t: self._forget(flight_key, t))
+        # shield：單一呼叫者被取消或逾期時不影響共用的 task
+        return await deadline.wait(asyncio.shield(task), stage), shared
+
+    def _forget(self, flight_key: Tuple[int, str], task: asyncio.Task) -> None:
+        if self._calls.get(flight_key) is task:
+            del self._calls[flight_key]
+        if not task.cancelled():
+            # 所有呼叫者都已取消時，避免 "exception was never retrieved" 警告
+            task.exception()
+
+    def in_flight(self) -> int:
+        """目前進行中的呼叫數"""
+        return len(self._calls)
@@ -6,10 +6,12 @@ import gradio as gr
 import pickle
 import uuid
 import os
-from projectflow_graph import run_graph, HumanMessage, AIMessage
+from projectflow_graph import run_graph, stream_graph, HumanMessage, AIMessage
+import background_tool
 import json
 import logging
 from group_manager import get_group_manager
+from config import WebConfig
 
 # 設定 logging
 logging.basicConfig(
@@ -76,11 +78,10 @@ def get_initial_state(group_id: str):
     }
 
 
-def get_initial_history(group_id: str):
-    """取得初始對話歷史"""
-    state = get_initial_state(group_id)
+def _messages_to_history(messages):
+    """依據 state["messages"] 組合 Chatbot 歷史"""
     history = []
-    for msg in state["messages"]:
+    for msg in messages:
         if hasattr(msg, "type") and msg.type == "ai":
             history.append({"role": "assistant", "content": msg.content})
         else:
@@ -88,9 +89,14 @@ def get_initial_history(group_id: str):
     return history
 
 
-def chat(user_msg, history, state):
-    """處理對話"""
-    logger.info(f"[chat] state id: {id(state)}")
+def get_initial_history(group_id: str):
+    """取得初始對話歷史"""
+    state = get_initial_state(group_id)
+    return _messages_to_history(state["messages"])
+
+
+def _load_latest_state(state):
+    """從組別目錄讀取背景 workflow 最新儲存的 state，並保留記憶體中的對話"""
     group_id = state.get("group_id")
     session_id = state.get("session_id")
     messages = state.get("messages", [])
@@ -112,17 +118,20 @@ def chat(user_msg, history, state):
     
     if messages:
         state["messages"] = messages
+
+
+def chat(user_msg, history, state):
+    """處理對話"""
+    logger.info(f"[chat] state id: {id(state)}")
+    _load_latest_state(state)
     
     logger.info(f"[chat] state: {state}")
     logger.info(f"user_msg: {user_msg}")
     state["messages"].append(HumanMessage(content=user_msg))
     bot_msg = run_graph(state)
     
-    # 儲存 state 到組別目錄
-    if group_id:
-        state_path = _get_group_state_path(group_id)
-        with open(state_path, "wb") as f:
-            pickle.dump(state, f)
+    # 與背景工作共用同一個 writer，保留已完成的背景摘要
+    background_tool.save_state(state)
     
     # 依據 state["messages"] 重新組合歷史
     history = []
@@ -137,6 +146,27 @@ def chat(user_msg, history, state):
     return history, "", state
 
 
+def chat_stream(user_msg, history, state):
+    """處理對話（串流模式）：逐段更新最後一則助理訊息"""
+    logger.info(f"[chat_stream] state id: {id(state)}")
+    _load_latest_state(state)
+    
+    logger.info(f"user_msg: {user_msg}")
+    state["messages"].append(HumanMessage(content=user_msg))
+    history = _messages_to_history(state["messages"])
+    history.append({"role": "assistant", "content": ""})
+    yield history, "", state
+    
+    for delta in stream_graph(state):
+        history[-1]["content"] += delta
+        yield history, "", state
+    
+    background_tool.save_state(state)
+    
+    # 串流結束後以清理過的正式回覆重組歷史
+    yield _messages_to_history(state["messages"]), "", state
+
+
 def clear(group_id):
     """清除對話"""
     state = get_initial_state(group_id)
@@ -217,7 +247,11 @@ def create_student_interface():
         )
         
         # 對話功能
-        send_btn.click(chat, [user_input, chatbox, state], [chatbox, user_input, state])
+        send_btn.click(
+            chat_stream if WebConfig.STREAMING else chat,
+            [user_input, chatbox, state],
+            [chatbox, user_input, state]
+        )
         
         # 清除功能
         def clear_with_group(current_group_id):
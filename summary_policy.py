@@ -0,0 +1,65 @@
+"""
+ProjectFlow 摘要頻率模組
+
+summary 原本每一輪都執行，但「好」「ok」這類回覆不會改變 project_content。
+本模組在執行 summary 前，以自上次摘要（state["summary_cursor"]）後的對話判斷是否需要執行：
+- 尚未摘要過、或 project_content 仍是空的：執行
+- 使用者輸入出現換主題、階段、計畫等關鍵字，或決策策略為「總結」：執行
+- 使用者輸入累積達 SUMMARY_POLICY_MIN_TOKENS：執行
+- 已連續略過 SUMMARY_POLICY_MAX_SKIPPED_TURNS 輪：執行，避免摘要過舊
+- 其他情況略過
+
+略過時不移動 summary_cursor，略過的輪次會併入下一次摘要（見 projectflow_graph.dialog_since）。
+只略過摘要，評分仍每輪執行；合併模式（summary_score_agent）略過時改為單獨執行 score_agent。
+
+指標：summary_policy_decisions（agent、decision、reason）。
+"""
+
+import logging
+from typing import Any, Dict, Tuple
+
+import metrics
+from config import SummaryPolicyConfig
+from utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def decide(state: Dict[str, Any]) -> Tuple[bool, str]:
+    """
+    判斷本次是否執行 summary
+
+    Returns:
+        (是否執行, 原因)
+    """
+    if not SummaryPolicyConfig.ENABLED:
+        return True, "disabled"
+    messages = state.get("messages") or []
+    cursor = state.get("summary_cursor")
+    if not isinstance(cursor, int) or cursor > len(messages):
+        return True, "initial"
+    if not state.get("project_content"):
+        return True, "initial"
+
+    user_inputs = [m.content for m in messages[cursor:] if getattr(m, "type", None) == "human"]
+    if not user_inputs:
+        return False, "no_new_input"
+    text = "\n".join(user_inputs)
+    if any(keyword in text for keyword in SummaryPolicyConfig.KEYWORDS):
+        return True, "keyword"
+    if "總結" in (state.get("guidance_strategy") or ""):
+        return True, "strategy"
+    if count_tokens(text) >= SummaryPolicyConfig.MIN_TOKENS:
+        return True, "tokens"
+    if len(user_inputs) > SummaryPolicyConfig.MAX_SKIPPED_TURNS:
+        return True, "turns"
+    return False, "small_delta"
+
+
+def should_summarize(state: Dict[str, Any], agent: str = "summary_agent") -> bool:
+    """decide 並記錄指標，略過時寫入日誌"""
+    run, reason = decide(state)
+    metrics.inc("summary_policy_decisions", agent=agent, decision="run" if run else "skip", reason=reason)
+    if not run:
+        logger.info(f"[{agent}] 對話變化不足（{reason}），略過本輪摘要，併入下一次")
+    return run
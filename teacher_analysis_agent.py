@@ -2,12 +2,20 @@
 教師分析 Agent
 協助教師分析各組學生的學習狀況並提供介入建議
 """
+import asyncio
 import logging
 import json
 import re
-from typing import Dict, List, Any
-from langchain_core.messages import HumanMessage
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import AsyncIterator, Dict, Iterator, List, Any, Optional
 from models import TeacherAnalysis, GroupProgress
+from config import TeacherAnalysisConfig
+from deadline import DeadlineExceeded
+import deadline
+import llm_client
+import metrics
+import prompt_layout
 
 logger = logging.getLogger(__name__)
 
@@ -67,14 +75,20 @@ TEACHER_ANALYSIS_PROMPT = """
 class TeacherAnalysisAgent:
     """教師分析 Agent"""
     
-    def __init__(self, llm):
+    def __init__(self, llm=None):
         """
         初始化教師分析 Agent
         
         Args:
-            llm: Language model instance (來自 projectflow_graph)
+            llm: Language model instance，預設不固定模型：每次呼叫由 llm_client 依
+                 TEACHER_MODEL / TEACHER_PROVIDER 與端點池選擇（於分析時才建立）
         """
-        self.llm = llm
+        self._llm = llm
+    
+    @property
+    def llm(self):
+        """分析使用的 LLM（未指定時為 llm_client 依 agent 設定取得的模型）"""
+        return self._llm or llm_client.get_agent_llm("teacher_analysis")
     
     def _extract_json_from_response(self, text: str) -> Dict[str, Any]:
         """
@@ -115,10 +129,59 @@ class TeacherAnalysisAgent:
             "analysis_summary": "目前資料不足，需要更多對話紀錄才能進行深入分析。"
         }
     
+    def _build_messages(self, progress: GroupProgress):
+        """建構分析提示"""
+        return prompt_layout.build_messages(
+            TEACHER_ANALYSIS_PROMPT,
+            group_name=progress.group_name,
+            stage_number=progress.stage_number,
+            project_content=progress.project_content or "尚未開始",
+            action_plan=progress.action_plan or "尚未制定",
+            current_progress=progress.current_progress or "尚未評分",
+            message_count=progress.message_count
+        )
+    
+    def _to_analysis(self, progress: GroupProgress, content: str) -> TeacherAnalysis:
+        """將 LLM 回應轉為 TeacherAnalysis"""
+        logger.info(f"[TeacherAnalysisAgent] LLM 回應: {content}")
+        
+        # 解析回應 - 使用更安全的 JSON 提取方法
+        result = self._extract_json_from_response(content)
+        
+        return TeacherAnalysis(
+            group_id=progress.group_id,
+            difficulties=result.get("difficulties", []),
+            suggestions=result.get("suggestions", []),
+            analysis_summary=result.get("analysis_summary", "")
+        )
+    
+    def _failed_analysis(self, progress: GroupProgress, error: Exception) -> TeacherAnalysis:
+        """分析失敗或逾時時的基本分析"""
+        if isinstance(error, DeadlineExceeded):
+            logger.warning(f"[TeacherAnalysisAgent] 分析逾時: {progress.group_name}")
+            metrics.inc("teacher_analysis_timeouts")
+            return TeacherAnalysis(
+                group_id=progress.group_id,
+                difficulties=["分析逾時，尚無結果"],
+                suggestions=["請稍後重新分析此組別"],
+                analysis_summary=f"分析超過 {TeacherAnalysisConfig.GROUP_TIMEOUT:g} 秒未完成，已略過此組別。"
+            )
+        
+        logger.error(f"[TeacherAnalysisAgent] 分析失敗: {error}")
+        metrics.inc("teacher_analysis_errors")
+        return TeacherAnalysis(
+            group_id=progress.group_id,
+            difficulties=["分析過程發生錯誤"],
+            suggestions=["建議檢查系統設定或與技術支援聯繫"],
+            analysis_summary=f"分析過程發生錯誤: {str(error)}"
+        )
+    
     def analyze_group(self, progress: GroupProgress) -> TeacherAnalysis:
         """
         分析單一組別的學習狀況
         
+        每組有獨立的期限（TEACHER_ANALYSIS_GROUP_TIMEOUT），逾時時回傳逾時的分析結果。
+        
         Args:
             progress: GroupProgress 物件，包含組別的進度資訊
             
@@ -126,58 +189,108 @@ class TeacherAnalysisAgent:
             TeacherAnalysis 物件，包含分析結果
         """
         logger.info(f"[TeacherAnalysisAgent] 分析組別: {progress.group_name}")
-        
-        # 建構分析提示
-        prompt = TEACHER_ANALYSIS_PROMPT.format(
-            group_name=progress.group_name,
-            stage_number=progress.stage_number,
-            project_content=progress.project_content or "尚未開始",
-            action_plan=progress.action_plan or "尚未制定",
-            current_progress=progress.current_progress or "尚未評分",
-            message_count=progress.message_count
-        )
+        messages = self._build_messages(progress)
         
         try:
-            # 呼叫 LLM 進行分析
-            response = self.llm.invoke([HumanMessage(content=prompt)])
-            logger.info(f"[TeacherAnalysisAgent] LLM 回應: {response.content}")
-            
-            # 解析回應 - 使用更安全的 JSON 提取方法
-            result = self._extract_json_from_response(response.content)
-            
-            return TeacherAnalysis(
-                group_id=progress.group_id,
-                difficulties=result.get("difficulties", []),
-                suggestions=result.get("suggestions", []),
-                analysis_summary=result.get("analysis_summary", "")
-            )
+            with deadline.use(deadline.start(TeacherAnalysisConfig.GROUP_TIMEOUT)):
+                response = llm_client.invoke("teacher_analysis", messages, llm=self._llm)
+            return self._to_analysis(progress, response.content)
+        except Exception as e:
+            return self._failed_analysis(progress, e)
+    
+    async def aanalyze_group(self, progress: GroupProgress) -> TeacherAnalysis:
+        """analyze_group 的非同步版本，逾時時直接取消該組的呼叫"""
+        logger.info(f"[TeacherAnalysisAgent] 分析組別: {progress.group_name}")
+        messages = self._build_messages(progress)
         
+        try:
+            with deadline.use(deadline.start(TeacherAnalysisConfig.GROUP_TIMEOUT)):
+                response = await deadline.wait(
+                    llm_client.ainvoke("teacher_analysis", messages, llm=self._llm),
+                    "teacher_analysis"
+                )
+            return self._to_analysis(progress, response.content)
         except Exception as e:
-            logger.error(f"[TeacherAnalysisAgent] 分析失敗: {e}")
+            return self._failed_analysis(progress, e)
+    
+    @staticmethod
+    def _concurrency(concurrency: Optional[int], total: int) -> int:
+        return max(1, min(concurrency or TeacherAnalysisConfig.CONCURRENCY, total))
+    
+    def iter_analyses(self, progress_list: List[GroupProgress],
+                      concurrency: Optional[int] = None) -> Iterator[TeacherAnalysis]:
+        """
+        同時分析多個組別，依完成順序逐一回傳結果
+        
+        同時進行的組別數不超過 concurrency（預設 TEACHER_ANALYSIS_CONCURRENCY），
+        每組的呼叫仍經過 llm_client 的快取、重試、斷路器與速率限制；未指定 llm 時
+        每次呼叫依 agent 名稱取得模型（TEACHER_MODEL / TEACHER_PROVIDER）與端點池中的端點，
+        各組可分散到不同端點。
+        
+        Args:
+            progress_list: GroupProgress 列表
+            concurrency: 同時分析的組別數上限
             
-            # 返回基本分析
-            return TeacherAnalysis(
-                group_id=progress.group_id,
-                difficulties=["分析過程發生錯誤"],
-                suggestions=["建議檢查系統設定或與技術支援聯繫"],
-                analysis_summary=f"分析過程發生錯誤: {str(e)}"
-            )
+        Yields:
+            TeacherAnalysis，依完成順序
+        """
+        if not progress_list:
+            return
+        started = time.perf_counter()
+        executor = ThreadPoolExecutor(
+            max_workers=self._concurrency(concurrency, len(progress_list)),
+            thread_name_prefix="teacher-analysis"
+        )
+        try:
+            futures = [executor.submit(self.analyze_group, progress) for progress in progress_list]
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # 呼叫端提前結束時取消尚未開始的組別
+            executor.shutdown(wait=False, cancel_futures=True)
+            metrics.observe("teacher_analysis_batch_seconds", time.perf_counter() - started)
     
-    def analyze_all_groups(self, progress_list: List[GroupProgress]) -> List[TeacherAnalysis]:
+    async def aiter_analyses(self, progress_list: List[GroupProgress],
+                             concurrency: Optional[int] = None) -> AsyncIterator[TeacherAnalysis]:
+        """iter_analyses 的非同步版本"""
+        if not progress_list:
+            return
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self._concurrency(concurrency, len(progress_list)))
+        
+        async def run(progress: GroupProgress) -> TeacherAnalysis:
+            async with semaphore:
+                return await self.aanalyze_group(progress)
+        
+        tasks = [asyncio.create_task(run(progress)) for progress in progress_list]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+            metrics.observe("teacher_analysis_batch_seconds", time.perf_counter() - started)
+    
+    def analyze_all_groups(self, progress_list: List[GroupProgress],
+                           concurrency: Optional[int] = None) -> List[TeacherAnalysis]:
         """
-        分析所有組別的學習狀況
+        分析所有組別的學習狀況（同時進行，見 iter_analyses）
         
         Args:
             progress_list: GroupProgress 列表
+            concurrency: 同時分析的組別數上限
             
         Returns:
-            TeacherAnalysis 列表
+            TeacherAnalysis 列表，順序與 progress_list 相同
         """
-        analyses = []
-        for progress in progress_list:
-            analysis = self.analyze_group(progress)
-            analyses.append(analysis)
-        return analyses
+        by_group = {a.group_id: a for a in self.iter_analyses(progress_list, concurrency)}
+        return [by_group[p.group_id] for p in progress_list]
+    
+    async def aanalyze_all_groups(self, progress_list: List[GroupProgress],
+                                  concurrency: Optional[int] = None) -> List[TeacherAnalysis]:
+        """analyze_all_groups 的非同步版本"""
+        by_group = {a.group_id: a async for a in self.aiter_analyses(progress_list, concurrency)}
+        return [by_group[p.group_id] for p in progress_list]
     
     def compare_groups(self, progress_list: List[GroupProgress]) -> Dict[str, Any]:
         """
@@ -220,12 +333,12 @@ class TeacherAnalysisAgent:
         }
 
 
-def create_teacher_analysis_agent(llm):
+def create_teacher_analysis_agent(llm=None):
     """
     建立教師分析 Agent 實例
     
     Args:
-        llm: Language model instance
+        llm: Language model instance，預設依 TEACHER_MODEL / TEACHER_PROVIDER 取得
         
     Returns:
         TeacherAnalysisAgent 實例
@@ -7,7 +7,6 @@ import logging
 from typing import List
 from group_manager import get_group_manager
 from teacher_analysis_agent import create_teacher_analysis_agent
-from projectflow_graph import llm
 import pandas as pd
 
 # 設定 logging
@@ -18,7 +17,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # 初始化教師分析 Agent
-teacher_agent = create_teacher_analysis_agent(llm)
+teacher_agent = create_teacher_analysis_agent()
 
 
 def get_all_groups_overview():
@@ -130,22 +129,9 @@ def analyze_group(group_id: str):
     return result
 
 
-def analyze_all_groups():
-    """分析所有組別"""
-    group_manager = get_group_manager()
-    progress_list = group_manager.get_all_progress()
-    
-    if not progress_list:
-        return "目前沒有組別資料"
-    
-    analyses = teacher_agent.analyze_all_groups(progress_list)
-    
-    results = ["# 所有組別分析報告\n"]
-    
-    for analysis in analyses:
-        progress = next((p for p in progress_list if p.group_id == analysis.group_id), None)
-        if progress:
-            results.append(f"""
+def _format_group_analysis(progress, analysis) -> str:
+    """單一組別在分析報告中的段落"""
+    return f"""
 ## {progress.group_name} ({progress.group_id})
 
 **當前階段**: 階段 {progress.stage_number} | **對話數**: {progress.message_count}
@@ -157,9 +143,31 @@ def analyze_all_groups():
 {chr(10).join(f"- {suggestion}" for suggestion in analysis.suggestions)}
 
 ---
-""")
+"""
+
+
+def analyze_all_groups():
+    """分析所有組別（同時分析，每完成一組就更新報告）"""
+    group_manager = get_group_manager()
+    progress_list = group_manager.get_all_progress()
     
-    return "\n".join(results)
+    if not progress_list:
+        yield "目前沒有組別資料"
+        return
+    
+    total = len(progress_list)
+    yield f"# 所有組別分析報告\n\n分析中... (0/{total})"
+    
+    by_group = {p.group_id: p for p in progress_list}
+    sections = {}
+    for analysis in teacher_agent.iter_analyses(progress_list):
+        progress = by_group.get(analysis.group_id)
+        if progress:
+            sections[analysis.group_id] = _format_group_analysis(progress, analysis)
+        status = "" if len(sections) == total else f"\n分析中... ({len(sections)}/{total})\n"
+        # 依組別原本的順序排列已完成的結果
+        ordered = [sections[p.group_id] for p in progress_list if p.group_id in sections]
+        yield "\n".join(["# 所有組別分析報告\n", status, *ordered])
 
 
 def create_new_group(group_id: str, group_name: str, students: str):
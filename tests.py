@@ -14,6 +14,7 @@ sys.path.insert(0, str(Path(__file__).parent))
 import unittest
 from unittest.mock import Mock, patch
 import json
+import time
 
 # 導入要測試的模組
 from utils import (
@@ -257,6 +258,1623 @@ class TestPrompts(unittest.TestCase):
         self.assertGreater(len(prompts.RESPONSE_AGENT_PROMPT), 0)
 
 
+class TestLLMClient(unittest.TestCase):
+    """測試 LLM 客戶端工廠"""
+    
+    def test_get_llm_reuses_instance(self):
+        """測試相同參數取得同一個實例並共用連線池"""
+        import llm_client
+        with patch.object(llm_client.LLMConfig, 'AZURE_API_KEY', 'test-key'):
+            llm_a = llm_client.get_llm(provider="openai", endpoint="http://test.com")
+            llm_b = llm_client.get_llm(provider="openai", endpoint="http://test.com")
+            llm_c = llm_client.get_llm(provider="openai", endpoint="http://test.com", temperature=0.7)
+        self.assertIs(llm_a, llm_b)
+        self.assertIsNot(llm_a, llm_c)
+        self.assertIs(llm_a.http_client, llm_c.http_client)
+        self.assertEqual(llm_a.openai_api_base, "http://test.com/v1")
+    
+    def test_agent_model_routing(self):
+        """測試各 agent 依設定使用不同模型的實例"""
+        import llm_client
+        routes = {"summary_agent": {"provider": "openai", "model": "small-model"}}
+        with patch.object(llm_client.LLMConfig, 'AZURE_API_KEY', 'test-key'), \
+                patch.object(llm_client.LLMConfig, 'AZURE_ENDPOINT', 'http://test.com'), \
+                patch.object(llm_client.LLMConfig, 'PROVIDER', 'openai'), \
+                patch.dict(llm_client.LLMConfig.AGENT_MODELS, routes):
+            summary_llm = llm_client.get_agent_llm("summary_agent")
+            response_llm = llm_client.get_agent_llm("response_agent")
+        self.assertEqual(summary_llm.model_name, "small-model")
+        self.assertEqual(response_llm.model_name, llm_client.LLMConfig.DEPLOYMENT)
+        self.assertIsNot(summary_llm, response_llm)
+    
+    def test_unsupported_provider(self):
+        """測試不支援的提供者"""
+        import llm_client
+        with self.assertRaises(ValueError):
+            llm_client.create_llm(provider="unknown")
+
+
+class TestLLMCache(unittest.TestCase):
+    """測試兩層 LLM 回應快取"""
+    
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "cache.sqlite3")
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+    
+    def test_key_depends_on_model_and_temperature(self):
+        """測試快取鍵包含模型與溫度"""
+        from llm_cache import LLMCache
+        key = LLMCache.make_key("openai", "gpt-4o", 0, "prompt")
+        self.assertEqual(key, LLMCache.make_key("openai", "gpt-4o", 0, "prompt"))
+        self.assertNotEqual(key, LLMCache.make_key("openai", "gpt-4o-mini", 0, "prompt"))
+        self.assertNotEqual(key, LLMCache.make_key("openai", "gpt-4o", 0.7, "prompt"))
+    
+    def test_memory_lru_eviction(self):
+        """測試記憶體 LRU 淘汰最久未使用的項目"""
+        from llm_cache import LLMCache
+        cache = LLMCache(max_memory_entries=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+        self.assertEqual(cache.get("a"), "1")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["misses"], 1)
+    
+    def test_disk_persists_across_instances(self):
+        """測試磁碟快取在新實例中仍可讀取"""
+        from llm_cache import LLMCache
+        cache = LLMCache(path=self.db_path)
+        cache.set("k", "value")
+        cache.close()
+        reopened = LLMCache(path=self.db_path)
+        self.assertEqual(reopened.get("k"), "value")
+        self.assertEqual(reopened.stats()["disk_hits"], 1)
+        reopened.close()
+    
+    def test_ttl_expiry(self):
+        """測試過期項目不會被回傳"""
+        from llm_cache import LLMCache
+        cache = LLMCache(path=self.db_path, ttl_seconds=10)
+        with patch("llm_cache.time.time", return_value=1000.0):
+            cache.set("k", "value")
+        with patch("llm_cache.time.time", return_value=1011.0):
+            self.assertIsNone(cache.get("k"))
+        cache.close()
+    
+    def test_disk_size_eviction(self):
+        """測試磁碟筆數超過上限時淘汰"""
+        from llm_cache import LLMCache
+        cache = LLMCache(path=self.db_path, max_memory_entries=1, max_disk_entries=2)
+        for i in range(4):
+            cache.set(f"k{i}", str(i))
+        self.assertEqual(cache.stats()["disk_entries"], 2)
+        cache.close()
+    
+    def test_invoke_uses_cache_for_enabled_agent(self):
+        """測試啟用快取的 agent 重複 prompt 只呼叫一次 LLM"""
+        import llm_client
+        from llm_cache import LLMCache
+        from langchain_core.messages import AIMessage, HumanMessage
+        llm = Mock(spec=["invoke", "temperature", "model_name"])
+        llm.temperature = 0
+        llm.model_name = "test-model"
+        llm.invoke.return_value = AIMessage(content="回覆")
+        with patch.object(llm_client, "_cache", LLMCache()), \
+                patch.object(llm_client.CacheConfig, "ENABLED", True):
+            first = llm_client.invoke("decision_agent", [HumanMessage(content="同樣的 prompt")], llm=llm)
+            second = llm_client.invoke("decision_agent", [HumanMessage(content="同樣的 prompt")], llm=llm)
+            llm_client.invoke("response_agent", [HumanMessage(content="同樣的 prompt")], llm=llm)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(llm.invoke.call_count, 2)
+
+
+class TestMetrics(unittest.TestCase):
+    """測試執行指標"""
+    
+    def setUp(self):
+        import metrics
+        metrics.reset()
+    
+    def test_counter_with_labels(self):
+        """測試計數器依標籤分開累計"""
+        import metrics
+        metrics.inc("calls", agent="a")
+        metrics.inc("calls", 2, agent="a")
+        metrics.inc("calls", agent="b")
+        self.assertEqual(metrics.get_counter("calls", agent="a"), 3)
+        self.assertIn("calls{agent=b}", metrics.snapshot()["counters"])
+    
+    def test_percentile(self):
+        """測試分布統計的百分位數"""
+        import metrics
+        for value in range(1, 101):
+            metrics.observe("latency", value)
+        self.assertEqual(metrics.percentile("latency", 50), 50)
+        self.assertEqual(metrics.percentile("latency", 99), 99)
+        self.assertIsNone(metrics.percentile("unknown", 50))
+
+
+class TestRateLimiter(unittest.TestCase):
+    """測試 RPM/TPM 速率限制"""
+    
+    def test_token_bucket_queues_instead_of_failing(self):
+        """測試額度不足時回傳等待秒數，後到的請求等待更久"""
+        from rate_limiter import TokenBucket
+        bucket = TokenBucket(per_minute=60)  # 每秒 1 個
+        self.assertEqual(bucket.reserve(60, now=bucket.updated), 0.0)
+        self.assertAlmostEqual(bucket.reserve(1, now=bucket.updated), 1.0)
+        self.assertAlmostEqual(bucket.reserve(1, now=bucket.updated), 2.0)
+    
+    def test_token_bucket_refills(self):
+        """測試額度隨時間補充"""
+        from rate_limiter import TokenBucket
+        bucket = TokenBucket(per_minute=60)
+        start = bucket.updated
+        bucket.reserve(60, now=start)
+        self.assertEqual(bucket.reserve(5, now=start + 5), 0.0)
+    
+    def test_limiter_uses_max_of_rpm_and_tpm(self):
+        """測試同時受 RPM 與 TPM 限制時取較長的等待"""
+        from rate_limiter import RateLimiter
+        limiter = RateLimiter("test", rpm=600, tpm=600)
+        self.assertEqual(limiter.reserve(600), 0.0)
+        # 請求額度充足，但 token 額度需再等 60 個 token (6 秒)
+        self.assertAlmostEqual(limiter.reserve(60), 6.0, places=1)
+    
+    def test_disabled_limiter(self):
+        """測試未設定上限時不等待"""
+        from rate_limiter import RateLimiter
+        limiter = RateLimiter("test")
+        self.assertFalse(limiter.enabled)
+        self.assertEqual(limiter.acquire(10 ** 6), 0.0)
+
+
+class TestEndpointPool(unittest.TestCase):
+    """測試多端點負載平衡與健康檢查"""
+    
+    def test_weighted_least_outstanding(self):
+        """測試依權重分配進行中的請求"""
+        from endpoint_pool import EndpointPool
+        pool = EndpointPool([("a", 2.0), ("b", 1.0)])
+        picked = [pool.acquire().url for _ in range(3)]
+        self.assertEqual(picked.count("a"), 2)
+        self.assertEqual(picked.count("b"), 1)
+    
+    def test_eject_after_consecutive_failures(self):
+        """測試連續失敗後剔除，並將流量導向其他端點"""
+        from endpoint_pool import EndpointPool
+        pool = EndpointPool([("a", 1.0), ("b", 1.0)], eject_consecutive_failures=2)
+        a = pool.endpoints[0]
+        for _ in range(2):
+            pool.release(pool.acquire(exclude=pool.endpoints[1]), 0.1, error=True)
+        self.assertTrue(pool.stats()[0]["ejected"])
+        self.assertEqual({pool.acquire().url for _ in range(4)}, {"b"})
+        # 剔除期滿後重新加入
+        a.ejected_until = 0.0
+        self.assertFalse(pool.stats()[0]["ejected"])
+    
+    def test_eject_slow_endpoint(self):
+        """測試延遲遠高於其他端點時剔除"""
+        from endpoint_pool import EndpointPool
+        pool = EndpointPool([("a", 1.0), ("b", 1.0), ("c", 1.0)], min_requests=2, ewma_alpha=1.0)
+        fast_b, fast_c, slow = pool.endpoints[1], pool.endpoints[2], pool.endpoints[0]
+        for endpoint, latency in ((fast_b, 0.1), (fast_c, 0.1), (slow, 1.0), (slow, 1.0)):
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            pool.release(endpoint, latency)
+        self.assertTrue(pool.stats()[0]["ejected"])
+    
+    def test_never_eject_last_endpoint(self):
+        """測試不會剔除最後一個可用端點"""
+        from endpoint_pool import EndpointPool
+        pool = EndpointPool([("a", 1.0)], eject_consecutive_failures=1)
+        pool.release(pool.acquire(), 0.1, error=True)
+        self.assertFalse(pool.stats()[0]["ejected"])
+        self.assertEqual(pool.acquire().url, "a")
+    
+    def test_client_errors_do_not_count(self):
+        """測試 4xx 請求錯誤不影響端點健康分數"""
+        import llm_client
+        bad_request = Exception("bad request")
+        bad_request.status_code = 400
+        overloaded = Exception("overloaded")
+        overloaded.status_code = 503
+        self.assertFalse(llm_client._is_provider_error(bad_request))
+        self.assertTrue(llm_client._is_provider_error(overloaded))
+        self.assertTrue(llm_client._is_provider_error(TimeoutError()))
+
+
+class TestHedging(unittest.TestCase):
+    """測試對沖請求"""
+    
+    def setUp(self):
+        import metrics
+        metrics.reset()
+    
+    def _slow_primary(self, index):
+        time.sleep(0.3 if index == 0 else 0.01)
+        return f"attempt-{index}"
+    
+    def test_delay_requires_samples(self):
+        """測試樣本不足或未啟用時不對沖"""
+        import metrics
+        from hedging import hedge_delay
+        from config import HedgeConfig
+        with patch.object(HedgeConfig, "ENABLED", True), patch.object(HedgeConfig, "MIN_SAMPLES", 3), \
+                patch.object(HedgeConfig, "MIN_DELAY", 0.0):
+            self.assertIsNone(hedge_delay("response_agent"))
+            for value in (1.0, 2.0, 3.0):
+                metrics.observe("llm_latency_seconds", value, agent="response_agent")
+            self.assertEqual(hedge_delay("response_agent"), 3.0)
+            self.assertIsNone(hedge_delay("summary_agent"))
+    
+    def test_hedged_call_takes_faster(self):
+        """測試原始請求過慢時採用對沖請求的結果"""
+        import metrics
+        from hedging import hedged_call
+        self.assertEqual(hedged_call("response_agent", self._slow_primary, 0.05, input_tokens=10), "attempt-1")
+        self.assertEqual(metrics.get_counter("llm_hedges", agent="response_agent"), 1)
+        self.assertEqual(metrics.get_counter("llm_hedge_wins", agent="response_agent"), 1)
+        self.assertEqual(metrics.get_gauge("llm_hedge_rate", agent="response_agent"), 1.0)
+    
+    def test_no_hedge_when_fast(self):
+        """測試原始請求在門檻內完成時不送出對沖請求"""
+        import metrics
+        from hedging import hedged_call
+        self.assertEqual(hedged_call("response_agent", lambda i: f"attempt-{i}", 1.0), "attempt-0")
+        self.assertEqual(metrics.get_counter("llm_hedges", agent="response_agent"), 0)
+    
+    def test_async_hedge_cancels_loser(self):
+        """測試非同步對沖會取消較慢的請求並記錄額外 token"""
+        import asyncio
+        import metrics
+        from hedging import ahedged_call
+        cancelled = []
+        
+        async def attempt(index):
+            try:
+                await asyncio.sleep(0.3 if index == 0 else 0.01)
+            except asyncio.CancelledError:
+                cancelled.append(index)
+                raise
+            return f"attempt-{index}"
+        
+        async def run():
+            result = await ahedged_call("response_agent", attempt, 0.05, input_tokens=10)
+            await asyncio.sleep(0)
+            return result
+        
+        self.assertEqual(asyncio.run(run()), "attempt-1")
+        self.assertEqual(cancelled, [0])
+        self.assertEqual(metrics.get_counter("llm_hedge_extra_tokens", agent="response_agent"), 10)
+    
+    def test_hedged_stream_uses_first_chunk(self):
+        """測試串流以第一個 chunk 決定勝出者，只輸出勝出者的內容"""
+        from hedging import hedged_stream
+        
+        def attempt(index):
+            time.sleep(0.3 if index == 0 else 0.01)
+            for part in ("a", "b"):
+                yield f"{index}{part}"
+        
+        self.assertEqual(list(hedged_stream("response_agent", attempt, 0.05)), ["1a", "1b"])
+
+
+def _import_graph():
+    """匯入 projectflow_graph（模組載入時會建立預設 LLM，測試時提供假的連線設定）"""
+    from config import LLMConfig
+    with patch.object(LLMConfig, "AZURE_ENDPOINT", LLMConfig.AZURE_ENDPOINT or "http://localhost:1"), \
+            patch.object(LLMConfig, "AZURE_API_KEY", LLMConfig.AZURE_API_KEY or "test"):
+        import projectflow_graph
+    return projectflow_graph
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """測試 LLM 斷路器與備援回覆"""
+    
+    def test_opens_after_consecutive_failures(self):
+        """測試連續失敗後開啟並立即拒絕呼叫"""
+        from circuit_breaker import CircuitBreaker, CircuitOpenError
+        breaker = CircuitBreaker("test", consecutive_failures=2, open_seconds=60)
+        for _ in range(2):
+            breaker.allow()
+            breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()
+    
+    def test_opens_on_failure_rate(self):
+        """測試視窗內錯誤率達門檻時開啟"""
+        from circuit_breaker import CircuitBreaker
+        breaker = CircuitBreaker("test", failure_rate=0.5, min_calls=4, consecutive_failures=100)
+        for ok in (True, False, True, False):
+            breaker.record_success() if ok else breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+    
+    def test_half_open_recovers(self):
+        """測試開啟期滿後放行一次試探呼叫，成功即恢復"""
+        from circuit_breaker import CircuitBreaker, CircuitOpenError
+        breaker = CircuitBreaker("test", consecutive_failures=1, open_seconds=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, "half_open")
+        breaker.allow()
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+    
+    def test_fallback_reply_uses_stage(self):
+        """測試備援回覆包含目前階段名稱與核心問題"""
+        import yaml
+        build_fallback_reply = _import_graph().build_fallback_reply
+        with open("prompts/stage_setting.yaml", encoding="utf-8") as f:
+            stage = yaml.safe_load(f)["stage_2"]
+        reply = build_fallback_reply({"stage_number": 2})
+        self.assertIn(stage["name"], reply)
+        self.assertIn(stage["main_issue"], reply)
+    
+    def test_response_agent_falls_back_when_open(self):
+        """測試斷路器開啟時 response_agent 改用備援回覆"""
+        projectflow_graph = _import_graph()
+        from circuit_breaker import CircuitOpenError
+        state = {"messages": [], "stage_number": 1, "project_content": "", "action_plan": "",
+                 "guidance_strategy": ""}
+        with patch.object(projectflow_graph.llm_client, "invoke", side_effect=CircuitOpenError("test", 30)):
+            state = projectflow_graph.response_agent(state)
+        self.assertIn("階段一", state["messages"][-1].content)
+
+
+class TestFusedSummaryScore(unittest.TestCase):
+    """測試合併的 summary_score_agent"""
+    
+    def _state(self, **kwargs):
+        from langchain_core.messages import HumanMessage
+        state = {"messages": [HumanMessage(content="我想減少剩食")], "stage_number": 1,
+                 "project_content": "", "action_plan": "", "historical_log": "", "current_progress": "舊評分"}
+        state.update(kwargs)
+        return state
+    
+    def test_single_call_updates_summary_and_score(self):
+        """測試一次呼叫同時更新摘要欄位與評分"""
+        graph = _import_graph()
+        from langchain_core.messages import AIMessage
+        reply = AIMessage(content=json.dumps([{
+            "project_content": "剩食計畫", "ACTION_PLAN": "訪談", "HISTORICAL_LOG": "階段一",
+            "stage_number": 1, "current_progress": "新評分"}], ensure_ascii=False))
+        with patch.object(graph.llm_client, "invoke", return_value=reply) as invoke:
+            state = graph.summary_score_agent(self._state())
+        self.assertEqual(invoke.call_count, 1)
+        self.assertEqual(invoke.call_args[0][0], "summary_score_agent")
+        self.assertEqual(state["project_content"], "剩食計畫")
+        self.assertEqual(state["current_progress"], "新評分")
+    
+    def test_stage_change_rebuilds_progress(self):
+        """測試階段改變時採用新階段的評分表，而非模型對舊階段的評分"""
+        graph = _import_graph()
+        from langchain_core.messages import AIMessage
+        reply = AIMessage(content=json.dumps([{"stage_number": 2, "current_progress": "舊階段評分"}],
+                                             ensure_ascii=False))
+        state = graph._finish_summary_score(self._state(), reply)
+        self.assertEqual(state["stage_number"], 2)
+        self.assertNotEqual(state["current_progress"], "舊階段評分")
+    
+    def test_graph_uses_fused_edge(self):
+        """測試傳入 summary_score 時背景 workflow 只有一個節點"""
+        graph = _import_graph()
+        bookkeeping = graph.build_bookkeeping_graph_builder(
+            graph.summary_agent, graph.score_agent, graph.summary_score_agent)
+        self.assertEqual(set(bookkeeping.nodes), {"summary_score_agent"})
+
+
+class TestStructuredOutput(unittest.TestCase):
+    """測試提供者原生結構化輸出模式"""
+    
+    def test_openai_binds_json_schema(self):
+        """測試 OpenAI 相容模型綁定 json_schema，假 LLM 則維持原樣"""
+        import llm_client
+        from langchain_openai import ChatOpenAI
+        from models import ScoreOutput
+        llm = ChatOpenAI(model="gpt-4o-mini", base_url="http://localhost:1/v1", api_key="test")
+        with patch('config.LLMConfig.STRUCTURED_OUTPUT', True):
+            bound = llm_client._with_schema(llm, ScoreOutput)
+            fake = llm_client.create_llm(provider="fake")
+            self.assertIs(llm_client._with_schema(fake, ScoreOutput), fake)
+        self.assertIs(bound.kwargs["response_format"], ScoreOutput)
+        with patch('config.LLMConfig.STRUCTURED_OUTPUT', False):
+            self.assertIs(llm_client._with_schema(llm, ScoreOutput), llm)
+    
+    def test_invoke_sends_schema_and_separates_cache(self):
+        """測試 invoke 帶 schema 時送出 response_format，且與一般輸出使用不同的請求合併鍵"""
+        import llm_client
+        from langchain_core.messages import AIMessage, HumanMessage
+        from langchain_openai import ChatOpenAI
+        from models import DecisionOutput
+        llm = ChatOpenAI(model="structured-test", base_url="http://localhost:1/v1", api_key="test")
+        messages = [HumanMessage(content="DecideG")]
+        reply = AIMessage(content='{"Guidance_and_Strategy": "提問"}')
+        with patch('config.LLMConfig.STRUCTURED_OUTPUT', True), \
+                patch.object(ChatOpenAI, "invoke", return_value=reply) as call:
+            response = llm_client.invoke("decision_agent", messages, llm=llm, schema=DecisionOutput)
+            bound = llm_client._with_schema(llm, DecisionOutput)
+        self.assertEqual(response.content, reply.content)
+        self.assertIs(call.call_args.kwargs["response_format"], DecisionOutput)
+        self.assertNotEqual(llm_client._request_text(bound, messages), llm_client._request_text(llm, messages))
+    
+    def test_parse_validates_schema_then_falls_back(self):
+        """測試結構化輸出以 schema 驗證，不符合時改用文字解析"""
+        graph = _import_graph()
+        from models import ScoreOutput
+        with patch('config.LLMConfig.STRUCTURED_OUTPUT', True):
+            self.assertEqual(graph.parse_agent_output("score_agent", '{"current_progress": "3 分"}', ScoreOutput),
+                             {"current_progress": "3 分"})
+            self.assertEqual(
+                graph.parse_agent_output("score_agent", '說明 [{"current_progress": "4 分"}]', ScoreOutput),
+                {"current_progress": "4 分"})
+        self.assertEqual(graph.parse_agent_output("score_agent", "無法解析", ScoreOutput), {})
+
+
+class TestOutputBudget(unittest.TestCase):
+    """測試輸出 token 上限與截斷偵測"""
+    
+    def test_budget_shrinks_under_load(self):
+        """測試 response_agent 的上限隨進行中的呼叫數縮減"""
+        import llm_client
+        from config import OutputBudgetConfig
+        with patch.dict(OutputBudgetConfig.MAX_TOKENS, {"response_agent": 1000, "summary_agent": 4000}), \
+                patch.multiple(OutputBudgetConfig, MIN_TOKENS=200, LOAD_LOW=10, LOAD_HIGH=30):
+            with patch.object(llm_client, "_in_flight", 0):
+                self.assertEqual(llm_client.output_budget("response_agent"), 1000)
+            with patch.object(llm_client, "_in_flight", 20):
+                self.assertEqual(llm_client.output_budget("response_agent"), 600)
+                self.assertEqual(llm_client.output_budget("summary_agent"), 4000)
+            with patch.object(llm_client, "_in_flight", 100):
+                self.assertEqual(llm_client.output_budget("response_agent"), 200)
+    
+    def test_truncated_response_counted_and_not_cached(self):
+        """測試截斷的回應會被計數且不寫入快取"""
+        import llm_client
+        import metrics
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import HumanMessage
+        metrics.reset()
+        llm = FakeChatModel(model_name="budget-test", output_length=200)
+        with patch.object(llm_client, "_cache_store") as store:
+            response = llm_client.invoke("score_agent", [HumanMessage(content="BuddyG")], llm=llm, max_tokens=20)
+        self.assertEqual(len(response.content), 20)
+        self.assertTrue(llm_client.is_truncated(response))
+        self.assertEqual(metrics.get_counter("llm_truncated", agent="score_agent"), 1)
+        store.assert_not_called()
+    
+    def test_truncated_summary_not_applied(self):
+        """測試被截斷的摘要輸出不寫入 state"""
+        graph = _import_graph()
+        from langchain_core.messages import AIMessage
+        state = {"messages": [], "stage_number": 1, "project_content": "原本內容", "current_progress": "x"}
+        truncated = AIMessage(content='[{"project_content": "寫到一半', response_metadata={"finish_reason": "length"})
+        self.assertEqual(graph._finish_summary(state, truncated)["project_content"], "原本內容")
+    
+    def test_stream_marks_truncated_reply(self):
+        """測試串流回覆被截斷時附加結尾並寫回 state"""
+        graph = _import_graph()
+        from fake_llm import FakeChatModel
+        state = {"messages": [], "stage_number": 1, "project_content": "", "action_plan": "",
+                 "guidance_strategy": ""}
+        llm = FakeChatModel(model_name="budget-stream", output_length=200)
+        with patch.object(graph.llm_client, "get_agent_llm", return_value=llm), \
+                patch.object(graph.llm_client, "output_budget", return_value=30):
+            text = "".join(graph.stream_response_agent(state))
+        self.assertTrue(text.endswith(graph.TRUNCATION_SUFFIX))
+        self.assertEqual(state["messages"][-1].content, text)
+
+
+class TestDeadline(unittest.TestCase):
+    """測試每輪對話期限"""
+    
+    def test_check_and_timeout(self):
+        """測試未設期限時不限制，期限已過時拋出 DeadlineExceeded"""
+        import deadline
+        self.assertIsNone(deadline.remaining())
+        self.assertEqual(deadline.timeout(60), 60)
+        deadline.check("test")
+        with deadline.use(deadline.start(0.05)):
+            self.assertLessEqual(deadline.timeout(60), 0.05)
+            time.sleep(0.06)
+            with self.assertRaises(deadline.DeadlineExceeded):
+                deadline.check("test")
+        self.assertIsNone(deadline.start(0))
+    
+    def test_rate_limiter_rejects_beyond_remaining(self):
+        """測試排隊時間超過剩餘時間時不等待也不佔用額度"""
+        from rate_limiter import RateLimiter
+        limiter = RateLimiter("test", rpm=60)
+        self.assertEqual(limiter.acquire(0), 0.0)
+        for _ in range(59):
+            limiter.reserve(0)
+        self.assertIsNone(limiter.acquire(0, max_wait=0.5))
+        self.assertAlmostEqual(limiter.reserve(0), 1.0, places=1)
+    
+    def test_invoke_bounded_by_remaining_time(self):
+        """測試呼叫的逾時不超過剩餘時間，逾期時拋出 DeadlineExceeded"""
+        import deadline
+        import llm_client
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import HumanMessage
+        llm = FakeChatModel(model_name="deadline-test", latency_ms=500)
+        started = time.monotonic()
+        with deadline.use(deadline.start(0.1)):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                llm_client.invoke("response_agent", [HumanMessage(content="BuddyG")], llm=llm)
+        self.assertLess(time.monotonic() - started, 0.4)
+    
+    def test_ainvoke_cancelled_at_deadline(self):
+        """測試非同步呼叫在期限到時被取消"""
+        import asyncio
+        import deadline
+        import llm_client
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import HumanMessage
+        llm = FakeChatModel(model_name="deadline-async", latency_ms=500)
+        
+        async def call():
+            with deadline.use(deadline.start(0.1)):
+                return await llm_client.ainvoke("response_agent", [HumanMessage(content="BuddyG")], llm=llm)
+        
+        started = time.monotonic()
+        with self.assertRaises(deadline.DeadlineExceeded):
+            asyncio.run(call())
+        self.assertLess(time.monotonic() - started, 0.4)
+    
+    def test_stream_graph_falls_back_at_deadline(self):
+        """測試逾期時決策沿用原策略、串流回覆改用備援回覆並寫回 state"""
+        graph = _import_graph()
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import HumanMessage
+        state = {"messages": [HumanMessage(content="垃圾問題")], "stage_number": 1, "project_content": "",
+                 "action_plan": "", "historical_log": "", "current_progress": "", "guidance_strategy": "原策略",
+                 "session_id": "deadline-test"}
+        llm = FakeChatModel(model_name="deadline-graph", latency_ms=300)
+        with patch.object(graph.llm_client, "get_agent_llm", return_value=llm), \
+                patch.object(graph.LLMConfig, "TURN_DEADLINE", 0.2), \
+                patch.object(graph.background_tool, "run_async") as background:
+            text = "".join(graph.stream_graph(state))
+        self.assertIn("階段一", text)
+        self.assertEqual(state["guidance_strategy"], "原策略")
+        self.assertEqual(state["messages"][-1].content, text)
+        # 背景工作在期限外執行
+        background.assert_called_once()
+
+
+class TestRetry(unittest.TestCase):
+    """測試 LLM 重試策略"""
+    
+    class _StatusError(Exception):
+        def __init__(self, status_code, headers=None):
+            super().__init__(f"status {status_code}")
+            self.status_code = status_code
+            self.response = Mock(headers=headers or {})
+    
+    def test_retryable_rules(self):
+        """測試只重試逾時、連線錯誤、429 與 5xx"""
+        import retry
+        from circuit_breaker import CircuitOpenError
+        from deadline import DeadlineExceeded
+        from fake_llm import FakeLLMError, FakeLLMTimeout
+        for error in (self._StatusError(429), self._StatusError(503), FakeLLMError("x"), FakeLLMTimeout("x"),
+                      TimeoutError()):
+            self.assertTrue(retry.is_retryable(error), error)
+        for error in (self._StatusError(400), self._StatusError(401), ValueError("x"),
+                      CircuitOpenError("test", 30), DeadlineExceeded("test")):
+            self.assertFalse(retry.is_retryable(error), error)
+    
+    def test_retry_after_header(self):
+        """測試讀取 retry-after-ms 與 retry-after"""
+        import retry
+        self.assertEqual(retry.retry_after(self._StatusError(429, {"retry-after-ms": "1500"})), 1.5)
+        self.assertEqual(retry.retry_after(self._StatusError(429, {"retry-after": "3"})), 3.0)
+        self.assertIsNone(retry.retry_after(self._StatusError(429)))
+    
+    def test_backoff_full_jitter(self):
+        """測試退避時間在 0 ~ 指數上限之間"""
+        import retry
+        from config import RetryConfig
+        with patch.multiple(RetryConfig, BASE_DELAY=0.5, MAX_DELAY=4):
+            delays = [retry.backoff(3) for _ in range(200)]
+        self.assertTrue(all(0 <= d <= 4 for d in delays))
+        self.assertGreater(max(delays) - min(delays), 1)
+    
+    def test_next_delay_honors_limits(self):
+        """測試重試次數上限、Retry-After 上限與本輪剩餘時間"""
+        import deadline
+        import metrics
+        import retry
+        from config import RetryConfig
+        metrics.reset()
+        with patch.multiple(RetryConfig, ENABLED=True, MAX_RETRIES=2, BASE_DELAY=0.01, MAX_RETRY_AFTER=10):
+            self.assertIsNotNone(retry.next_delay("a", self._StatusError(503), 0))
+            self.assertIsNone(retry.next_delay("a", self._StatusError(503), 2))
+            self.assertGreaterEqual(retry.next_delay("a", self._StatusError(429, {"retry-after": "2"}), 0), 2)
+            self.assertIsNone(retry.next_delay("a", self._StatusError(429, {"retry-after": "60"}), 0))
+            with deadline.use(deadline.start(1)):
+                self.assertIsNone(retry.next_delay("a", self._StatusError(429, {"retry-after": "2"}), 0))
+        self.assertEqual(metrics.get_counter("llm_retries", agent="a", reason="503"), 1)
+        self.assertEqual(metrics.get_counter("llm_retry_exhausted", agent="a"), 1)
+    
+    def test_invoke_retries_transient_errors(self):
+        """測試 invoke 重試暫時性錯誤後成功"""
+        import llm_client
+        from config import RetryConfig
+        from fake_llm import FakeChatModel, FakeLLMError
+        from langchain_core.messages import HumanMessage
+        llm = FakeChatModel(model_name="retry-test")
+        original = FakeChatModel._generate
+        calls = []
+        
+        def flaky(self, *args, **kwargs):
+            calls.append(1)
+            if len(calls) < 3:
+                raise FakeLLMError("503")
+            return original(self, *args, **kwargs)
+        
+        with patch.multiple(RetryConfig, ENABLED=True, MAX_RETRIES=2, BASE_DELAY=0.01), \
+                patch.object(FakeChatModel, "_generate", flaky), \
+                patch.object(llm_client, "_allow", return_value=None):
+            response = llm_client.invoke("score_agent", [HumanMessage(content="BuddyG")], llm=llm)
+        self.assertTrue(response.content)
+        self.assertEqual(len(calls), 3)
+    
+    def test_stream_not_retried_after_output(self):
+        """測試串流已輸出內容後的錯誤不重試"""
+        import retry
+        from config import RetryConfig
+        from fake_llm import FakeLLMError
+        attempts = []
+        
+        def attempt(index):
+            attempts.append(index)
+            yield "a"
+            raise FakeLLMError("503")
+        
+        with patch.multiple(RetryConfig, ENABLED=True, MAX_RETRIES=2, BASE_DELAY=0.01):
+            with self.assertRaises(FakeLLMError):
+                list(retry.stream("a", attempt))
+        self.assertEqual(attempts, [0])
+
+
+class TestLazyStartup(unittest.TestCase):
+    """測試提供者套件與 workflow 延後載入"""
+    
+    def test_import_does_not_load_providers(self):
+        """測試匯入 projectflow_graph 時不載入提供者套件與 langgraph"""
+        import subprocess
+        code = (
+            "import sys, projectflow_graph; "
+            "print(','.join(m for m in ('langchain_openai', 'langchain_google_vertexai', 'langgraph') "
+            "if m in sys.modules))"
+        )
+        env = dict(os.environ, LLM_PROVIDER="fake", LOG_LEVEL="WARNING", MODULE_LOG_LEVEL="WARNING")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "")
+    
+    def test_graph_built_once_on_first_use(self):
+        """測試 workflow 於第一次存取時編譯並重複使用"""
+        graph = _import_graph()
+        self.assertIs(graph.get_graph("bookkeeping_graph"), graph.bookkeeping_graph)
+        with self.assertRaises(AttributeError):
+            graph.not_a_graph
+
+
+class TestForegroundReply(unittest.TestCase):
+    """測試前景 decision_agent → response_agent 直接回傳回覆"""
+    
+    def _state(self, session_id):
+        from langchain_core.messages import HumanMessage
+        return {"messages": [HumanMessage(content="我想解決校園的垃圾問題")], "stage_number": 1,
+                "project_content": "", "action_plan": "", "historical_log": "", "current_progress": "",
+                "guidance_strategy": "", "session_id": session_id}
+    
+    def test_run_graph_returns_reply(self):
+        """測試 run_graph 回傳本輪回覆並寫回 state，背景只執行摘要與評分"""
+        graph = _import_graph()
+        import metrics
+        from fake_llm import FakeChatModel
+        state = self._state("foreground-sync")
+        llm = FakeChatModel(model_name="foreground-sync")
+        before = metrics.sample_count("time_to_reply_seconds", mode="invoke")
+        with patch.object(graph.llm_client, "get_agent_llm", return_value=llm), \
+                patch.object(graph.background_tool, "run_async") as background:
+            reply = graph.run_graph(state)
+            first_turn = state["turn_id"]
+            graph.run_graph(state)
+        self.assertTrue(reply)
+        self.assertTrue(first_turn)
+        self.assertNotEqual(state["turn_id"], first_turn)
+        self.assertNotIn("decision_agent", state)
+        self.assertNotIn("response_agent", state)
+        self.assertEqual(background.call_count, 2)
+        self.assertIs(background.call_args.kwargs["graph"], graph.get_graph("bookkeeping_graph"))
+        self.assertEqual(metrics.sample_count("time_to_reply_seconds", mode="invoke"), before + 2)
+    
+    def test_arun_graph_returns_reply(self):
+        """測試 arun_graph 回傳本輪回覆"""
+        import asyncio
+        graph = _import_graph()
+        from fake_llm import FakeChatModel
+        state = self._state("foreground-async")
+        llm = FakeChatModel(model_name="foreground-async")
+        
+        with patch.object(graph.llm_client, "get_agent_llm", return_value=llm), \
+                patch.object(graph.background_tool, "run_async") as background:
+            reply = asyncio.run(graph.arun_graph(state))
+        self.assertTrue(reply)
+        self.assertEqual(state["messages"][-1].content, reply)
+        background.assert_called_once()
+        self.assertIs(background.call_args.kwargs["graph"], graph.get_graph("bookkeeping_graph"))
+    
+    def test_amain_graph_runs_decision_then_response(self):
+        """測試 amain_graph 依序執行 decision_agent → response_agent，並附加本輪回覆"""
+        import asyncio
+        graph = _import_graph()
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import AIMessage
+        state = self._state("foreground-order")
+        
+        async def events():
+            return [event async for event in graph.get_graph("amain_graph").astream(state)]
+        
+        with patch.object(graph.llm_client, "get_agent_llm", return_value=FakeChatModel(model_name="foreground-order")):
+            result = asyncio.run(events())
+        self.assertEqual([node for event in result for node in event], ["decision_agent", "response_agent"])
+        messages = result[-1]["response_agent"]["messages"]
+        self.assertEqual(len(messages), 2)
+        self.assertIsInstance(messages[-1], AIMessage)
+        self.assertTrue(messages[-1].content)
+    
+    def test_async_agent_error_propagates(self):
+        """測試非降級的錯誤由 arun_graph / astream_graph 拋出，且不送出背景工作"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        graph = _import_graph()
+        
+        async def consume(state):
+            return [delta async for delta in graph.astream_graph(state)]
+        
+        with patch.object(graph.llm_client, "ainvoke", AsyncMock(side_effect=ValueError("boom"))), \
+                patch.object(graph.background_tool, "run_async") as background:
+            with self.assertRaises(ValueError):
+                asyncio.run(graph.arun_graph(self._state("foreground-error")))
+            with self.assertRaises(ValueError):
+                asyncio.run(consume(self._state("foreground-error-stream")))
+        background.assert_not_called()
+    
+    def test_async_degraded_error_uses_fallback_reply(self):
+        """測試斷路器開啟時 arun_graph 以備援回覆結束本輪，仍送出背景工作"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        graph = _import_graph()
+        from circuit_breaker import CircuitOpenError
+        state = self._state("foreground-degraded")
+        with patch.object(graph.llm_client, "ainvoke", AsyncMock(side_effect=CircuitOpenError("test", 30))), \
+                patch.object(graph.background_tool, "run_async") as background:
+            reply = asyncio.run(graph.arun_graph(state))
+        self.assertEqual(reply, graph.build_fallback_reply(state))
+        self.assertEqual(state["messages"][-1].content, reply)
+        background.assert_called_once()
+    
+    def test_astream_graph_appends_reply_and_schedules_background(self):
+        """測試 astream_graph 串流結束後附加完整回覆，並只送出一次背景工作"""
+        import asyncio
+        graph = _import_graph()
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import AIMessage
+        state = self._state("foreground-astream")
+        
+        async def consume():
+            return [delta async for delta in graph.astream_graph(state)]
+        
+        with patch.object(graph.llm_client, "get_agent_llm", return_value=FakeChatModel(model_name="foreground-astream")), \
+                patch.object(graph.background_tool, "run_async") as background:
+            deltas = asyncio.run(consume())
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual(len(state["messages"]), 2)
+        self.assertIsInstance(state["messages"][-1], AIMessage)
+        self.assertEqual(state["messages"][-1].content, "".join(deltas))
+        background.assert_called_once()
+        submitted = background.call_args.args[0]
+        self.assertEqual(submitted["messages"][-1].content, "".join(deltas))
+        self.assertIs(background.call_args.kwargs["graph"], graph.get_graph("bookkeeping_graph"))
+
+
+class TestBackgroundJobs(unittest.TestCase):
+    """測試背景工作登記與去重"""
+    
+    def test_registry_deduplicates_same_turn(self):
+        """測試同一 session 的同一輪只登記一次"""
+        from background_jobs import JobRegistry
+        registry = JobRegistry()
+        self.assertTrue(registry.claim("s1", "t1"))
+        self.assertFalse(registry.claim("s1", "t1"))
+        self.assertTrue(registry.claim("s1", "t2"))
+        self.assertFalse(registry.claim("s1", "t1"))
+        self.assertTrue(registry.claim("s2", "t1"))
+        # 沒有 session_id 或 turn_id 時無法識別，一律放行
+        self.assertTrue(registry.claim(None, "t1"))
+        self.assertTrue(registry.claim(None, "t1"))
+        self.assertTrue(registry.claim("s1", None))
+        self.assertEqual(registry.stats(), {"sessions": 2, "submitted": 6, "deduplicated": 2})
+    
+    def test_registry_keeps_turns_with_same_message_count(self):
+        """測試從舊 pickle 載入、訊息數相同的新一輪不會被當成重複"""
+        import background_jobs
+        from langchain_core.messages import HumanMessage
+        session_id = f"reload-{time.monotonic_ns()}"
+        first = {"session_id": session_id, "messages": [HumanMessage(content="第一輪")],
+                 "turn_id": background_jobs.new_turn_id()}
+        second = dict(first, messages=[HumanMessage(content="第二輪")], turn_id=background_jobs.new_turn_id())
+        self.assertTrue(background_jobs.claim(first))
+        self.assertTrue(background_jobs.claim(second))
+        self.assertFalse(background_jobs.claim(second))
+    
+    def test_registry_bounded(self):
+        """測試記錄的 session 數有上限"""
+        from background_jobs import JobRegistry
+        registry = JobRegistry(max_sessions=2)
+        for session_id in ("a", "b", "c"):
+            registry.claim(session_id, "t1")
+        self.assertEqual(registry.stats()["sessions"], 2)
+        self.assertTrue(registry.claim("a", "t1"))
+    
+    def test_run_async_runs_once_per_turn(self):
+        """測試同一輪重複送出時背景 graph 只執行一次"""
+        import tempfile
+        import threading
+        import background_tool
+        from langchain_core.messages import AIMessage, HumanMessage
+        calls = []
+        done = threading.Event()
+        
+        class Graph:
+            def stream(self, state):
+                calls.append(len(state["messages"]))
+                done.set()
+                return iter(())
+        
+        state = {"messages": [HumanMessage(content="你好"), AIMessage(content="嗨")],
+                 "session_id": f"jobs-{time.monotonic_ns()}", "turn_id": "t1"}
+        path = os.path.join(tempfile.mkdtemp(), "state.pkl")
+        with patch.object(background_tool, "_state_path", return_value=path):
+            self.assertTrue(background_tool.run_async(state.copy(), graph=Graph()))
+            self.assertFalse(background_tool.run_async(state.copy(), graph=Graph()))
+            self.assertTrue(done.wait(5))
+        self.assertEqual(calls, [2])
+
+
+    def test_update_tool_uses_shared_bookkeeping_writer(self):
+        """測試 background_update_tool 以上一個背景結果為起點，記錄結果並寫入組別的 state 檔"""
+        import tempfile
+        import background_jobs
+        import background_tool
+        from langchain_core.messages import AIMessage, HumanMessage
+        
+        class Graph:
+            def stream(self, state):
+                yield {"summary_agent": {"project_content": state["project_content"] + "+"}}
+        
+        session_id = f"tool-{time.monotonic_ns()}"
+        background_jobs.get_registry().remember(session_id, {"project_content": "背景"})
+        groups_dir = tempfile.mkdtemp()
+        with patch.dict(os.environ, {"GROUPS_DIR": groups_dir}), \
+                patch.object(background_tool, "_background_graph", Graph()), \
+                patch.object(background_tool, "_AIMessage", AIMessage), \
+                patch.object(background_tool, "_HumanMessage", HumanMessage):
+            result = background_tool.background_update_tool(session_id, "嗨", "你好", group_id="tool-group")
+            saved = background_tool._load_state(session_id, "tool-group")
+        self.assertTrue(os.path.exists(os.path.join(groups_dir, "tool-group", f"state_{session_id}.pkl")))
+        self.assertEqual(result["project_content"], "背景+")
+        self.assertEqual(background_jobs.get_registry().latest(session_id)["project_content"], "背景+")
+        self.assertEqual(saved["project_content"], "背景+")
+        self.assertEqual([m.type for m in saved["messages"]], ["ai", "human"])
+    
+    def test_later_turn_starts_from_previous_result(self):
+        """測試同一 session 的下一輪以上一輪背景工作的結果為起點，不會覆寫較新的摘要"""
+        import tempfile
+        import threading
+        import background_jobs
+        import background_tool
+        from langchain_core.messages import HumanMessage
+        release = threading.Event()
+        started = threading.Event()
+        seen = []
+        
+        class Graph:
+            def stream(self, state):
+                seen.append(state["project_content"])
+                started.set()
+                release.wait(5)
+                yield {"summary_agent": {"project_content": state["project_content"] + "+"}}
+        
+        session_id = f"lanes-{time.monotonic_ns()}"
+        state = {"messages": [HumanMessage(content="第一輪")], "project_content": "",
+                 "session_id": session_id, "turn_id": "t1"}
+        path = os.path.join(tempfile.mkdtemp(), "state.pkl")
+        with patch.object(background_tool, "_state_path", return_value=path):
+            background_tool.run_async(state.copy(), graph=Graph())
+            self.assertTrue(started.wait(5))
+            # 第二輪送出時第一輪尚未完成，快照中的 project_content 仍是舊的
+            state["messages"].append(HumanMessage(content="第二輪"))
+            state["turn_id"] = "t2"
+            background_tool.run_async(state.copy(), graph=Graph())
+            release.set()
+            self.assertTrue(background_jobs.get_pool().join(5))
+        self.assertEqual(seen, ["", "+"])
+        self.assertEqual(background_jobs.get_registry().latest(session_id)["project_content"], "++")
+
+
+    def test_dialog_covers_unprocessed_turns(self):
+        """測試背景 agent 讀取自上次處理後的所有訊息"""
+        graph = _import_graph()
+        from langchain_core.messages import AIMessage, HumanMessage
+        messages = [AIMessage(content="a0")]
+        for i in range(1, 4):
+            messages += [HumanMessage(content=f"h{i}"), AIMessage(content=f"a{i}")]
+        state = {"messages": messages}
+        # 沒有紀錄時為最近 3 則
+        self.assertEqual(graph.dialog_since(state, "summary_cursor"), "a2\nh3\na3")
+        # 上次處理到第 1 輪（3 則訊息），合併後涵蓋第 2、3 輪
+        state["summary_cursor"] = 3
+        self.assertEqual(graph.dialog_since(state, "summary_cursor"), "a1\nh2\na2\nh3\na3")
+        with patch.object(graph.BackgroundConfig, "MAX_DIALOG_MESSAGES", 4):
+            self.assertEqual(graph.dialog_since(state, "summary_cursor"), "h2\na2\nh3\na3")
+        # 紀錄不合理（訊息被清除）時回到預設
+        state["summary_cursor"] = 99
+        self.assertEqual(graph.dialog_since(state, "summary_cursor"), "a2\nh3\na3")
+
+
+class TestSummaryPolicy(unittest.TestCase):
+    """測試依對話變化決定是否執行摘要"""
+    
+    def _state(self, *user_inputs, cursor=1, project_content="社區剩食"):
+        from langchain_core.messages import AIMessage, HumanMessage
+        messages = [AIMessage(content="嗨")]
+        for text in user_inputs:
+            messages += [HumanMessage(content=text), AIMessage(content="回覆")]
+        return {"messages": messages, "summary_cursor": cursor, "project_content": project_content,
+                "guidance_strategy": "提問"}
+    
+    def test_decisions(self):
+        """測試各種情況的判斷"""
+        from summary_policy import decide
+        self.assertEqual(decide(self._state("好", cursor=None)), (True, "initial"))
+        self.assertEqual(decide(self._state("好", project_content="")), (True, "initial"))
+        self.assertEqual(decide(self._state("好")), (False, "small_delta"))
+        self.assertEqual(decide(self._state("好", cursor=3)), (False, "no_new_input"))
+        self.assertEqual(decide(self._state("我想換主題")), (True, "keyword"))
+        self.assertEqual(decide(self._state("我們訪問了學校附近的三家便利商店，發現每天晚上都有大量即期食品被丟棄，"
+                                            "店員說總部規定不能捐出去")), (True, "tokens"))
+        self.assertEqual(decide(self._state("好", "ok", "嗯")), (True, "turns"))
+        state = self._state("好")
+        state["guidance_strategy"] = "總結"
+        self.assertEqual(decide(state), (True, "strategy"))
+    
+    def test_skipped_turns_folded_into_next_summary(self):
+        """測試略過時不呼叫 LLM 也不移動 cursor，下一次摘要涵蓋略過的輪次"""
+        graph = _import_graph()
+        state = self._state("好")
+        with patch.object(graph.llm_client, "invoke") as invoke:
+            graph.summary_agent(state)
+        invoke.assert_not_called()
+        self.assertEqual(state["summary_cursor"], 1)
+        from langchain_core.messages import AIMessage, HumanMessage
+        state["messages"] += [HumanMessage(content="我想改成減少校園剩食"), AIMessage(content="回覆")]
+        self.assertTrue(graph.summary_policy.should_summarize(state))
+        self.assertEqual(graph.dialog_since(state, "summary_cursor"), "嗨\n好\n回覆\n我想改成減少校園剩食\n回覆")
+    
+    def test_fused_mode_still_scores_when_summary_skipped(self):
+        """測試合併模式略過摘要時仍執行評分，與分開模式的 score 相同"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        from langchain_core.messages import AIMessage
+        graph = _import_graph()
+        response = AIMessage(content=json.dumps([{"current_progress": "評分後"}], ensure_ascii=False))
+        results = []
+        for run in (graph.score_agent, graph.summary_score_agent,
+                    lambda state: asyncio.run(graph.asummary_score_agent(state))):
+            state = self._state("好")
+            state.update(current_progress="評分前", score_cursor=1)
+            with patch.object(graph.llm_client, "invoke", return_value=response) as invoke, \
+                    patch.object(graph.llm_client, "ainvoke", AsyncMock(return_value=response)) as ainvoke:
+                run(state)
+            calls = invoke.call_args_list + ainvoke.call_args_list
+            self.assertEqual([call.args[0] for call in calls], ["score_agent"])
+            self.assertEqual(state["summary_cursor"], 1)
+            self.assertEqual(state["score_cursor"], len(state["messages"]))
+            results.append(state["current_progress"])
+        self.assertEqual(results, ["評分後"] * 3)
+    
+    def test_disabled(self):
+        """測試關閉時每輪都執行"""
+        from config import SummaryPolicyConfig
+        from summary_policy import decide
+        with patch.object(SummaryPolicyConfig, "ENABLED", False):
+            self.assertTrue(decide(self._state("好"))[0])
+
+
+class TestWorkerPool(unittest.TestCase):
+    """測試背景 worker pool 與佇列上限"""
+    
+    def _blocked_pool(self, overflow, **kwargs):
+        """建立一個 worker 被佔住的 pool，之後送出的工作都會留在佇列"""
+        import threading
+        from background_jobs import WorkerPool
+        pool = WorkerPool(workers=1, queue_size=2, overflow=overflow, **kwargs)
+        gate = threading.Event()
+        started = threading.Event()
+        pool.submit(lambda: (started.set(), gate.wait(5)))
+        self.assertTrue(started.wait(5))
+        return pool, gate
+    
+    def test_drop_oldest(self):
+        """測試 drop_oldest 丟棄最舊的等待中工作"""
+        ran = []
+        pool, gate = self._blocked_pool("drop_oldest")
+        for i in range(3):
+            self.assertTrue(pool.submit(lambda i=i: ran.append(i)))
+        self.assertEqual(pool.stats()["queue_depth"], 2)
+        gate.set()
+        self.assertTrue(pool.join(5))
+        self.assertEqual(ran, [1, 2])
+        self.assertEqual(pool.stats()["dropped"], 1)
+    
+    def test_reject_and_block_timeout(self):
+        """測試 reject 與 block 逾時時丟棄新工作"""
+        for overflow in ("reject", "block"):
+            ran = []
+            pool, gate = self._blocked_pool(overflow, block_timeout=0.05)
+            self.assertTrue(pool.submit(lambda: ran.append(0)))
+            self.assertTrue(pool.submit(lambda: ran.append(1)))
+            self.assertFalse(pool.submit(lambda: ran.append(2)))
+            gate.set()
+            self.assertTrue(pool.join(5))
+            self.assertEqual(ran, [0, 1])
+    
+    def test_block_waits_for_space(self):
+        """測試 block 模式等到有空位後排入"""
+        import threading
+        ran = []
+        pool, gate = self._blocked_pool("block", block_timeout=5)
+        pool.submit(lambda: ran.append(0))
+        pool.submit(lambda: ran.append(1))
+        threading.Timer(0.05, gate.set).start()
+        self.assertTrue(pool.submit(lambda: ran.append(2)))
+        self.assertTrue(pool.join(5))
+        self.assertEqual(ran, [0, 1, 2])
+    
+    def test_same_key_runs_in_order(self):
+        """測試同一 key 的工作依序執行，不同 key 平行執行"""
+        import threading
+        from background_jobs import WorkerPool
+        pool = WorkerPool(workers=4, queue_size=10)
+        lock = threading.Lock()
+        running = {"a": 0, "b": 0}
+        overlap = []
+        order = []
+        
+        def job(key, i):
+            with lock:
+                running[key] += 1
+                overlap.append(running[key] > 1)
+            time.sleep(0.05)
+            with lock:
+                order.append((key, i))
+                running[key] -= 1
+        
+        started = time.monotonic()
+        for i in range(3):
+            pool.submit(lambda i=i: job("a", i), key="a")
+            pool.submit(lambda i=i: job("b", i), key="b")
+        self.assertTrue(pool.join(5))
+        self.assertFalse(any(overlap))
+        self.assertEqual([i for k, i in order if k == "a"], [0, 1, 2])
+        self.assertEqual([i for k, i in order if k == "b"], [0, 1, 2])
+        # 兩個 session 平行，總時間約為單一 session 的時間
+        self.assertLess(time.monotonic() - started, 0.3)
+    
+    def test_coalesce_replaces_waiting_job(self):
+        """測試同一 key 還在等待的工作被新工作取代，執行中的工作不受影響"""
+        import threading
+        from background_jobs import WorkerPool
+        pool = WorkerPool(workers=1, queue_size=10)
+        gate = threading.Event()
+        started = threading.Event()
+        ran = []
+        pool.submit(lambda: (started.set(), gate.wait(5), ran.append(0)), key="a", coalesce=True)
+        self.assertTrue(started.wait(5))
+        for i in (1, 2, 3):
+            self.assertTrue(pool.submit(lambda i=i: ran.append(i), key="a", coalesce=True))
+        self.assertEqual(pool.stats()["queue_depth"], 1)
+        gate.set()
+        self.assertTrue(pool.join(5))
+        self.assertEqual(ran, [0, 3])
+        self.assertEqual(pool.stats()["coalesced"], 2)
+    
+    def test_metrics_and_errors(self):
+        """測試佇列指標，工作失敗不影響 worker"""
+        import metrics
+        from background_jobs import WorkerPool
+        with self.assertRaises(ValueError):
+            WorkerPool(1, 1, overflow="unknown")
+        pool = WorkerPool(workers=2, queue_size=4)
+        before = metrics.sample_count("background_queue_wait_seconds")
+        pool.submit(lambda: 1 / 0)
+        pool.submit(lambda: None)
+        self.assertTrue(pool.join(5))
+        self.assertEqual(metrics.sample_count("background_queue_wait_seconds"), before + 2)
+        self.assertEqual(pool.stats()["completed"], 2)
+        self.assertEqual(metrics.get_gauge("background_queue_depth"), 0)
+
+
+class TestChatStream(unittest.TestCase):
+    """測試串流對話介面（/chat/stream SSE 與 Gradio chat_stream）"""
+    
+    def _fake_llm(self, name):
+        from fake_llm import FakeChatModel
+        return FakeChatModel(model_name=name)
+    
+    def _events(self, client, session_id, prompt):
+        response = client.post("/chat/stream", json={"session_id": session_id, "user_prompt": prompt})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    
+    def test_sse_saves_history_without_background(self):
+        """測試背景工作未執行（去重、合併或捨棄）時，前景仍儲存每一輪對話"""
+        import tempfile
+        from fastapi.testclient import TestClient
+        graph = _import_graph()
+        import api_server
+        import background_tool
+        session_id = f"sse-{time.monotonic_ns()}"
+        with patch.object(background_tool, "SESSION_DIR", tempfile.mkdtemp()), \
+                patch.object(graph.llm_client, "get_agent_llm", return_value=self._fake_llm("sse")), \
+                patch.object(graph.background_tool, "run_async", return_value=False):
+            client = TestClient(api_server.app)
+            first = self._events(client, session_id, "我想解決校園的垃圾問題")
+            second = self._events(client, session_id, "我們先觀察垃圾桶")
+            saved = background_tool._load_state(session_id)
+        
+        for events in (first, second):
+            self.assertGreater(len(events), 1)
+            self.assertEqual({e["type"] for e in events[:-1]}, {"token"})
+            self.assertEqual(events[-1]["type"], "done")
+            self.assertTrue(events[-1]["content"])
+        self.assertEqual([m.type for m in saved["messages"]], ["human", "ai", "human", "ai"])
+        self.assertEqual(saved["messages"][-1].content, second[-1]["content"])
+    
+    def test_sse_error_event(self):
+        """測試串流失敗時送出 error 事件"""
+        from fastapi.testclient import TestClient
+        _import_graph()
+        import api_server
+        
+        async def failing(state):
+            yield "部分"
+            raise RuntimeError("boom")
+        
+        with patch.object(api_server, "astream_graph", failing):
+            events = self._events(TestClient(api_server.app), f"sse-error-{time.monotonic_ns()}", "你好")
+        self.assertEqual([e["type"] for e in events], ["token", "error"])
+        self.assertEqual(events[-1]["content"], "boom")
+    
+    def test_background_result_does_not_overwrite_newer_history(self):
+        """測試較晚完成的背景工作不會以較舊的對話覆寫前景已儲存的下一輪"""
+        import tempfile
+        import background_tool
+        from langchain_core.messages import AIMessage, HumanMessage
+        session_id = f"save-{time.monotonic_ns()}"
+        turn = [HumanMessage(content="第一輪"), AIMessage(content="回覆一")]
+        with patch.object(background_tool, "SESSION_DIR", tempfile.mkdtemp()):
+            background_tool.save_state({"session_id": session_id, "messages": turn + turn, "project_content": ""})
+            background_tool.save_state({"session_id": session_id, "messages": turn, "project_content": "摘要"})
+            saved = background_tool._load_state(session_id)
+        self.assertEqual(len(saved["messages"]), 4)
+        self.assertEqual(saved["project_content"], "摘要")
+    
+    def _run_gradio_stream(self, module, state):
+        graph = _import_graph()
+        with patch.object(graph.llm_client, "get_agent_llm", return_value=self._fake_llm("gradio-stream")), \
+                patch.object(graph.background_tool, "run_async", return_value=False):
+            return [[dict(m) for m in history] for history, _, _ in module.chat_stream("我想解決校園的垃圾問題", [], state)]
+    
+    def _check_gradio_updates(self, updates, state):
+        # 先顯示使用者訊息與空白的助理訊息，再逐段補上回覆
+        self.assertEqual(updates[0][-1], {"role": "assistant", "content": ""})
+        partials = [u[-1]["content"] for u in updates[1:-1]]
+        self.assertTrue(partials)
+        for shorter, longer in zip(partials, partials[1:]):
+            self.assertTrue(longer.startswith(shorter))
+        self.assertEqual(updates[-1][-1], {"role": "assistant", "content": state["messages"][-1].content})
+    
+    def _group_state(self, prefix):
+        """建立組別 state，回傳 (state, 組別目錄設定, 組別 state 檔路徑)"""
+        import tempfile
+        groups_dir = tempfile.mkdtemp()
+        session_id = f"{prefix}-{time.monotonic_ns()}"
+        path = os.path.join(groups_dir, "gradio-group", f"state_{session_id}.pkl")
+        state = {"messages": [], "project_content": "", "session_id": session_id, "group_id": "gradio-group"}
+        return state, patch.dict(os.environ, {"GROUPS_DIR": groups_dir}), path
+    
+    def test_student_interface_stream_saves_state(self):
+        """測試學生介面串流逐段更新歷史並儲存組別 state"""
+        import pickle
+        _import_graph()
+        import student_interface
+        state, groups_dir, path = self._group_state("gradio")
+        with groups_dir, patch.object(student_interface, "_get_group_state_path", return_value=path):
+            updates = self._run_gradio_stream(student_interface, state)
+        self._check_gradio_updates(updates, state)
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        self.assertEqual([m.type for m in saved["messages"]], ["human", "ai"])
+    
+    def test_student_interface_keeps_finished_background_summary(self):
+        """測試背景工作先於前景儲存完成時，組別 state 檔仍保留背景摘要"""
+        import pickle
+        import background_jobs
+        graph = _import_graph()
+        import student_interface
+        from fake_llm import FakeChatModel
+        state, groups_dir, path = self._group_state("gradio-order")
+        run_async = graph.background_tool.run_async
+        
+        def run_and_wait(*args, **kwargs):
+            # 背景工作在前景儲存之前完成
+            submitted = run_async(*args, **kwargs)
+            self.assertTrue(background_jobs.get_pool().join(5))
+            return submitted
+        
+        with groups_dir, patch.object(student_interface, "_get_group_state_path", return_value=path), \
+                patch.object(graph.llm_client, "get_agent_llm", return_value=FakeChatModel(model_name="gradio-order")), \
+                patch.object(graph.background_tool, "run_async", side_effect=run_and_wait):
+            student_interface.chat("我想解決校園的垃圾問題", [], state)
+        summary = background_jobs.get_registry().latest(state["session_id"])["project_content"]
+        self.assertTrue(summary)
+        self.assertEqual(state["project_content"], "")
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        self.assertEqual(saved["project_content"], summary)
+        self.assertEqual([m.type for m in saved["messages"]], ["human", "ai"])
+    
+    def test_projectflow_web_stream(self):
+        """測試 projectflow_web 串流逐段更新歷史"""
+        import tempfile
+        _import_graph()
+        try:
+            import projectflow_web
+        except Exception as e:  # 安裝的 gradio 版本不支援介面參數時無法匯入
+            self.skipTest(f"無法匯入 projectflow_web: {e}")
+        state = {"messages": [], "project_content": "", "session_id": f"web-{time.monotonic_ns()}"}
+        with patch.object(projectflow_web, "SESSION_DIR", tempfile.mkdtemp()):
+            updates = self._run_gradio_stream(projectflow_web, state)
+        self._check_gradio_updates(updates, state)
+
+
+class TestTeacherBatchAnalysis(unittest.TestCase):
+    """測試教師同時分析所有組別"""
+    
+    def _progress(self, count, prefix):
+        from models import GroupProgress
+        return [GroupProgress(group_id=f"{prefix}-{i}", group_name=f"{prefix} 第{i}組", message_count=i)
+                for i in range(count)]
+    
+    def test_groups_analyzed_concurrently_in_input_order(self):
+        """測試各組同時分析，結果順序與輸入相同"""
+        from fake_llm import FakeChatModel
+        from teacher_analysis_agent import TeacherAnalysisAgent
+        agent = TeacherAnalysisAgent(FakeChatModel(model_name="teacher-batch", latency_ms=300))
+        progress_list = self._progress(4, "batch")
+        started = time.monotonic()
+        analyses = agent.analyze_all_groups(progress_list, concurrency=4)
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual([a.group_id for a in analyses], [p.group_id for p in progress_list])
+    
+    def test_results_yielded_as_they_finish(self):
+        """測試先完成的組別先回傳"""
+        from models import TeacherAnalysis
+        from teacher_analysis_agent import TeacherAnalysisAgent
+        agent = TeacherAnalysisAgent(llm=object())
+        delays = {"order-0": 0.3, "order-1": 0.0, "order-2": 0.15}
+        
+        def analyze(progress):
+            time.sleep(delays[progress.group_id])
+            return TeacherAnalysis(group_id=progress.group_id)
+        
+        with patch.object(agent, "analyze_group", side_effect=analyze):
+            order = [a.group_id for a in agent.iter_analyses(self._progress(3, "order"))]
+        self.assertEqual(order, ["order-1", "order-2", "order-0"])
+    
+    def test_group_timeout_returns_partial_results(self):
+        """測試單組逾時只影響該組，回傳逾時的分析結果"""
+        import asyncio
+        from config import TeacherAnalysisConfig
+        from fake_llm import FakeChatModel
+        from teacher_analysis_agent import TeacherAnalysisAgent
+        agent = TeacherAnalysisAgent(FakeChatModel(model_name="teacher-timeout", latency_ms=500))
+        with patch.object(TeacherAnalysisConfig, "GROUP_TIMEOUT", 0.1):
+            started = time.monotonic()
+            analyses = asyncio.run(agent.aanalyze_all_groups(self._progress(2, "timeout")))
+            self.assertLess(time.monotonic() - started, 0.4)
+            analysis = agent.analyze_group(self._progress(1, "timeout-sync")[0])
+        self.assertEqual(len(analyses), 2)
+        for result in [*analyses, analysis]:
+            self.assertEqual(result.difficulties, ["分析逾時，尚無結果"])
+    
+    def test_default_agent_routes_through_llm_client(self):
+        """測試未指定 llm 時每組都交由 llm_client 依 agent 選擇模型與端點"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        from langchain_core.messages import AIMessage
+        import teacher_analysis_agent
+        agent = teacher_analysis_agent.TeacherAnalysisAgent()
+        response = AIMessage(content='{"difficulties": [], "suggestions": [], "analysis_summary": "ok"}')
+        with patch.object(teacher_analysis_agent.llm_client, "invoke", return_value=response) as invoke, \
+                patch.object(teacher_analysis_agent.llm_client, "ainvoke", AsyncMock(return_value=response)) as ainvoke:
+            agent.analyze_all_groups(self._progress(3, "route"))
+            asyncio.run(agent.aanalyze_all_groups(self._progress(3, "aroute")))
+        for mock in (invoke, ainvoke):
+            self.assertEqual(mock.call_count, 3)
+            for call in mock.call_args_list:
+                self.assertEqual(call.args[0], "teacher_analysis")
+                self.assertIsNone(call.kwargs["llm"])
+
+
+class TestFakeLLM(unittest.TestCase):
+    """測試離線測試用的假 LLM"""
+    
+    def _invoke(self, prompt, **kwargs):
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import HumanMessage
+        return FakeChatModel(**kwargs).invoke([HumanMessage(content=prompt)]).content
+    
+    def test_agent_outputs_are_parseable(self):
+        """測試各 agent 的輸出符合解析格式"""
+        import prompts
+        fields = dict(current_dialog="你好", project_content="", action_plan="",
+                      historical_log="", current_progress="")
+        summary = json.loads(self._invoke(prompts.SUMMARY_AGENT_PROMPT.format(**fields)))
+        self.assertEqual(set(summary[0]), {"project_content", "ACTION_PLAN", "HISTORICAL_LOG", "stage_number"})
+        score = json.loads(self._invoke(prompts.SCORE_AGENT_PROMPT.format(**fields)))
+        self.assertIn("current_progress", score[0])
+        decision = json.loads(self._invoke(prompts.DECISION_AGENT_PROMPT.format(**fields)))
+        self.assertIn("Guidance_and_Strategy", decision[0])
+    
+    def test_deterministic(self):
+        """測試相同 prompt 得到相同輸出"""
+        self.assertEqual(self._invoke("BuddyG 你好"), self._invoke("BuddyG 你好"))
+        self.assertNotEqual(self._invoke("BuddyG 你好"), self._invoke("BuddyG 再見"))
+    
+    def test_output_length_and_errors(self):
+        """測試輸出長度與錯誤率設定"""
+        from fake_llm import FakeLLMError
+        text = self._invoke("BuddyG", output_length=200, output_jitter=0)
+        self.assertGreaterEqual(len(text), 200)
+        with self.assertRaises(FakeLLMError):
+            self._invoke("BuddyG", error_rate=1.0)
+    
+    def test_stream_matches_invoke(self):
+        """測試串流輸出與一般呼叫一致"""
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import HumanMessage
+        model = FakeChatModel(chunk_size=3)
+        messages = [HumanMessage(content="BuddyG 串流")]
+        chunks = [c.content for c in model.stream(messages)]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), model.invoke(messages).content)
+    
+    def test_create_fake_provider(self):
+        """測試 LLM_PROVIDER=fake 不需要任何連線設定"""
+        from llm_client import create_llm
+        self.assertEqual(create_llm(provider="fake")._llm_type, "fake-chat")
+
+
+class TestSingleFlight(unittest.TestCase):
+    """測試相同請求合併"""
+    
+    def test_concurrent_calls_share_result(self):
+        """測試同時進行的相同 key 只執行一次"""
+        import threading
+        from singleflight import SingleFlight
+        flights = SingleFlight()
+        calls, results = [], []
+        
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return "result"
+        
+        threads = [threading.Thread(target=lambda: results.append(flights.do("k", slow))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([r for r, _ in results], ["result"] * 5)
+        self.assertEqual(sum(shared for _, shared in results), 4)
+        self.assertEqual(flights.in_flight(), 0)
+    
+    def test_error_is_shared_and_not_remembered(self):
+        """測試例外會傳給所有等待者，且完成後不再保留"""
+        from singleflight import SingleFlight
+        flights = SingleFlight()
+        with self.assertRaises(ValueError):
+            flights.do("k", Mock(side_effect=ValueError("boom")))
+        self.assertEqual(flights.do("k", lambda: "ok"), ("ok", False))
+    
+    def test_follower_respects_own_deadline(self):
+        """測試 leader 執行超過等待者的期限時，等待者拋出 DeadlineExceeded，leader 不受影響"""
+        import threading
+        import deadline
+        from singleflight import SingleFlight
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        results = []
+        
+        def slow():
+            started.set()
+            release.wait(5)
+            return "result"
+        
+        leader = threading.Thread(target=lambda: results.append(flights.do("k", slow)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        began = time.monotonic()
+        with deadline.use(deadline.start(0.1)):
+            with self.assertRaises(deadline.DeadlineExceeded) as ctx:
+                flights.do("k", slow, stage="response_agent")
+        self.assertLess(time.monotonic() - began, 1)
+        self.assertEqual(ctx.exception.stage, "response_agent")
+        release.set()
+        leader.join()
+        self.assertEqual(results, [("result", False)])
+    
+    def test_async_follower_respects_own_deadline(self):
+        """測試非同步等待者逾期時拋出 DeadlineExceeded，共用的 task 仍完成"""
+        import asyncio
+        import deadline
+        from singleflight import AsyncSingleFlight
+        flights = AsyncSingleFlight()
+        
+        async def slow():
+            await asyncio.sleep(0.3)
+            return "result"
+        
+        async def follower():
+            await asyncio.sleep(0)
+            with deadline.use(deadline.start(0.05)):
+                return await flights.do("k", slow)
+        
+        async def main():
+            return await asyncio.gather(flights.do("k", slow), follower(), return_exceptions=True)
+        
+        leader, follower_result = asyncio.run(main())
+        self.assertEqual(leader, ("result", False))
+        self.assertIsInstance(follower_result, deadline.DeadlineExceeded)
+    
+    def test_async_cancel_does_not_affect_others(self):
+        """測試非同步呼叫者被取消時，其他呼叫者仍取得結果"""
+        import asyncio
+        from singleflight import AsyncSingleFlight
+        flights = AsyncSingleFlight()
+        calls = []
+        
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+        
+        async def run():
+            first = asyncio.ensure_future(flights.do("k", slow))
+            second = asyncio.ensure_future(flights.do("k", slow))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            return await second
+        
+        self.assertEqual(asyncio.run(run()), ("result", True))
+        self.assertEqual(len(calls), 1)
+    
+    def test_invoke_coalesces_identical_prompts(self):
+        """測試 llm_client.invoke 對同時進行的相同 prompt 只呼叫一次模型"""
+        import threading
+        import llm_client
+        from langchain_core.messages import AIMessage, HumanMessage
+        llm = Mock(spec=["invoke", "temperature", "model_name"])
+        llm.temperature = 0
+        llm.model_name = "singleflight-test"
+        llm.invoke.side_effect = lambda messages: time.sleep(0.1) or AIMessage(content="分析結果")
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                llm_client.invoke("teacher_analysis", [HumanMessage(content="同一組")], llm=llm)
+            ))
+            for _ in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(llm.invoke.call_count, 1)
+        self.assertEqual([r.content for r in results], ["分析結果"] * 3)
+
+
+class TestPromptLayout(unittest.TestCase):
+    """測試利於前綴快取的 prompt 組裝"""
+    
+    FIELDS = dict(current_dialog="學生：我想做剩食", project_content="剩食計畫", action_plan="",
+                  historical_log="", current_progress="階段 1")
+    
+    def test_split_keeps_fields_at_end(self):
+        """測試靜態前綴不含欄位，動態部分以原本的結尾指示收尾"""
+        import prompts
+        from prompt_layout import split_template
+        for template in (prompts.SUMMARY_AGENT_PROMPT, prompts.SCORE_AGENT_PROMPT,
+                         prompts.DECISION_AGENT_PROMPT, prompts.RESPONSE_AGENT_PROMPT):
+            static, dynamic = split_template(template)
+            static.format()  # 靜態前綴沒有任何欄位
+            self.assertRegex(dynamic, r"\{\w+\}")
+            self.assertTrue(dynamic.rstrip().endswith("請回覆："))
+    
+    def test_prefix_mode_static_prefix_is_stable(self):
+        """測試 prefix 模式下不同輪的 SystemMessage 完全相同"""
+        import prompts
+        from langchain_core.messages import HumanMessage, SystemMessage
+        from prompt_layout import build_messages
+        with patch('config.LLMConfig.PROMPT_LAYOUT', 'prefix'):
+            first = build_messages(prompts.SUMMARY_AGENT_PROMPT, **self.FIELDS)
+            second = build_messages(prompts.SUMMARY_AGENT_PROMPT, **dict(self.FIELDS, current_dialog="下一輪"))
+        self.assertIsInstance(first[0], SystemMessage)
+        self.assertIsInstance(first[1], HumanMessage)
+        self.assertEqual(first[0].content, second[0].content)
+        self.assertIn("學生：我想做剩食", first[1].content)
+        self.assertNotIn("學生：我想做剩食", first[0].content)
+    
+    def test_inline_mode_unchanged(self):
+        """測試預設 inline 模式與原本的 format 結果相同"""
+        import prompts
+        from prompt_layout import build_messages
+        with patch('config.LLMConfig.PROMPT_LAYOUT', 'inline'):
+            messages = build_messages(prompts.SCORE_AGENT_PROMPT, **self.FIELDS)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].content, prompts.SCORE_AGENT_PROMPT.format(**self.FIELDS))
+    
+    def test_cached_tokens_recorded(self):
+        """測試依 usage_metadata 記錄前綴快取命中"""
+        import llm_client
+        import metrics
+        from fake_llm import FakeChatModel
+        from langchain_core.messages import HumanMessage, SystemMessage
+        metrics.reset()
+        llm = FakeChatModel(model_name="prefix-test")
+        for turn in ("第一輪", "第二輪"):
+            llm_client.invoke("score_agent", [SystemMessage(content="ScoreG 固定說明"), HumanMessage(content=turn)], llm=llm)
+        self.assertEqual(metrics.get_counter("llm_cached_input_tokens", agent="score_agent"), len("ScoreG 固定說明"))
+        self.assertGreater(metrics.get_gauge("llm_prefix_cache_hit_ratio", agent="score_agent"), 0)
+    
+    def test_marker_replaced_across_chunks(self):
+        """測試串流時被切開的專案內容標記仍會被替換"""
+        graph = _import_graph()
+        marker = graph._MarkerFilter("剩食計畫")
+        pieces = ["總結：[CURRENT_", "PROJECT_CON", "TENT]。有疑問嗎？[笑]"]
+        text = "".join(marker.feed(p) for p in pieces) + marker.flush()
+        self.assertEqual(text, "總結：剩食計畫。有疑問嗎？[笑]")
+
+
 def run_tests(verbosity=2):
     """執行所有測試"""
     # 建立測試套件
@@ -270,6 +1888,28 @@ def run_tests(verbosity=2):
     suite.addTests(loader.loadTestsFromTestCase(TestTextProcessing))
     suite.addTests(loader.loadTestsFromTestCase(TestConfiguration))
     suite.addTests(loader.loadTestsFromTestCase(TestPrompts))
+    suite.addTests(loader.loadTestsFromTestCase(TestLLMClient))
+    suite.addTests(loader.loadTestsFromTestCase(TestLLMCache))
+    suite.addTests(loader.loadTestsFromTestCase(TestMetrics))
+    suite.addTests(loader.loadTestsFromTestCase(TestRateLimiter))
+    suite.addTests(loader.loadTestsFromTestCase(TestEndpointPool))
+    suite.addTests(loader.loadTestsFromTestCase(TestHedging))
+    suite.addTests(loader.loadTestsFromTestCase(TestCircuitBreaker))
+    suite.addTests(loader.loadTestsFromTestCase(TestFusedSummaryScore))
+    suite.addTests(loader.loadTestsFromTestCase(TestStructuredOutput))
+    suite.addTests(loader.loadTestsFromTestCase(TestOutputBudget))
+    suite.addTests(loader.loadTestsFromTestCase(TestDeadline))
+    suite.addTests(loader.loadTestsFromTestCase(TestRetry))
+    suite.addTests(loader.loadTestsFromTestCase(TestLazyStartup))
+    suite.addTests(loader.loadTestsFromTestCase(TestForegroundReply))
+    suite.addTests(loader.loadTestsFromTestCase(TestBackgroundJobs))
+    suite.addTests(loader.loadTestsFromTestCase(TestSummaryPolicy))
+    suite.addTests(loader.loadTestsFromTestCase(TestWorkerPool))
+    suite.addTests(loader.loadTestsFromTestCase(TestChatStream))
+    suite.addTests(loader.loadTestsFromTestCase(TestTeacherBatchAnalysis))
+    suite.addTests(loader.loadTestsFromTestCase(TestFakeLLM))
+    suite.addTests(loader.loadTestsFromTestCase(TestSingleFlight))
+    suite.addTests(loader.loadTestsFromTestCase(TestPromptLayout))
     
     # 執行測試
     runner = unittest.TextTestRunner(verbosity=verbosity)
@@ -20,11 +20,12 @@ from dotenv import load_dotenv
 import os
 import re
 import yaml
-from langchain_openai import ChatOpenAI
-from langchain_google_vertexai import ChatVertexAI
 from langchain_core.messages import HumanMessage, AIMessage
 import logging
 
+from config import LLMConfig
+import llm_client
+
 # 設定 logging
 logging.basicConfig(
     level=logging.INFO,
@@ -35,33 +36,16 @@ logger = logging.getLogger(__name__)
 # Load environment config
 load_dotenv("./.env")
 
-# Set Azure OpenAI API (支援地端部署的 OpenAI 模型)
-azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-azure_api_key = os.getenv("AZURE_OPENAI_API_KEY")
-deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
-
 # LLM will be initialized when needed
 llm = None
 
 def get_llm():
-    """延遲初始化 LLM"""
+    """延遲初始化 LLM（透過 llm_client 共用連線池）"""
     global llm
     if llm is None:
-        if azure_endpoint and azure_api_key:
-            endpoint = azure_endpoint
-            if not endpoint.endswith("/v1"):
-                endpoint = endpoint.rstrip("/") + "/v1"
-            
-            llm = ChatOpenAI(
-                model=deployment_name,
-                base_url=endpoint,
-                api_key=azure_api_key,
-                temperature=0.7,
-                timeout=60,
-                max_retries=2
-            )
-        else:
-            llm = ChatVertexAI(model_name="gemini-2.5-flash", temperature=0.7)
+        # 有設定 OpenAI 相容 API 時依 LLM_PROVIDER 建立，否則使用 Vertex AI
+        provider = None if LLMConfig.use_openai() or LLMConfig.PROVIDER == "fake" else "vertexai"
+        llm = llm_client.get_llm(provider=provider, temperature=LLMConfig.TEMPERATURE)
     return llm
 
 # 主題設定 Agent 的 Prompt
@@ -181,7 +165,7 @@ def generate_theme_config(teacher_input):
     logger.info("正在生成主題設定...")
     
     prompt = THEME_SETTER_PROMPT.format(teacher_input=teacher_input)
-    response = get_llm().invoke([HumanMessage(content=prompt)])
+    response = llm_client.invoke("theme_setter", [HumanMessage(content=prompt)], llm=get_llm())
     
     # 解析 YAML
     yaml_content = response.content
@@ -213,7 +197,7 @@ def modify_agent_prompt(agent_name, original_prompt, theme_config):
         original_prompt=original_prompt
     )
     
-    response = get_llm().invoke([HumanMessage(content=prompt)])
+    response = llm_client.invoke("theme_setter", [HumanMessage(content=prompt)], llm=get_llm())
     return response.content.strip()
 
 
@@ -252,6 +236,7 @@ def load_original_prompts_from_backup():
         return {
             "SUMMARY_AGENT_PROMPT": prompts.SUMMARY_AGENT_PROMPT,
             "SCORE_AGENT_PROMPT": prompts.SCORE_AGENT_PROMPT,
+            "SUMMARY_SCORE_AGENT_PROMPT": prompts.SUMMARY_SCORE_AGENT_PROMPT,
             "DECISION_AGENT_PROMPT": prompts.DECISION_AGENT_PROMPT,
             "RESPONSE_AGENT_PROMPT": prompts.RESPONSE_AGENT_PROMPT,
         }
@@ -262,7 +247,7 @@ def load_original_prompts_from_backup():
     
     # 提取各個 prompt
     prompts_dict = {}
-    for prompt_name in ["SUMMARY_AGENT_PROMPT", "SCORE_AGENT_PROMPT", 
+    for prompt_name in ["SUMMARY_AGENT_PROMPT", "SCORE_AGENT_PROMPT", "SUMMARY_SCORE_AGENT_PROMPT",
                         "DECISION_AGENT_PROMPT", "RESPONSE_AGENT_PROMPT"]:
         start_marker = f'{prompt_name} = """'
         start_idx = backup_content.find(start_marker)
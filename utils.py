@@ -124,17 +124,24 @@ def clean_llm_response(text: str) -> str:
 
 # === Token 計數工具 ===
 
-# 嘗試導入 tiktoken，失敗時使用簡單估算
-try:
-    import tiktoken
-    _TIKTOKEN_AVAILABLE = True
-    _ENCODING = tiktoken.get_encoding("cl100k_base")
-except ImportError:
-    _TIKTOKEN_AVAILABLE = False
-    _ENCODING = None
-    logger.warning(
-        "tiktoken 未安裝，將使用簡單估算。建議安裝: pip install tiktoken"
-    )
+# tiktoken 的編碼表在第一次計數時才載入（載入約需數百毫秒，不計入啟動時間）
+_ENCODING = None
+_ENCODING_LOADED = False
+
+
+def _get_encoding():
+    """取得 cl100k_base 編碼，未安裝 tiktoken 時回傳 None"""
+    global _ENCODING, _ENCODING_LOADED
+    if not _ENCODING_LOADED:
+        try:
+            import tiktoken
+            _ENCODING = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            logger.warning(
+                "tiktoken 未安裝，將使用簡單估算。建議安裝: pip install tiktoken"
+            )
+        _ENCODING_LOADED = True
+    return _ENCODING
 
 
 def count_tokens(text: str) -> int:
@@ -149,9 +156,10 @@ def count_tokens(text: str) -> int:
     Returns:
         token 數量
     """
-    if _TIKTOKEN_AVAILABLE and _ENCODING:
+    encoding = _get_encoding()
+    if encoding:
         try:
-            return len(_ENCODING.encode(text))
+            return len(encoding.encode(text))
         except Exception as e:
             logger.error(f"Token 計數失敗: {e}")
             return len(text.split())
@@ -168,6 +176,7 @@ class TokenStats:
         self.stats: Dict[str, Dict[str, int]] = {
             "summary_agent": {"input": 0, "output": 0},
             "score_agent": {"input": 0, "output": 0},
+            "summary_score_agent": {"input": 0, "output": 0},
             "decision_agent": {"input": 0, "output": 0},
             "response_agent": {"input": 0, "output": 0},
         }